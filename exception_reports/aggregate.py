@@ -0,0 +1,329 @@
+"""
+Count json exception reports by exception type and location.
+
+Usage:
+
+    python -m exception_reports.aggregate /tmp/python-error-reports/ --hours 6 --top 20
+
+Works on a directory written by LocalErrorStorage or SegmentErrorStorage. Reports are parsed one at a time by a
+pool of worker processes that only keep the exception type, last frame and server time of each report. A report
+stored once with content_addressed=True is counted once for each of its recorded occurrences.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+
+# directories of shared objects written next to the reports by the storage options
+SHARED_DIRS = ("assets", "environment", "snippets", "occurrences", "index")
+# names of content-addressed reports and the occurrence records ErrorStorage.record_occurrence writes for them
+_ADDRESSED_NAME_RE = re.compile(r".*[0-9a-f]{40}\.json")
+_OCCURRENCE_NAME_RE = re.compile(r"(.*)occurrences/(.+)/[^/]+\.txt")
+
+
+def iter_report_paths(path, since=None):
+    """Yield the paths of the json reports under path, skipping files last modified before the since timestamp."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name not in SHARED_DIRS:
+                    yield from iter_report_paths(entry.path, since)
+            elif entry.name.endswith(".json"):
+                if (
+                    since is None
+                    or entry.stat().st_mtime >= since
+                    or _occurred_since(entry.path, since)
+                ):
+                    yield entry.path
+
+
+def _occurrence_log(report_path):
+    """Return the path of the occurrences log LocalErrorStorage.record_occurrence keeps for a report."""
+    directory, name = os.path.split(report_path)
+    return os.path.join(directory, "occurrences", f"{name}.log")
+
+
+def _occurred_since(report_path, since):
+    try:
+        return os.path.getmtime(_occurrence_log(report_path)) >= since
+    except OSError:
+        return False
+
+
+def _occurrence_timestamps(report_path):
+    """Return the timestamps of the recorded occurrences of a report, or None if it has none."""
+    try:
+        with open(_occurrence_log(report_path), "r", encoding="utf-8") as f:
+            return [_parse_time(line.strip()) for line in f if line.strip()]
+    except OSError:
+        return None
+
+
+def _parse_time(text):
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def summarize_report(report):
+    """Return the (exception type, location, server timestamp) of report data, or None if it isn't a report."""
+    if not isinstance(report, dict) or "exception_type" not in report:
+        return None
+    lastframe = report.get("lastframe") or {}
+    location = None
+    if lastframe:
+        location = (
+            f"{lastframe.get('filename')}:{lastframe.get('lineno')}"
+            f" in {lastframe.get('function')}"
+        )
+    timestamp = None
+    if report.get("server_time"):
+        timestamp = _parse_time(report["server_time"])
+    return report["exception_type"], location, timestamp
+
+
+class _Aggregate:
+    def __init__(self):
+        # (exception type, location) -> [count, first seen, last seen]
+        self.groups = {}
+        self.histogram = Counter()
+        # content-addressed segment reports and their occurrences, matched up once every segment is read
+        self.addressed = {}
+        self.occurrences = {}
+
+    def add(self, summary, since, bucket_seconds):
+        exception_type, location, timestamp = summary
+        if since is not None and timestamp is not None and timestamp < since:
+            return
+        key = (exception_type, location)
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = [1, timestamp, timestamp]
+        else:
+            group[0] += 1
+            if timestamp is not None:
+                group[1] = timestamp if group[1] is None else min(group[1], timestamp)
+                group[2] = timestamp if group[2] is None else max(group[2], timestamp)
+        if timestamp is not None:
+            self.histogram[key, timestamp - timestamp % bucket_seconds] += 1
+
+    def merge(self, other):
+        for key, (count, first_seen, last_seen) in other.groups.items():
+            group = self.groups.setdefault(key, [0, first_seen, last_seen])
+            group[0] += count
+            if first_seen is not None:
+                group[1] = first_seen if group[1] is None else min(group[1], first_seen)
+                group[2] = last_seen if group[2] is None else max(group[2], last_seen)
+        self.histogram.update(other.histogram)
+        self.addressed.update(other.addressed)
+        for name, timestamps in other.occurrences.items():
+            self.occurrences.setdefault(name, []).extend(timestamps)
+
+    def add_occurrences(self, since, bucket_seconds):
+        """Count the content-addressed reports once per occurrence."""
+        for name, summary in self.addressed.items():
+            timestamps = self.occurrences.get(name)
+            if timestamps is None:
+                self.add(summary, since, bucket_seconds)
+            for timestamp in timestamps or ():
+                self.add(summary[:2] + (timestamp,), since, bucket_seconds)
+        self.addressed = {}
+        self.occurrences = {}
+
+
+def _aggregate_files(paths, since, bucket_seconds):
+    aggregate = _Aggregate()
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                summary = summarize_report(json.load(f))
+        except (OSError, ValueError):
+            continue
+        if summary is None:
+            continue
+        timestamps = _occurrence_timestamps(path)
+        if timestamps is None:
+            aggregate.add(summary, since, bucket_seconds)
+        for timestamp in timestamps or ():
+            aggregate.add(summary[:2] + (timestamp,), since, bucket_seconds)
+    return aggregate
+
+
+def _aggregate_segment(segment, since, bucket_seconds, addressed_only=False):
+    """
+    Count the reports in a segment.
+
+    addressed_only: only read the content-addressed reports, for segments written before since that can still
+    hold the reports of later occurrences
+    """
+    from exception_reports.storages import iter_segment_records
+
+    aggregate = _Aggregate()
+    for _, name, data in iter_segment_records(segment, strict=False):
+        occurrence = _OCCURRENCE_NAME_RE.fullmatch(name)
+        if occurrence:
+            if not addressed_only:
+                report_name = occurrence.group(1) + occurrence.group(2)
+                timestamp = _parse_time(data.decode("utf8", "replace"))
+                aggregate.occurrences.setdefault(report_name, []).append(timestamp)
+            continue
+        addressed = _ADDRESSED_NAME_RE.fullmatch(name)
+        if not name.endswith(".json") or (addressed_only and not addressed):
+            continue
+        try:
+            summary = summarize_report(json.loads(data))
+        except ValueError:
+            continue
+        if summary is None:
+            continue
+        if addressed:
+            aggregate.addressed[name] = summary
+        else:
+            aggregate.add(summary, since, bucket_seconds)
+    return aggregate
+
+
+def _aggregate_old_segment(segment, since, bucket_seconds):
+    return _aggregate_segment(segment, since, bucket_seconds, addressed_only=True)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _tasks(path, since, chunk_size):
+    segments = sorted(
+        os.path.join(path, name) for name in os.listdir(path) if name.endswith(".seg")
+    )
+    for segment in segments:
+        if since is None or os.path.getmtime(segment) >= since:
+            yield _aggregate_segment, segment
+        else:
+            yield _aggregate_old_segment, segment
+    for chunk in _chunks(iter_report_paths(path, since), chunk_size):
+        yield _aggregate_files, chunk
+
+
+def aggregate_reports(
+    path, since=None, top=20, bucket_seconds=3600, processes=None, chunk_size=256
+):
+    """
+    Count the json reports under path by exception type and last frame location.
+
+    since: only count reports from after this datetime
+    top: how many of the most frequent groups to return
+    bucket_seconds: width of the histogram buckets
+    processes: number of worker processes, defaults to the number of cpus. 1 aggregates in the current process.
+
+    Returns {"total": ..., "groups": [...]} with groups sorted by count. Each group has its exception type,
+    location, count, first and last seen times and a histogram of {bucket start time: count}.
+    """
+    if isinstance(since, datetime):
+        since = since.timestamp()
+    processes = processes or os.cpu_count() or 1
+    tasks = _tasks(str(path), since, chunk_size)
+
+    aggregate = _Aggregate()
+    if processes == 1:
+        for function, argument in tasks:
+            aggregate.merge(function(argument, since, bucket_seconds))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # keep a few tasks in flight so report paths are listed as workers need them
+            pending = set()
+            for function, argument in tasks:
+                pending.add(executor.submit(function, argument, since, bucket_seconds))
+                if len(pending) >= processes * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        aggregate.merge(future.result())
+            for future in pending:
+                aggregate.merge(future.result())
+    aggregate.add_occurrences(since, bucket_seconds)
+
+    histograms = {}
+    for (key, bucket), count in aggregate.histogram.items():
+        histograms.setdefault(key, {})[_format_time(bucket)] = count
+
+    top_groups = sorted(
+        aggregate.groups.items(), key=lambda item: item[1][0], reverse=True
+    )[:top]
+    return {
+        "total": sum(count for count, _, _ in aggregate.groups.values()),
+        "groups": [
+            {
+                "exception_type": exception_type,
+                "location": location,
+                "count": count,
+                "first_seen": _format_time(first_seen),
+                "last_seen": _format_time(last_seen),
+                "histogram": dict(
+                    sorted(histograms.get((exception_type, location), {}).items())
+                ),
+            }
+            for (exception_type, location), (count, first_seen, last_seen) in top_groups
+        ],
+    }
+
+
+def _format_time(timestamp):
+    if timestamp is None:
+        return None
+    return str(datetime.fromtimestamp(timestamp, timezone.utc))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m exception_reports.aggregate",
+        description="Count json exception reports by exception type and location.",
+    )
+    parser.add_argument(
+        "path", help="directory of LocalErrorStorage or SegmentErrorStorage reports"
+    )
+    parser.add_argument(
+        "--hours", type=float, help="only count reports from the last N hours"
+    )
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument(
+        "--bucket-minutes", type=float, default=60, help="histogram bucket width"
+    )
+    parser.add_argument("--processes", type=int, help="defaults to the number of cpus")
+    parser.add_argument("--json", action="store_true", help="output json")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.hours * 3600 if args.hours else None
+    result = aggregate_reports(
+        args.path,
+        since=since,
+        top=args.top,
+        bucket_seconds=args.bucket_minutes * 60,
+        processes=args.processes,
+    )
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    print(f"{result['total']} reports")
+    for group in result["groups"]:
+        print(f"{group['count']:>8}  {group['exception_type']}  {group['location']}")
+        for bucket, count in group["histogram"].items():
+            print(f"{'':>10}{bucket}  {count}")
+
+
+if __name__ == "__main__":
+    main()
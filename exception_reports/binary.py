@@ -0,0 +1,189 @@
+"""
+Compact binary encoding of exception reports.
+
+A binary report holds the same data as the json report (decoding it and dumping the result as json gives the json
+report). It's encoded by the C marshal and zlib modules, so encoding a report takes less time than dumping it as
+json and the result is a fraction of the size.
+
+Layout:
+
+    magic            4 bytes   b"ERB3"
+    marshal version  1 byte    4
+    data             zlib compressed (level 1) marshal data of the report value
+
+The marshal format version is pinned rather than left to the running python, and recorded in the header so a
+python that can't read it raises ValueError instead of misreading the report. Marshal version 4 writes an object
+that occurs more than once, like the filename shared by the frames of a module, once and refers back to it. Equal
+local variable values of different frames are made the same string before encoding, so they're written once too.
+
+Values that marshal can't encode, like the traceback of each frame, the exceptions that caused a chained
+exception and the server time, are converted the way the json report converts them before encoding. Values that
+marshal encodes but json doesn't (tuples, sets, bytes, non-string keys) are converted when decoding. Like
+marshal, decoding isn't safe against maliciously constructed data, only decode reports from a trusted storage.
+
+Usage:
+
+    python -m exception_reports.binary report.erb --to html > report.html
+"""
+import json
+import marshal
+import sys
+import zlib
+
+MAGIC = b"ERB3"
+MARSHAL_VERSION = 4
+_TRACEBACK = "<Traceback object>"
+_PLAIN_TYPES = (str, int, float, bool, type(None))
+
+
+def encode_binary_report(exception_data):
+    """Encode report data as a binary report."""
+    from exception_reports.reporter import _json_serializer
+
+    data = dict(exception_data)
+    if "server_time" in data:
+        data["server_time"] = _json_serializer(data["server_time"])
+    convert = _FrameConverter(_json_serializer)
+    if isinstance(data.get("frames"), list):
+        data["frames"] = [convert(frame) for frame in data["frames"]]
+    if "lastframe" in data:
+        data["lastframe"] = convert(data["lastframe"])
+    if isinstance(data.get("exception_groups"), list):
+        data["exception_groups"] = [
+            {**group, "sub_exceptions": _convert_sub_exceptions(group, convert)}
+            for group in data["exception_groups"]
+        ]
+    try:
+        encoded = marshal.dumps(data, MARSHAL_VERSION)
+    except ValueError:
+        # an object marshal can't encode somewhere else in the report
+        from exception_reports.reporter import render_exception_json
+
+        encoded = marshal.dumps(
+            json.loads(render_exception_json(exception_data)), MARSHAL_VERSION
+        )
+    return MAGIC + bytes([MARSHAL_VERSION]) + zlib.compress(encoded, 1)
+
+
+def _convert_sub_exceptions(group, convert):
+    sub_exceptions = []
+    for sub_exception in group["sub_exceptions"]:
+        frames = [convert(frame) for frame in sub_exception["frames"]]
+        sub_exceptions.append({**sub_exception, "frames": frames})
+    return sub_exceptions
+
+
+class _FrameConverter:
+    """Converts the values of a frame that marshal can't encode, the way the json report converts them."""
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        # consecutive frames share the exception that caused theirs, it's only converted once
+        self.cause = self.cause_text = None
+        self.strings = {}
+
+    def __call__(self, frame):
+        if not isinstance(frame, dict):
+            return frame
+        frame = dict(frame)
+        if "tb" in frame:
+            frame["tb"] = _TRACEBACK
+        for key in ("exc_cause", "exc_cause_explicit"):
+            value = frame.get(key)
+            if value.__class__ in _PLAIN_TYPES:
+                continue
+            if value is not self.cause:
+                self.cause, self.cause_text = value, self.serializer(value)
+            frame[key] = self.cause_text
+        variables = frame.get("vars")
+        if variables.__class__ is list:
+            # equal values formatted for different frames are written once
+            strings = self.strings
+            frame["vars"] = [
+                (v[0], strings.setdefault(v[1], v[1]), *v[2:])
+                if v[1].__class__ is str
+                else v
+                for v in variables
+            ]
+        return frame
+
+
+def decode_binary_report(data):
+    """Decode a binary report to the data of the equivalent json report."""
+    if data[:4] != MAGIC or len(data) < 5:
+        raise ValueError("Not a binary exception report")
+    if data[4] > marshal.version:
+        raise ValueError(
+            f"Binary exception report uses marshal version {data[4]}, this python reads up to {marshal.version}"
+        )
+    try:
+        value = marshal.loads(zlib.decompress(data[5:]))
+    except (zlib.error, EOFError, TypeError) as e:
+        raise ValueError(f"Corrupt binary exception report: {e}") from e
+    return _json_value(value)
+
+
+def _json_value(value):
+    """Return value as json would decode its json encoding."""
+    if value is None or value.__class__ in (str, int, float, bool):
+        return value
+    if value.__class__ is dict:
+        return {
+            k if k.__class__ is str else _json_key(k): _json_value(v)
+            for k, v in value.items()
+        }
+    if value.__class__ in (list, tuple):
+        return [_json_value(item) for item in value]
+
+    from exception_reports.reporter import _json_serializer
+
+    return _json_serializer(value)
+
+
+def _json_key(key):
+    if key is None:
+        return "null"
+    if key is True:
+        return "true"
+    if key is False:
+        return "false"
+    if isinstance(key, float):
+        return float.__repr__(key)
+    return str(key)
+
+
+def binary_report_to_json(data):
+    """Convert a binary report to a json report."""
+    from exception_reports.reporter import render_exception_json
+
+    return render_exception_json(decode_binary_report(data))
+
+
+def binary_report_to_html(data):
+    """Convert a binary report to an html report."""
+    from exception_reports.reporter import render_exception_html
+
+    return render_exception_html(decode_binary_report(data))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m exception_reports.binary",
+        description="Convert a binary exception report to json or html.",
+    )
+    parser.add_argument("path")
+    parser.add_argument("--to", choices=("json", "html"), default="json")
+    args = parser.parse_args(argv)
+
+    with open(args.path, "rb") as f:
+        data = f.read()
+    converted = (
+        binary_report_to_html(data) if args.to == "html" else binary_report_to_json(data)
+    )
+    sys.stdout.buffer.write(converted.encode("utf8", "surrogateescape"))
+
+
+if __name__ == "__main__":
+    main()
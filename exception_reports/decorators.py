@@ -1,16 +1,22 @@
+import copy
+import logging
 import sys
+import threading
+from collections import namedtuple
+from contextlib import ContextDecorator
 
-from decorator import decorator
-
-from exception_reports.reporter import (
-    append_to_exception_message,
-    create_exception_report,
-)
 from exception_reports.storages import LocalErrorStorage
 
+logger = logging.getLogger(__name__)
+
 
 def exception_report(
-    storage_backend=LocalErrorStorage(), output_format="html", data_processor=None
+    storage_backend=None,
+    output_format="html",
+    data_processor=None,
+    include_memory=False,
+    render_pool=None,
+    load_shedder=None,
 ):
     """
     Decorator for creating detailed exception reports for thrown exceptions.
@@ -23,7 +29,12 @@ def exception_report(
 
         foobar('hi')
 
-    Output:
+    Output (on python 3.11+ the report location is added as a note):
+
+        Exception: bad things!!
+        [report:/tmp/python-error-reports/2018-01-05_06:15:56.218190+00:00_0773698470164da3b2c427d8832dac13.html]
+
+    Before python 3.11 the location is appended to the message:
 
         Exception: bad things!! [report:/tmp/python-error-reports/2018-01-05_06:15:56.218190+00:00_0773698470164da3b2c427d8832dac13.html]
 
@@ -36,25 +47,25 @@ def exception_report(
 
         foobar('hi')
     """
+    from decorator import decorator
+
+    if storage_backend is None:
+        storage_backend = LocalErrorStorage()
 
     def _exception_reports(func, *args, **kwargs):
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            exc_type, exc_value, tb = sys.exc_info()
-
-            report_location = create_exception_report(
-                exc_type,
-                exc_value,
-                tb,
+            e = _report_exception(
+                e,
+                sys.exc_info()[2],
+                storage_backend,
                 output_format,
-                storage_backend=storage_backend,
                 data_processor=data_processor,
+                include_memory=include_memory,
+                render_pool=render_pool,
+                load_shedder=load_shedder,
             )
-
-            e = append_to_exception_message(e, tb, f"[report:{report_location}]")
-            setattr(e, "report", report_location)
-
             # We want to raise the original exception:
             #    1) with a modified message containing the report location
             #    2) with the original traceback
@@ -62,3 +73,273 @@ def exception_report(
             raise e from None
 
     return decorator(_exception_reports)
+
+
+def _report_exception(e, tb, storage_backend, output_format, **report_kwargs):
+    """Create a report of e and return it with the report location added to its message and `report` attribute."""
+    from exception_reports.reporter import (
+        append_to_exception_message,
+        create_exception_report,
+    )
+
+    report_location = create_exception_report(
+        type(e), e, tb, output_format, storage_backend=storage_backend, **report_kwargs
+    )
+
+    if report_location is not None:
+        e = append_to_exception_message(e, tb, f"[report:{report_location}]")
+    setattr(e, "report", report_location)
+    return e
+
+
+def fast_exception_report(
+    storage_backend=None,
+    output_format="html",
+    data_processor=None,
+    **report_kwargs,
+):
+    """
+    Like `exception_report`, for functions called so often that the wrapper's overhead matters.
+
+    The wrapper is a plain function that calls the decorated function inside a try block, all the work is in the
+    except branch. Unlike `exception_report` the wrapper doesn't have the decorated function's exact signature,
+    it's copied with functools.wraps so `inspect.signature` still works.
+
+    Usage:
+
+        @fast_exception_report()
+        def parse_row(row):
+            ...
+    """
+    import functools
+
+    if storage_backend is None:
+        storage_backend = LocalErrorStorage()
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                e = _report_exception(
+                    e,
+                    sys.exc_info()[2],
+                    storage_backend,
+                    output_format,
+                    data_processor=data_processor,
+                    **report_kwargs,
+                )
+                raise e from None
+
+        return wrapper
+
+    return decorate
+
+
+class report_exceptions:
+    """
+    Context manager that creates a report of an exception raised in its block.
+
+    The exception is raised again with the report location added to its message, like `exception_report`.
+    Entering and leaving the block without an exception only costs the two method calls.
+
+    Usage:
+
+        with report_exceptions(output_format="json"):
+            handle(message)
+    """
+
+    def __init__(
+        self,
+        storage_backend=None,
+        output_format="html",
+        data_processor=None,
+        **report_kwargs,
+    ):
+        if storage_backend is None:
+            storage_backend = LocalErrorStorage()
+        self.storage_backend = storage_backend
+        self.output_format = output_format
+        self.data_processor = data_processor
+        self.report_kwargs = report_kwargs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None or not issubclass(exc_type, Exception):
+            return False
+        e = _report_exception(
+            exc_value,
+            tb,
+            self.storage_backend,
+            self.output_format,
+            data_processor=self.data_processor,
+            **self.report_kwargs,
+        )
+        if e is exc_value:
+            return False
+        raise e from None
+
+
+def install_excepthook(storage_backend=None, output_format="html", **report_kwargs):
+    """
+    Set sys.excepthook to create a report of uncaught exceptions and then call the previous hook.
+
+    The report location is added to the message of the exception the previous hook prints.
+    """
+    if storage_backend is None:
+        storage_backend = LocalErrorStorage()
+    previous_hook = sys.excepthook
+
+    def excepthook(exc_type, exc_value, tb):
+        if issubclass(exc_type, Exception):
+            try:
+                exc_value = _report_exception(
+                    exc_value, tb, storage_backend, output_format, **report_kwargs
+                )
+                exc_type = type(exc_value)
+            except Exception:  # noqa
+                logger.warning("Error generating exception report", exc_info=True)
+        previous_hook(exc_type, exc_value, tb)
+
+    sys.excepthook = excepthook
+    return excepthook
+
+
+def install_threading_excepthook(
+    storage_backend=None, output_format="html", **report_kwargs
+):
+    """
+    Set threading.excepthook to create a report of exceptions uncaught in threads and then call the previous hook.
+
+    The report location is added to the message of the exception the previous hook prints.
+    """
+    if storage_backend is None:
+        storage_backend = LocalErrorStorage()
+    previous_hook = threading.excepthook
+
+    def excepthook(args):
+        if issubclass(args.exc_type, Exception):
+            try:
+                exc_value = _report_exception(
+                    args.exc_value,
+                    args.exc_traceback,
+                    storage_backend,
+                    output_format,
+                    **report_kwargs,
+                )
+                args = _ExceptHookArgs(
+                    type(exc_value), exc_value, args.exc_traceback, args.thread
+                )
+            except Exception:  # noqa
+                logger.warning("Error generating exception report", exc_info=True)
+        previous_hook(args)
+
+    threading.excepthook = excepthook
+    return excepthook
+
+
+_ExceptHookArgs = namedtuple(
+    "_ExceptHookArgs", ["exc_type", "exc_value", "exc_traceback", "thread"]
+)
+
+
+class slow_call_report(ContextDecorator):
+    """
+    Decorator and context manager that creates a report when a call takes longer than threshold_ms.
+
+    The report shows the stack, local variables and source context of the call at the moment the threshold is
+    crossed, sampled from a helper thread, along with the elapsed time. The call itself isn't interrupted.
+
+    Usage:
+
+        @slow_call_report(threshold_ms=200)
+        def fetch_orders(customer):
+            ...
+
+        with slow_call_report(threshold_ms=50, name="render invoice"):
+            render_invoice(order)
+
+    Output (logged as a warning when the slow call finishes, or when its report is written if that's later):
+
+        Slow call fetch_orders took 1312 ms [report:/tmp/python-error-reports/2018-01-05_06:15:56.218190+00:00_0773698470164da3b2c427d8832dac13.html]
+    """
+
+    def __init__(
+        self,
+        threshold_ms,
+        storage_backend=None,
+        output_format="html",
+        data_processor=None,
+        name=None,
+    ):
+        if storage_backend is None:
+            storage_backend = LocalErrorStorage()
+        self.threshold = threshold_ms / 1000
+        self.storage_backend = storage_backend
+        self.output_format = output_format
+        self.data_processor = data_processor
+        self.name = name
+        self._watches = threading.local()
+
+    def __call__(self, func):
+        if self.name is None:
+            named = copy.copy(self)
+            named.name = func.__qualname__
+            return super(slow_call_report, named).__call__(func)
+        return super().__call__(func)
+
+    def __enter__(self):
+        from exception_reports.watchdog import get_slow_call_monitor
+
+        watch = get_slow_call_monitor().watch(self.threshold, self._report)
+        self._watches.__dict__.setdefault("stack", []).append(watch)
+        return watch
+
+    def __exit__(self, exc_type, exc_value, tb):
+        watch = self._watches.stack.pop()
+        with watch.lock:
+            watch.active = False
+            watch.duration = watch.elapsed
+            report_location = watch.report_location
+        # a report that is still being written is logged by the thread writing it, the call doesn't wait for it
+        if report_location is not None:
+            self._log(watch)
+        return False
+
+    def _log(self, watch):
+        logger.warning(
+            f"Slow call {self.name or 'block'} took {watch.duration * 1000:.0f} ms [report:{watch.report_location}]",
+            extra={"data": {"error_report": watch.report_location}},
+        )
+
+    def _report(self, watch):
+        from exception_reports.reporter import create_stack_report
+
+        with watch.lock:
+            if not watch.active:
+                return
+            tb = watch.current_stack()
+            if tb is None:
+                return
+            elapsed = watch.elapsed
+        name = self.name or "block"
+        report_location = None
+        try:
+            report_location = create_stack_report(
+                [(f"Slow call {name}", tb)],
+                "SlowCall",
+                f"{name} still running after {elapsed * 1000:.0f} ms (threshold {self.threshold * 1000:.0f} ms)",
+                self.output_format,
+                self.storage_backend,
+                data_processor=self.data_processor,
+            )
+        finally:
+            with watch.lock:
+                watch.report_location = report_location
+                finished = not watch.active
+            if finished and report_location is not None:
+                self._log(watch)
+            watch.reported.set()
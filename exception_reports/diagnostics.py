@@ -0,0 +1,178 @@
+import functools
+import gc
+import os
+import sys
+import threading
+import time
+from contextlib import suppress
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+_CONTAINER_TYPES = (list, tuple, set, frozenset, dict)
+_IMPORT_TIME = time.time()
+
+
+def approximate_size(value, max_items=1000):
+    """
+    Return the approximate size of value in bytes.
+
+    Containers include the size of their direct items, extrapolated from the first max_items items.
+    """
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, _CONTAINER_TYPES) and value:
+        items = value.items() if isinstance(value, dict) else value
+        item_count = 0
+        items_size = 0
+        for item in items:
+            if item_count == max_items:
+                break
+            if isinstance(value, dict):
+                items_size += sys.getsizeof(item[0], 0) + sys.getsizeof(item[1], 0)
+            else:
+                items_size += sys.getsizeof(item, 0)
+            item_count += 1
+        size += items_size * len(value) // item_count
+    return size
+
+
+def get_rss():
+    """Return the (current, peak) resident set size of the process in bytes. Either may be None if unavailable."""
+    rss = None
+    max_rss = None
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macos bytes
+        if sys.platform != "darwin":
+            max_rss *= 1024
+    return rss, max_rss
+
+
+def get_memory_data(frames, top=10, allocation_sites=True):
+    """
+    Return memory diagnostics for a report.
+
+    frames: traceback frames with their unformatted local variables, used to find the largest locals
+    top: how many of the largest locals and tracemalloc allocation sites to include
+    allocation_sites: whether to list the top tracemalloc allocation sites. Listing them takes a snapshot of every
+        traced allocation, which allocates a lot, so it's skipped for MemoryError reports.
+    """
+    import tracemalloc
+
+    rss, max_rss = get_rss()
+    data = {
+        "rss": rss,
+        "max_rss": max_rss,
+        "gc_counts": gc.get_count(),
+        "largest_locals": get_largest_locals(frames, top=top),
+        "tracemalloc": None,
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = []
+        if allocation_sites:
+            statistics = tracemalloc.take_snapshot().statistics("lineno")[:top]
+        data["tracemalloc"] = {
+            "current": current,
+            "peak": peak,
+            "top": [
+                {
+                    "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                    "size": stat.size,
+                    "count": stat.count,
+                }
+                for stat in statistics
+            ],
+        }
+    return data
+
+
+def get_largest_locals(frames, top=10):
+    """Return the top largest local variables of frames by approximate size."""
+    sizes = {}
+    for frame in frames:
+        for name, value in frame.get("vars") or []:
+            if id(value) in sizes:
+                continue
+            try:
+                size = approximate_size(value)
+            except Exception:  # noqa: W0718
+                continue
+            sizes[id(value)] = {
+                "function": frame.get("function"),
+                "name": name,
+                "type": type(value).__name__,
+                "size": size,
+            }
+    return sorted(sizes.values(), key=lambda v: v["size"], reverse=True)[:top]
+
+
+@functools.lru_cache()
+def _process_start_time():
+    """Return the wall clock time the process started, or when this module was imported if that's unknown."""
+    try:
+        with open("/proc/self/stat", "rb") as f:
+            # the command name can contain spaces, fields after it are space separated
+            start_ticks = int(f.read().rsplit(b")", 1)[1].split()[19])
+        with open("/proc/uptime", "rb") as f:
+            system_uptime = float(f.read().split()[0])
+        return time.time() - system_uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return _IMPORT_TIME
+
+
+def _open_fd_count():
+    """
+    Return the number of open file descriptors, or None where /proc isn't available.
+
+    Since Linux 6.2 the size of /proc/self/fd is the number of open descriptors, counted from the descriptor bitmap
+    by a single stat call. Older kernels report a size of 0, the directory is listed instead.
+    """
+    try:
+        count = os.stat("/proc/self/fd").st_size
+        if count:
+            return count
+        with os.scandir("/proc/self/fd") as entries:
+            # minus the descriptor of the listing itself
+            return sum(1 for _ in entries) - 1
+    except OSError:
+        return None
+
+
+def get_resource_data():
+    """
+    Return a cheap snapshot of the process resources for a report.
+
+    Only uses a few syscalls (no subprocesses), so it takes microseconds.
+    Values that aren't available on the current platform are None.
+    """
+    data = {
+        "uptime": round(time.time() - _process_start_time(), 3),
+        "thread_count": threading.active_count(),
+        "open_fds": _open_fd_count(),
+        "load_average": None,
+        "gc_counts": gc.get_count(),
+        "gc_collections": [gen["collections"] for gen in gc.get_stats()],
+        "rusage": None,
+    }
+    with suppress(AttributeError, OSError):
+        data["load_average"] = [round(load, 2) for load in os.getloadavg()]
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        data["rusage"] = {
+            "user_time": usage.ru_utime,
+            "system_time": usage.ru_stime,
+            "max_rss": usage.ru_maxrss,
+            "minor_faults": usage.ru_minflt,
+            "major_faults": usage.ru_majflt,
+            "voluntary_context_switches": usage.ru_nvcsw,
+            "involuntary_context_switches": usage.ru_nivcsw,
+        }
+    return data
@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# report detail levels, from most to least expensive
+FULL = "full"
+JSON_WITHOUT_LOCALS = "json"
+TRACEBACK_ONLY = "traceback"
+COUNT_ONLY = "count"
+DETAIL_LEVELS = (FULL, JSON_WITHOUT_LOCALS, TRACEBACK_ONLY, COUNT_ONLY)
+
+
+class ReportLoadShedder:
+    """
+    Lowers the detail of exception reports while generating them takes too much CPU.
+
+    The CPU time spent in reports over the last `window` seconds is compared to max_cpu_share of one CPU. Above
+    it, reports drop one detail level:
+
+        full (the requested format with local variables) -> json without local variables -> traceback only ->
+        count only (exception types are counted in `counts`, nothing is stored)
+
+    The level goes back up one step at a time once the share is below half of max_cpu_share for
+    min_level_duration seconds. At most max_concurrent reports are generated at once, further reports are only
+    counted.
+
+    Usage:
+
+        load_shedder = ReportLoadShedder(max_cpu_share=0.05)
+        create_exception_report(*sys.exc_info(), "html", storage_backend, load_shedder=load_shedder)
+    """
+
+    def __init__(
+        self,
+        max_cpu_share=0.1,
+        window=10,
+        max_concurrent=2,
+        min_level_duration=5,
+        check_interval=1,
+    ):
+        self.max_cpu_share = max_cpu_share
+        self.window = window
+        self.min_level_duration = min_level_duration
+        self.check_interval = check_interval
+        self.level = 0
+        self.counts = Counter()
+
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._level_lock = threading.Lock()
+        # (second, cpu seconds spent in reports that second)
+        self._cpu_seconds = deque()
+        self._last_check = time.monotonic()
+        self._last_change = self._last_check
+
+    @property
+    def detail_level(self):
+        return DETAIL_LEVELS[self.level]
+
+    def cpu_share(self, now=None):
+        """Return the CPU time spent in reports over the last window seconds as a share of one CPU."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._cpu_seconds and self._cpu_seconds[0][0] <= now - self.window:
+                self._cpu_seconds.popleft()
+            return sum(cpu for _, cpu in self._cpu_seconds) / self.window
+
+    def _record(self, cpu_time):
+        second = int(time.monotonic())
+        with self._lock:
+            if self._cpu_seconds and self._cpu_seconds[-1][0] == second:
+                self._cpu_seconds[-1][1] += cpu_time
+            else:
+                self._cpu_seconds.append([second, cpu_time])
+
+    def _update_level(self):
+        now = time.monotonic()
+        with self._level_lock:
+            if now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            share = self.cpu_share(now)
+            if share > self.max_cpu_share and self.level < len(DETAIL_LEVELS) - 1:
+                self.level += 1
+                self._last_change = now
+            elif (
+                share < self.max_cpu_share / 2
+                and self.level > 0
+                and now - self._last_change >= self.min_level_duration
+            ):
+                self.level -= 1
+                self._last_change = now
+
+    @contextmanager
+    def report(self, exc_type):
+        """Context manager around generating a report that yields the detail level to generate it at."""
+        if not self._slots.acquire(blocking=False):
+            self._count(exc_type)
+            yield COUNT_ONLY
+            return
+
+        start = time.thread_time()
+        try:
+            self._update_level()
+            level = self.detail_level
+            if level == COUNT_ONLY:
+                self._count(exc_type)
+            yield level
+        finally:
+            self._record(time.thread_time() - start)
+            self._slots.release()
+
+    def _count(self, exc_type):
+        with self._lock:
+            self.counts[_type_name(exc_type)] += 1
+
+
+def _type_name(exc_type):
+    return getattr(exc_type, "__name__", str(exc_type))
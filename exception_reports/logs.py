@@ -1,7 +1,9 @@
 import logging
+import math
 import time
+from json import JSONEncoder
+from json.encoder import encode_basestring
 
-from exception_reports.reporter import create_exception_report
 from exception_reports.storages import LocalErrorStorage
 from exception_reports.traceback import get_logger_traceback
 
@@ -18,13 +20,28 @@ def async_exception_handler(loop, context):
 
 
 class AddExceptionReportFilter(logging.Filter):
-    def __init__(self, storage_backend=LocalErrorStorage(), output_format="json"):
+    def __init__(
+        self,
+        storage_backend=None,
+        output_format="json",
+        include_memory=False,
+        render_pool=None,
+        load_shedder=None,
+    ):
         super().__init__()
+        if storage_backend is None:
+            storage_backend = LocalErrorStorage()
         self.storage_backend = storage_backend
         self.output_format = output_format
+        self.include_memory = include_memory
+        self.render_pool = render_pool
+        self.load_shedder = load_shedder
 
     def filter(self, record):
         if record.levelno >= logging.ERROR:
+            # imported here so configuring logging doesn't load the report rendering machinery
+            from exception_reports.reporter import create_exception_report
+
             if not getattr(record, "data", None):
                 setattr(record, "data", {})
             exc_type, exc_value, tb = record.exc_info or (
@@ -35,7 +52,14 @@ class AddExceptionReportFilter(logging.Filter):
 
             try:
                 record.data["error_report"] = create_exception_report(
-                    exc_type, exc_value, tb, self.output_format, self.storage_backend
+                    exc_type,
+                    exc_value,
+                    tb,
+                    self.output_format,
+                    self.storage_backend,
+                    include_memory=self.include_memory,
+                    render_pool=self.render_pool,
+                    load_shedder=self.load_shedder,
                 )
             except Exception as e:  # noqa
                 logger.warning(f"Error generating exception report {repr(e)}")
@@ -73,6 +97,121 @@ class ExtraDataLogFormatter(logging.Formatter):
         return super().format(record)
 
 
+class JsonLogFormatter(logging.Formatter):
+    """
+    Formats records as json lines, with the 'data' attribute (including 'error_report') as a "data" object.
+
+    fields: (json key, record attribute) pairs. "time", "message", "exc_info" and "stack_info" are computed.
+
+    The json key prefixes are encoded once, and the timestamp text is reused for records logged in the same second.
+    """
+
+    default_fields = (
+        ("time", "time"),
+        ("level", "levelname"),
+        ("logger", "name"),
+        ("function", "funcName"),
+        ("process", "process"),
+        ("message", "message"),
+    )
+
+    def __init__(self, fields=None, utc_timezone=False):
+        super().__init__()
+        self.utc_timezone = utc_timezone
+        self._encode_str = encode_basestring
+        self._encode = JSONEncoder(default=str, allow_nan=False).encode
+        self._fields = []
+        for i, (key, attribute) in enumerate(fields or self.default_fields):
+            prefix = ("{" if i == 0 else ", ") + encode_basestring(key) + ": "
+            self._fields.append((prefix, attribute))
+        self._time_cache = (None, "", "")
+
+    def _format_time(self, record):
+        second = int(record.created)
+        cached_second, text, suffix = self._time_cache
+        if second != cached_second:
+            if self.utc_timezone:
+                time_tuple = time.gmtime(second)
+                suffix = 'Z"'
+            else:
+                time_tuple = time.localtime(second)
+                suffix = time.strftime('%z"', time_tuple)
+            text = time.strftime('"%Y-%m-%dT%H:%M:%S.', time_tuple)
+            self._time_cache = (second, text, suffix)
+        return f"{text}{int(record.msecs):03d}{suffix}"
+
+    def _encode_value(self, value):
+        if value.__class__ is str:
+            return self._encode_str(value)
+        if value.__class__ is int:
+            return str(value)
+        try:
+            return self._encode(value)
+        except ValueError:
+            # NaN and infinity aren't valid json, or value is circular
+            try:
+                return self._encode(_finite(value))
+            except (TypeError, ValueError, RecursionError):
+                pass
+        except (TypeError, RecursionError):
+            # keys json can't encode, or value is nested too deep
+            pass
+        from pprint import saferepr
+
+        return self._encode_str(saferepr(value))
+
+    def format(self, record):
+        parts = []
+        for prefix, attribute in self._fields:
+            parts.append(prefix)
+            if attribute == "time":
+                parts.append(self._format_time(record))
+            elif attribute == "message":
+                parts.append(self._encode_str(record.getMessage()))
+            else:
+                parts.append(self._encode_value(getattr(record, attribute, None)))
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            parts.append(', "exc_info": ')
+            parts.append(self._encode_str(record.exc_text))
+        if record.stack_info:
+            parts.append(', "stack_info": ')
+            parts.append(self._encode_str(self.formatStack(record.stack_info)))
+
+        data = getattr(record, "data", None)
+        if data:
+            if isinstance(data, dict):
+                separator = ', "data": {'
+                for k, v in data.items():
+                    if v is not None:
+                        parts.append(separator)
+                        parts.append(self._encode_str(str(k)))
+                        parts.append(": ")
+                        parts.append(self._encode_value(v))
+                        separator = ", "
+                if separator == ", ":
+                    parts.append("}")
+            else:
+                # Output something, even if 'data' wasn't a dictionary.
+                parts.append(', "data": ')
+                parts.append(self._encode_str(str(data)))
+        parts.append("}")
+        return "".join(parts)
+
+
+def _finite(value):
+    """Return value with the NaN and infinite floats in it, and in the lists and dicts it contains, as strings."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return repr(value)
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(v) for v in value]
+    return value
+
+
 DEFAULT_LOGGING_CONFIG = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -81,10 +220,7 @@ DEFAULT_LOGGING_CONFIG = {
             "()": ExtraDataLogFormatter,
             "format": "%(asctime)s %(process)d [%(levelname)s] %(name)s.%(funcName)s: %(message)s; %(data_as_kv)s",
         },
-        # 'json': {
-        #     '()': 'pythonjsonlogger.jsonlogger.JsonFormatter',
-        #     'format': '%(asctime)s %(process)d [%(levelname)s] %(name)s.%(funcName)s: %(message)s; %(data_as_kv)s'
-        # }
+        "json": {"()": JsonLogFormatter},
     },
     "filters": {"add_exception_report": {"()": AddExceptionReportFilter}},
     "handlers": {
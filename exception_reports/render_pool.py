@@ -0,0 +1,148 @@
+import logging
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
+from pickle import PicklingError
+
+logger = logging.getLogger(__name__)
+
+_PRIMITIVE_TYPES = (str, int, float, bool, type(None), datetime, date)
+
+
+class RenderedValue(str):
+    """The str() of a value that couldn't be sent to a render worker. repr() returns the repr of the original value."""
+
+    def __new__(cls, value):
+        self = super().__new__(cls, _safe_call(str, value))
+        self.value_repr = _safe_call(repr, value)
+        return self
+
+    def __repr__(self):
+        return self.value_repr
+
+    def __reduce__(self):
+        return _rendered_value, (str(self), self.value_repr)
+
+
+def _rendered_value(text, value_repr):
+    value = str.__new__(RenderedValue, text)
+    value.value_repr = value_repr
+    return value
+
+
+def _safe_call(func, value):
+    try:
+        return func(value)
+    except Exception as e:  # noqa: W0718
+        return f"<{type(value).__name__} object, {func.__name__}() raised {e!r}>"
+
+
+def to_primitives(value):
+    """
+    Return a copy of report data made only of builtin types that can be cheaply pickled.
+
+    Values of other types (tracebacks, exception objects) are replaced by a RenderedValue that renders the same way.
+    """
+    if isinstance(value, _PRIMITIVE_TYPES):
+        # markupsafe.Markup is a str subclass that pickles as itself, so escaped values stay escaped
+        return value
+    if isinstance(value, dict):
+        return {k: to_primitives(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_primitives(v) for v in value)
+    return RenderedValue(value)
+
+
+def _render_html(exception_data, asset_urls):
+    from exception_reports.reporter import render_exception_html
+
+    return render_exception_html(exception_data, asset_urls=asset_urls)
+
+
+def _warm_up():
+    from exception_reports.reporter import _compile_template, _report_template
+
+    _compile_template(_report_template())
+
+
+class RenderPool:
+    """
+    Renders html reports in a small pool of worker processes so rendering doesn't hold the GIL of the calling process.
+
+    The report data is converted to builtin types (see to_primitives) and sent to a worker, the calling thread waits
+    for the rendered html without holding the GIL. At most max_pending reports are queued, further reports are
+    rendered in the calling process, as are reports that can't be sent to the pool, time out or hit a broken pool.
+
+    Workers are started with the "spawn" method, which imports the main module in each worker. Scripts that render
+    reports through a pool need an `if __name__ == "__main__":` guard around their entry point, like any script
+    using a spawn process pool.
+
+    Usage:
+
+        render_pool = RenderPool(processes=2)
+        create_exception_report(*sys.exc_info(), "html", storage_backend, render_pool=render_pool)
+    """
+
+    def __init__(self, processes=2, max_pending=8, timeout=10):
+        self.processes = processes
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # forking a threaded server could copy locks held by other threads into the workers
+                self._executor = ProcessPoolExecutor(  # noqa: R1732
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_up,
+                )
+            return self._executor
+
+    def render_html(self, exception_data, asset_urls=None):
+        """Render exception_data as an html report, in a worker process when one is available."""
+        if self._slots is not None and self._slots.acquire(blocking=False):  # noqa: R1732
+            try:
+                return self._render_in_pool(exception_data, asset_urls)
+            except (
+                BrokenProcessPool,
+                FutureTimeoutError,
+                PicklingError,
+                TypeError,
+                OSError,
+                RuntimeError,
+            ):
+                logger.warning(
+                    "Rendering exception report in worker failed, rendering in process",
+                    exc_info=True,
+                )
+            finally:
+                self._slots.release()
+
+        return _render_html(exception_data, asset_urls)
+
+    def _render_in_pool(self, exception_data, asset_urls):
+        # render_exception_html adds the repr builtin to the data itself
+        exception_data = {k: v for k, v in exception_data.items() if k != "repr"}
+        future = self._get_executor().submit(
+            _render_html, to_primitives(exception_data), asset_urls
+        )
+        try:
+            return future.result(self.timeout)
+        except BrokenProcessPool:
+            self.shutdown(wait=False)
+            raise
+        finally:
+            future.cancel()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,155 @@
+/*
+ Frames are rendered from the json payload next to each traceback list, the last CHUNK_SIZE items first. Source
+ context and local variables are only rendered once a frame is expanded. Payload strings are escaped html.
+*/
+var CHUNK_SIZE = 50;
+var tracebacks = [];
+
+window.onload = function () {
+    var lists = document.querySelectorAll('ul.traceback[data-payload]');
+    for (var i = 0; i < lists.length; i++) {
+        var payload = document.getElementById(lists[i].getAttribute('data-payload'));
+        var fallback = document.getElementById(payload.id + '-static');
+        if (fallback) {
+            fallback.parentNode.removeChild(fallback);
+        }
+        var traceback = {list: lists[i], items: JSON.parse(payload.textContent), start: 0, more: null};
+        traceback.start = traceback.items.length;
+        tracebacks.push(traceback);
+        showEarlier(traceback, CHUNK_SIZE);
+    }
+    if (location.hash.indexOf('#f') === 0) {
+        showFrame(location.hash.slice(2));
+    }
+};
+
+function showEarlier(traceback, count) {
+    var start = Math.max(0, traceback.start - count);
+    var fragment = document.createDocumentFragment();
+    for (var i = start; i < traceback.start; i++) {
+        fragment.appendChild(renderItem(traceback.items[i]));
+    }
+    traceback.list.insertBefore(fragment, traceback.more ? traceback.more.nextSibling : traceback.list.firstChild);
+    traceback.start = start;
+
+    if (start === 0) {
+        if (traceback.more) {
+            traceback.list.removeChild(traceback.more);
+            traceback.more = null;
+        }
+        return;
+    }
+    if (!traceback.more) {
+        traceback.more = document.createElement('li');
+        traceback.more.className = 'more';
+        traceback.more.innerHTML = '<a href="#"></a>';
+        traceback.more.firstChild.onclick = function () {
+            showEarlier(traceback, CHUNK_SIZE);
+            return false;
+        };
+        traceback.list.insertBefore(traceback.more, traceback.list.firstChild);
+    }
+    traceback.more.firstChild.textContent = 'Show ' + Math.min(start, CHUNK_SIZE) + ' earlier items (' + start + ' hidden)';
+}
+
+function showFrame(id) {
+    for (var t = 0; t < tracebacks.length; t++) {
+        var traceback = tracebacks[t];
+        for (var i = 0; i < traceback.items.length; i++) {
+            if (traceback.items[i].id == id) {
+                if (i < traceback.start) {
+                    showEarlier(traceback, traceback.start - i);
+                }
+                document.getElementById('f' + id).scrollIntoView();
+                return false;
+            }
+        }
+    }
+    return true;
+}
+
+function renderItem(item) {
+    var li = document.createElement('li');
+    if (typeof item === 'string') {
+        li.innerHTML = '<h3>' + item + '</h3>';
+        return li;
+    }
+
+    li.className = 'frame ' + item.type;
+    li.id = 'f' + item.id;
+    var html = '<code>' + item.filename + '</code> in <code>' + item.function + '</code>';
+    if (item.context_line !== undefined) {
+        html += '<div class="context"><ol start="' + item.lineno + '" class="context-line"><li><pre>' +
+            item.context_line + '</pre> <span>...</span></li></ol></div>';
+    }
+    if (item.vars) {
+        html += '<div class="commands"><a href="#"><span>&#x25b6;</span> Local vars</a></div>';
+    }
+    li.innerHTML = html;
+
+    if (item.context_line !== undefined) {
+        li.querySelector('ol.context-line li').onclick = function () {
+            return contextToggle(li, item);
+        };
+    }
+    if (item.vars) {
+        li.querySelector('div.commands a').onclick = function () {
+            return varToggle(this, li, item);
+        };
+    }
+    return li;
+}
+
+function contextLines(className, start, lines, onclick) {
+    var ol = document.createElement('ol');
+    ol.className = className;
+    ol.start = start;
+    ol.innerHTML = lines.map(function (line) {
+        return '<li><pre>' + line + '</pre></li>';
+    }).join('');
+    ol.onclick = onclick;
+    return ol;
+}
+
+function contextToggle(li, item) {
+    var context = li.querySelector('div.context');
+    var lists = context.querySelectorAll('ol.pre-context, ol.post-context');
+    if (lists.length) {
+        for (var i = 0; i < lists.length; i++) {
+            lists[i].style.display = lists[i].style.display == 'none' ? 'block' : 'none';
+        }
+        return false;
+    }
+    var onclick = function () {
+        return contextToggle(li, item);
+    };
+    if (item.pre_context && item.pre_context.length) {
+        context.insertBefore(contextLines('pre-context', item.pre_context_lineno, item.pre_context, onclick), context.firstChild);
+    }
+    if (item.post_context && item.post_context.length) {
+        context.appendChild(contextLines('post-context', item.lineno + 1, item.post_context, onclick));
+    }
+    return false;
+}
+
+function varToggle(link, li, item) {
+    var table = li.querySelector('table.vars');
+    if (!table) {
+        table = document.createElement('table');
+        table.className = 'vars';
+        table.innerHTML = '<thead><tr><th>Variable</th><th>Value</th></tr></thead><tbody>' +
+            item.vars.map(function (v) {
+                var value = '<pre>' + v[1] + '</pre>';
+                if (v.length > 2) {
+                    value = '<a href="#f' + v[2] + '" onclick="return showFrame(\'' + v[2] + '\')">' + value + '</a>';
+                }
+                return '<tr><td>' + v[0] + '</td><td class="code">' + value + '</td></tr>';
+            }).join('') + '</tbody>';
+        li.appendChild(table);
+    } else {
+        table.style.display = table.style.display == 'none' ? 'table' : 'none';
+    }
+    var s = link.getElementsByTagName('span')[0];
+    s.innerHTML = table.style.display == 'none' ? String.fromCharCode(0x25b6) : String.fromCharCode(0x25bc);
+    return false;
+}
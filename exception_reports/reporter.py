@@ -1,8 +1,10 @@
+import builtins
 import functools
+import hashlib
 import json
 import logging
-import platform
 import re
+import reprlib
 import sys
 import types
 from contextlib import suppress
@@ -11,37 +13,259 @@ from html import escape
 from pathlib import Path
 from pprint import pformat, saferepr
 
-import jinja2
-
-from exception_reports.traceback import TracebackFrameProxy, get_logger_traceback
+from exception_reports.diagnostics import get_memory_data, get_resource_data
+from exception_reports.traceback import (
+    TracebackFrameProxy,
+    TracebackSnapshot,
+    get_logger_traceback,
+)
 from exception_reports.utils import force_text, gen_error_filename
 
 logger = logging.getLogger(__name__)
 
+ENVIRONMENT_KEYS = ("sys_executable", "sys_version_info", "sys_path", "platform")
+VOLATILE_KEYS = ("server_time", "resources", "memory", "lastframe", "repr")
+# output formats and the file extension of their reports
+REPORT_EXTENSIONS = {"html": "html", "json": "json", "binary": "erb"}
+SNIPPET_KEYS = ("pre_context_lineno", "pre_context", "context_line", "post_context")
+INDEX_COLUMNS = ("time", "exception", "message", "last frame")
+INDEX_MESSAGE_LENGTH = 200
+
+_environment_snapshot = {}
+_environment_html_cache = {}
+
+
+TEMPLATE_DIR = Path(__file__).parent
+
+
+def minify_template(template):
+    """Collapse the whitespace of an html template."""
+    template = re.sub(r"\s{2,}", " ", template)
+    template = re.sub(r"\n", "", template)
+    template = re.sub(r"> <", "><", template)
+    return template
+
+
+def build_minified_template():
+    """
+    Regenerate the minified report template and assets from their sources.
+
+    The minified files are shipped with the package so reports don't pay for the whitespace collapsing at runtime.
+    Run `make templates` after editing report_template.html, report_template.css or report_template.js.
+    """
+    for extension in ("html", "css", "js"):
+        with open(TEMPLATE_DIR / f"report_template.{extension}", "r", encoding="utf-8") as f:
+            template = minify_template(f.read())
+        with open(TEMPLATE_DIR / f"report_template.min.{extension}", "w", encoding="utf-8") as f:
+            f.write(template)
+
 
 @functools.lru_cache()
 def _report_template():
     """get the report template."""
-    current_dir = Path(__file__).parent
+    with open(TEMPLATE_DIR / "report_template.min.html", "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@functools.lru_cache()
+def _report_assets():
+    """get the css and javascript used by the report template."""
+    assets = {}
+    for extension in ("css", "js"):
+        with open(TEMPLATE_DIR / f"report_template.min.{extension}", "r", encoding="utf-8") as f:
+            assets[extension] = f.read()
+    return assets
+
+
+@functools.lru_cache()
+def report_asset_files():
+    """Return the versioned filenames of the report assets, mapped to their contents."""
+    asset_files = {}
+    for extension, text in _report_assets().items():
+        asset_hash = hashlib.sha1(text.encode("utf8")).hexdigest()
+        asset_files[f"assets/{asset_hash}.{extension}"] = text
+    return asset_files
 
-    with open(current_dir / "report_template.html", "r", encoding="utf-8") as f:
-        template = f.read()
-        template = re.sub(r"\s{2,}", " ", template)
-        template = re.sub(r"\n", "", template)
-        template = re.sub(r"> <", "><", template)
-    return template
 
+@functools.lru_cache(maxsize=8)
+def _compile_template(report_template):
+    """Compile a report template. jinja2 is only imported once a report is rendered."""
+    import jinja2
 
-def render_exception_html(exception_data, report_template=None):
-    """Render exception_data as an html report."""
-    report_template = report_template or _report_template()
     jinja_env = jinja2.Environment(
         loader=jinja2.BaseLoader(),
         extensions=[],
         autoescape=jinja2.select_autoescape(["html", "htm", "xml"]),
     )
+    jinja_env.filters["traceback_payload"] = _traceback_payload
+    jinja_env.filters["exception_group_payload"] = _exception_group_payload
+    return jinja_env.from_string(report_template)
+
+
+def _payload_json(items):
+    from markupsafe import Markup
+
+    # "<" is escaped so the payload can't end the script element it's embedded in
+    return Markup(json.dumps(items, default=str).replace("<", "\\u003c"))
+
+
+def _escape_html(value):
+    # the same escaping as the template's escape filter
+    from markupsafe import escape as escape_markup
+
+    return str(escape_markup(value))
+
+
+def _frame_payload(frame, frames):
+    """Return the data the report javascript renders a frame from, with its strings escaped."""
+    payload = {
+        "id": frame.get("id"),
+        "type": frame.get("type"),
+        "filename": _escape_html(frame.get("filename")),
+        "function": _escape_html(frame.get("function")),
+        "lineno": frame.get("lineno"),
+    }
+    if frame.get("context_line"):
+        payload["context_line"] = _escape_html(frame["context_line"])
+        if frame.get("pre_context"):
+            payload["pre_context_lineno"] = frame.get("pre_context_lineno")
+            payload["pre_context"] = [
+                _escape_html(line) for line in frame["pre_context"]
+            ]
+        if frame.get("post_context"):
+            payload["post_context"] = [
+                _escape_html(line) for line in frame["post_context"]
+            ]
+    if frame.get("vars"):
+        references = frame.get("var_references") or {}
+        payload["vars"] = []
+        for name, value in frame["vars"]:
+            # values are escaped when they're formatted, see format_frame_vars
+            var = [_escape_html(name), str(value)]
+            if name in references:
+                var.append(frames[references[name]["frame"] - 1].get("id"))
+            payload["vars"].append(var)
+    return payload
+
+
+def _traceback_payload(frames):
+    """
+    Return the json the report javascript renders the traceback from.
+
+    Frames are objects, the headings between them (exception causes and sections) are strings of escaped html.
+    """
+    items = []
+    cause = None
+    section = None
+    for frame in frames:
+        if frame.get("exc_cause") != cause and frame.get("exc_cause"):
+            cause_repr = _escape_html(repr(frame["exc_cause"]))
+            if frame.get("is_full_stack_trace"):
+                items.append("Full Stack Trace")
+            elif frame.get("exc_cause_explicit"):
+                items.append(
+                    f"The above exception ({cause_repr}) was the direct cause of the"
+                    " following exception:"
+                )
+            else:
+                items.append(
+                    f"During handling of the above exception ({cause_repr}), another"
+                    " exception occurred:"
+                )
+        cause = frame.get("exc_cause")
+        if frame.get("section") and frame["section"] != section:
+            items.append(_escape_html(frame["section"]))
+        section = frame.get("section")
+        items.append(_frame_payload(frame, frames))
+    return _payload_json(items)
+
+
+def _exception_group_payload(group):
+    """Return the json the report javascript renders the sub-exceptions of an exception group from."""
+    items = []
+    for sub_exception in group["sub_exceptions"]:
+        exception_type = _escape_html(sub_exception["exception_type"])
+        exception_value = _escape_html(sub_exception["exception_value"])
+        items.append(
+            f"{sub_exception['count']} &times; {exception_type}: {exception_value}"
+        )
+        if sub_exception.get("frames_omitted"):
+            items.append(f"{sub_exception['frames_omitted']} frames omitted")
+        frames = sub_exception.get("frames") or []
+        items.extend(_frame_payload(frame, frames) for frame in frames)
+    return _payload_json(items)
+
+
+def get_environment_data():
+    """
+    Return a snapshot of the process environment (python executable, version, path and platform).
+
+    The snapshot is computed once per process and only refreshed when sys.path changes. Each call returns a copy so
+    data processors can alter it.
+    """
+    snapshot = _environment_snapshot.get("data")
+    if snapshot is None or snapshot["sys_path"] != sys.path:
+        import platform
+
+        snapshot = {
+            "sys_executable": sys.executable,
+            "sys_version_info": "%d.%d.%d" % sys.version_info[0:3],  # noqa: C0209
+            "sys_path": list(sys.path),
+            "platform": platform.uname()._asdict(),
+        }
+        snapshot["environment_hash"] = _environment_hash(snapshot)
+        _environment_snapshot["data"] = snapshot
+    return {
+        **snapshot,
+        "sys_path": list(snapshot["sys_path"]),
+        "platform": dict(snapshot["platform"]),
+    }
+
+
+def _environment_hash(exception_data):
+    """Return the hash of the environment fields of exception_data, as they are after any data processor."""
+    environment = {k: exception_data.get(k) for k in ENVIRONMENT_KEYS}
+    environment_json = json.dumps(environment, default=repr, sort_keys=True)
+    return hashlib.sha1(environment_json.encode("utf8", "surrogateescape")).hexdigest()
+
+
+def _render_environment_html(template, exception_data):
+    """Render the environment section of a report, reusing the rendered fragment for the same environment fields."""
+    environment_hash = None
+    if "sys_path" in exception_data:
+        # otherwise the environment is stored separately and the fragment only links to it
+        environment_hash = _environment_hash(exception_data)
+    cache_key = (template, environment_hash)
+    environment_html = _environment_html_cache.get(cache_key)
+    if environment_html is None:
+        context = template.new_context(exception_data)
+        environment_html = "".join(template.blocks["environment"](context))
+        if environment_hash:
+            if len(_environment_html_cache) > 16:
+                _environment_html_cache.clear()
+            _environment_html_cache[cache_key] = environment_html
+    return environment_html
+
+
+def render_exception_html(exception_data, report_template=None, asset_urls=None):
+    """
+    Render exception_data as an html report.
+
+    asset_urls: links to the "css" and "js" assets. When not supplied the assets are inlined in the report.
+    """
+    from markupsafe import Markup
+
+    template = _compile_template(report_template or _report_template())
     exception_data["repr"] = repr
-    return jinja_env.from_string(report_template).render(exception_data)
+    environment_html = _render_environment_html(template, exception_data)
+    assets = _report_assets()
+    return template.render(
+        exception_data,
+        environment_html=Markup(environment_html),
+        asset_urls=asset_urls,
+        report_css=Markup(assets["css"]),
+        report_js=Markup(assets["js"]),
+    )
 
 
 def render_exception_json(exception_data):
@@ -54,7 +278,7 @@ def _json_serializer(obj):
     if isinstance(obj, (datetime, date)):
         return obj.isoformat(sep=" ")
 
-    if isinstance(obj, (types.TracebackType, TracebackFrameProxy)):
+    if isinstance(obj, (types.TracebackType, TracebackFrameProxy, TracebackSnapshot)):
         return "<Traceback object>"
 
     return saferepr(obj)
@@ -66,6 +290,10 @@ def get_exception_data(
     tb=None,
     get_full_tb=False,
     max_var_length=4096 + 2048,
+    max_group_exceptions=100,
+    max_group_frames=200,
+    include_memory=False,
+    include_locals=True,
 ):
     """
     Return a dictionary containing exception information.
@@ -73,40 +301,22 @@ def get_exception_data(
     if exc_type, exc_value, and tb are not provided they will be supplied by sys.exc_info()
 
     max_var_length: how long a variable's output can be before it's truncated
+    max_group_exceptions: how many sub-exceptions of an exception group are examined
+    max_group_frames: how many frames are shown for the sub-exceptions of an exception group
+    include_memory: add a memory section (rss, gc counts, largest locals and tracemalloc top allocations)
+    include_locals: include the local variables of each frame
 
     """
 
-    head_var_length = int(max_var_length / 2)
-    tail_var_length = max_var_length - head_var_length
-
     if not tb:
         exc_type, exc_value, tb = sys.exc_info()
 
     frames = get_traceback_frames(exc_value=exc_value, tb=tb, get_full_tb=get_full_tb)
-
-    for i, frame in enumerate(frames):
-        if "vars" in frame:
-            frame_vars = []
-            for k, v in frame["vars"]:
-                try:
-                    v = pformat(v)
-                except Exception as e:  # noqa: W0718
-                    try:
-                        v = saferepr(e)
-                    except Exception:  # noqa: W0718
-                        v = (
-                            "An error occurred rendering the exception of type: "
-                            + repr(e.__class__)
-                        )
-                # The force_escape filter assume unicode, make sure that works
-                if isinstance(v, bytes):
-                    v = v.decode("utf-8", "replace")  # don't choke on non-utf-8 input
-                # Trim large blobs of data
-                if len(v) > max_var_length:
-                    v = f"{v[0:head_var_length]}... \n\n<trimmed {len(v)} bytes string>\n\n ...{v[-tail_var_length:]}"
-                frame_vars.append((k, escape(v)))
-            frame["vars"] = frame_vars
-        frames[i] = frame
+    memory = get_memory_data(frames) if include_memory else None
+    if not include_locals:
+        for frame in frames:
+            frame.pop("vars", None)
+    format_frame_vars(frames, max_var_length)
 
     unicode_hint = ""
     if exc_type and issubclass(exc_type, UnicodeError):
@@ -127,11 +337,9 @@ def get_exception_data(
     c = {
         "unicode_hint": unicode_hint,
         "frames": frames,
-        "sys_executable": sys.executable,
-        "sys_version_info": "%d.%d.%d" % sys.version_info[0:3],  # noqa: C0209
         "server_time": datetime.now(timezone.utc),
-        "sys_path": sys.path,
-        "platform": platform.uname()._asdict(),
+        **get_environment_data(),
+        "resources": get_resource_data(),
     }
     # Check whether exception info is available
     if exc_type:
@@ -140,10 +348,205 @@ def get_exception_data(
         c["exception_value"] = force_text(exc_value, errors="replace")
     if frames:
         c["lastframe"] = frames[-1]
+    if memory is not None:
+        c["memory"] = memory
+
+    exception_groups = get_exception_group_data(
+        exc_value,
+        max_exceptions=max_group_exceptions,
+        max_frames=max_group_frames,
+        max_var_length=max_var_length,
+    )
+    if exception_groups:
+        c["exception_groups"] = exception_groups
 
     return c
 
 
+def get_stack_data(stacks, report_type, message, max_var_length=4096 + 2048):
+    """
+    Return a dictionary like get_exception_data's for stacks that didn't raise an exception.
+
+    stacks: (label, traceback) pairs, e.g. one per thread. Each stack is shown under its label.
+    report_type: shown in place of the exception type
+    message: shown in place of the exception message
+    """
+    frames = []
+    for label, tb in stacks:
+        stack_frames = get_traceback_frames(exc_value=Exception(label), tb=tb, get_full_tb=False)
+        for frame in stack_frames:
+            frame["section"] = label
+        frames.extend(stack_frames)
+    format_frame_vars(frames, max_var_length)
+
+    c = {
+        "unicode_hint": "",
+        "frames": frames,
+        "server_time": datetime.now(timezone.utc),
+        **get_environment_data(),
+        "resources": get_resource_data(),
+        "exception_type": report_type,
+        "exception_value": message,
+    }
+    if frames:
+        c["lastframe"] = frames[-1]
+    return c
+
+
+def format_frame_vars(frames, max_var_length=4096 + 2048, min_reference_length=100):
+    """
+    Format the local variables of frames as escaped strings, trimming values longer than max_var_length.
+
+    An object that is a local of several frames is only formatted once. Repeats that format to at least
+    min_reference_length characters are shown as a reference to the first frame (numbered from 1) that has it, and
+    listed in the frame's "var_references" as {name: {"frame": number, "name": name in that frame}}.
+    """
+    # id -> (value, frame number, name, text), the value keeps its id from being reused by another object
+    formatted = {}
+    for number, frame in enumerate(frames, 1):
+        if "vars" in frame:
+            frame_vars = []
+            references = {}
+            for k, v in frame["vars"]:
+                first = formatted.get(id(v))
+                if first is None or first[0] is not v:
+                    text = _format_var(v, max_var_length)
+                    formatted[id(v)] = (v, number, k, text)
+                else:
+                    _, first_number, first_name, text = first
+                    if len(text) >= min_reference_length:
+                        references[k] = {"frame": first_number, "name": first_name}
+                        text = escape(f"same as frame {first_number} `{first_name}`")
+                frame_vars.append((k, text))
+            frame["vars"] = frame_vars
+            if references:
+                frame["var_references"] = references
+    return frames
+
+
+def _format_var(v, max_var_length):
+    head_var_length = int(max_var_length / 2)
+    tail_var_length = max_var_length - head_var_length
+    try:
+        v = pformat(v)
+    except Exception as e:  # noqa: W0718
+        try:
+            v = saferepr(e)
+        except Exception:  # noqa: W0718
+            v = "An error occurred rendering the exception of type: " + repr(
+                e.__class__
+            )
+    # The force_escape filter assume unicode, make sure that works
+    if isinstance(v, bytes):
+        v = v.decode("utf-8", "replace")  # don't choke on non-utf-8 input
+    # Trim large blobs of data
+    if len(v) > max_var_length:
+        v = f"{v[0:head_var_length]}... \n\n<trimmed {len(v)} bytes string>\n\n ...{v[-tail_var_length:]}"
+    return escape(v)
+
+
+def _exception_group_types():
+    exception_group_types = []
+    if hasattr(builtins, "BaseExceptionGroup"):
+        exception_group_types.append(builtins.BaseExceptionGroup)
+    with suppress(ImportError):
+        from exceptiongroup import BaseExceptionGroup as BackportedExceptionGroup
+
+        exception_group_types.append(BackportedExceptionGroup)
+    return tuple(exception_group_types)
+
+
+def _exception_chain(exc_value):
+    while exc_value is not None:
+        yield exc_value
+        exc_value = getattr(exc_value, "__cause__", None) or getattr(
+            exc_value, "__context__", None
+        )
+
+
+def _traceback_shape(exc_value):
+    shape = [type(exc_value).__qualname__]
+    tb = exc_value.__traceback__
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        shape.append((code.co_filename, code.co_name, tb.tb_lineno))
+        tb = tb.tb_next
+    return tuple(shape)
+
+
+def get_exception_group_data(
+    exc_value, max_exceptions=100, max_frames=200, max_var_length=4096 + 2048
+):
+    """
+    Return a summary of the exception groups in the exception chain of exc_value.
+
+    Sub-exceptions of a group (including those of nested groups) with the same type and traceback are shown once,
+    with a count. Only the first max_exceptions sub-exceptions are examined, the rest are only counted. Frames are
+    included for unique sub-exceptions until max_frames frames have been collected.
+    """
+    exception_group_types = _exception_group_types()
+    if not exception_group_types:
+        return []
+
+    groups = []
+    frames_left = max_frames
+    for group in _exception_chain(exc_value):
+        if not isinstance(group, exception_group_types):
+            continue
+
+        sub_exceptions = {}
+        examined = 0
+        unexamined = 0
+        nested_groups = 0
+        pending = list(reversed(group.exceptions))
+        while pending:
+            sub_exception = pending.pop()
+            if isinstance(sub_exception, exception_group_types):
+                nested_groups += 1
+                pending.extend(reversed(sub_exception.exceptions))
+                continue
+            if examined >= max_exceptions:
+                unexamined += 1
+                continue
+            examined += 1
+
+            shape = _traceback_shape(sub_exception)
+            entry = sub_exceptions.get(shape)
+            if entry is None:
+                frames = get_traceback_frames(
+                    exc_value=sub_exception,
+                    tb=sub_exception.__traceback__,
+                    get_full_tb=False,
+                )
+                frames_omitted = 0
+                if len(frames) > frames_left:
+                    frames_omitted = len(frames)
+                    frames = []
+                frames_left -= len(frames)
+                entry = sub_exceptions[shape] = {
+                    "exception_type": type(sub_exception).__name__,
+                    "exception_value": force_text(sub_exception, errors="replace"),
+                    "count": 0,
+                    "frames": format_frame_vars(frames, max_var_length),
+                    "frames_omitted": frames_omitted,
+                }
+            entry["count"] += 1
+
+        groups.append(
+            {
+                "exception_type": type(group).__name__,
+                "exception_value": force_text(group, errors="replace"),
+                "nested_groups": nested_groups,
+                "examined": examined,
+                "unexamined": unexamined,
+                "sub_exceptions": sorted(
+                    sub_exceptions.values(), key=lambda e: e["count"], reverse=True
+                ),
+            }
+        )
+    return groups
+
+
 def get_lines_from_file(filename, lineno, context_lines, loader=None, module_name=None):
     """
     Returns context_lines before and after lineno from file.
@@ -280,45 +683,495 @@ def create_exception_report(
     storage_backend,
     data_processor=None,
     get_full_tb=False,
+    include_memory=False,
+    render_pool=None,
+    load_shedder=None,
 ):
     """
     Create an exception report and return its location.
+
+    MemoryErrors get a minimal json report instead, see create_memory_error_report.
+    render_pool: a render_pool.RenderPool to render html reports in worker processes
+    load_shedder: a load_shedding.ReportLoadShedder that lowers the report detail while reports take too much CPU.
+        No report is stored, and None is returned, when it only counts the exception.
     """
+    if exc_type is not None and issubclass(exc_type, MemoryError):
+        return create_memory_error_report(
+            exc_type, exc_value, tb, storage_backend, data_processor=data_processor
+        )
+
+    if load_shedder is None:
+        return _create_exception_report(
+            exc_type,
+            exc_value,
+            tb,
+            output_format,
+            storage_backend,
+            data_processor=data_processor,
+            get_full_tb=get_full_tb,
+            include_memory=include_memory,
+            render_pool=render_pool,
+        )
+
+    from exception_reports.load_shedding import COUNT_ONLY, FULL, TRACEBACK_ONLY
+
+    with load_shedder.report(exc_type) as detail_level:
+        if detail_level == COUNT_ONLY:
+            return None
+        if detail_level == TRACEBACK_ONLY:
+            return create_traceback_report(
+                exc_type, exc_value, tb, storage_backend, data_processor=data_processor
+            )
+        return _create_exception_report(
+            exc_type,
+            exc_value,
+            tb,
+            output_format if detail_level == FULL else "json",
+            storage_backend,
+            data_processor=data_processor,
+            get_full_tb=get_full_tb,
+            include_memory=include_memory,
+            include_locals=detail_level == FULL,
+            render_pool=render_pool,
+        )
+
+
+def _create_exception_report(
+    exc_type,
+    exc_value,
+    tb,
+    output_format,
+    storage_backend,
+    data_processor=None,
+    get_full_tb=False,
+    include_memory=False,
+    include_locals=True,
+    render_pool=None,
+):
     exception_data = get_exception_data(
-        exc_type, exc_value, tb, get_full_tb=get_full_tb
+        exc_type,
+        exc_value,
+        tb,
+        get_full_tb=get_full_tb,
+        include_memory=include_memory,
+        include_locals=include_locals,
     )
     if data_processor:
         exception_data = data_processor(exception_data)
 
-    if output_format == "html":
-        text = render_exception_html(exception_data)
-    elif output_format == "json":
-        text = render_exception_json(exception_data)
-    else:
+    return store_exception_data(
+        exception_data, output_format, storage_backend, render_pool=render_pool
+    )
+
+
+def create_traceback_report(
+    exc_type, exc_value, tb, storage_backend, data_processor=None
+):
+    """Create a json report with only the exception and the location of each frame, and return its location."""
+    frames = []
+    while tb is not None:
+        if tb.tb_frame.f_locals.get("__traceback_hide__"):
+            tb = tb.tb_next
+            continue
+        frames.append(
+            {
+                "filename": tb.tb_frame.f_code.co_filename,
+                "function": tb.tb_frame.f_code.co_name,
+                "lineno": tb.tb_lineno,
+            }
+        )
+        tb = tb.tb_next
+
+    exception_data = {
+        "frames": frames,
+        "server_time": str(datetime.now(timezone.utc)),
+        "exception_type": getattr(exc_type, "__name__", "Exception"),
+        "exception_value": force_text(exc_value, errors="replace"),
+        "lastframe": frames[-1] if frames else None,
+    }
+    if data_processor:
+        exception_data = data_processor(exception_data)
+
+    text = json.dumps(exception_data, default=str)
+    return storage_backend.write(gen_error_filename(extension="json"), text)
+
+
+def create_memory_error_report(
+    exc_type, exc_value, tb, storage_backend, data_processor=None
+):
+    """
+    Create a minimal json report for a MemoryError and return its location.
+
+    Formatting locals and source context could fail again, or make things worse, while memory is exhausted. The
+    report only has frame locations, short reprs of the local variables and the memory section, without the
+    tracemalloc allocation sites which need a snapshot of every allocation.
+    """
+    short_repr = reprlib.Repr()
+    short_repr.maxstring = short_repr.maxother = 80
+    short_repr.maxlevel = 1
+
+    frames = []
+    while tb is not None:
+        if tb.tb_frame.f_locals.get("__traceback_hide__"):
+            tb = tb.tb_next
+            continue
+        frame_vars = list(tb.tb_frame.f_locals.items())
+        frames.append(
+            {
+                "filename": tb.tb_frame.f_code.co_filename,
+                "function": tb.tb_frame.f_code.co_name,
+                "lineno": tb.tb_lineno,
+                "vars": frame_vars,
+            }
+        )
+        tb = tb.tb_next
+
+    try:
+        memory = get_memory_data(frames, allocation_sites=False)
+    except MemoryError:
+        memory = None
+    for frame in frames:
+        frame["vars"] = [(k, short_repr.repr(v)) for k, v in frame["vars"]]
+
+    exception_data = {
+        "frames": frames,
+        "server_time": str(datetime.now(timezone.utc)),
+        "exception_type": exc_type.__name__,
+        "exception_value": force_text(exc_value, errors="replace"),
+        "lastframe": frames[-1] if frames else None,
+        "memory": memory,
+        "environment_hash": _environment_snapshot.get("data", {}).get(
+            "environment_hash"
+        ),
+    }
+    if data_processor:
+        exception_data = data_processor(exception_data)
+
+    text = json.dumps(exception_data, default=str)
+    return storage_backend.write(gen_error_filename(extension="json"), text)
+
+
+def create_stack_report(
+    stacks,
+    report_type,
+    message,
+    output_format,
+    storage_backend,
+    data_processor=None,
+):
+    """
+    Create a report of stacks that didn't raise an exception and return its location.
+
+    See get_stack_data.
+    """
+    stack_data = get_stack_data(stacks, report_type, message)
+    if data_processor:
+        stack_data = data_processor(stack_data)
+
+    return store_exception_data(stack_data, output_format, storage_backend)
+
+
+def store_exception_data(
+    exception_data, output_format, storage_backend, render_pool=None
+):
+    """
+    Render exception_data in output_format, write it to storage_backend and return its location.
+    """
+    if output_format not in REPORT_EXTENSIONS:
         raise TypeError("Exception report format not correctly specified")
 
-    filename = gen_error_filename(extension=output_format)
+    if getattr(storage_backend, "content_addressed", False):
+        return _store_content_addressed(
+            exception_data, output_format, storage_backend, render_pool
+        )
 
+    filename = gen_error_filename(extension=REPORT_EXTENSIONS[output_format])
+    text = render_report(
+        exception_data, output_format, storage_backend, filename, render_pool
+    )
     report_location = storage_backend.write(filename, text)
+    if getattr(storage_backend, "index", False):
+        index_report(exception_data, storage_backend, filename)
 
     return report_location
 
 
+def render_report(
+    exception_data, output_format, storage_backend, filename, render_pool=None
+):
+    """Render exception_data for storage as filename, applying the shared storage options of storage_backend."""
+    if getattr(storage_backend, "shared_environment", False):
+        share_environment(exception_data, storage_backend)
+
+    if output_format == "html":
+        asset_urls = None
+        if getattr(storage_backend, "shared_assets", False):
+            asset_urls = share_assets(storage_backend, filename)
+        if render_pool is not None:
+            return render_pool.render_html(exception_data, asset_urls=asset_urls)
+        return render_exception_html(exception_data, asset_urls=asset_urls)
+
+    if getattr(storage_backend, "shared_snippets", False):
+        share_snippets(exception_data, storage_backend)
+    if output_format == "binary":
+        from exception_reports.binary import encode_binary_report
+
+        return encode_binary_report(exception_data)
+    return render_exception_json(exception_data)
+
+
+def _store_content_addressed(
+    exception_data, output_format, storage_backend, render_pool=None
+):
+    """
+    Store the report under a hash of its content. Repeats of a stored report are only recorded as occurrences.
+    """
+    filename = (
+        f"{report_content_hash(exception_data)}.{REPORT_EXTENSIONS[output_format]}"
+    )
+    report_location = storage_backend.stored_location(filename)
+    if report_location is None:
+        text = render_report(
+            exception_data, output_format, storage_backend, filename, render_pool
+        )
+        report_location = storage_backend.write_once(filename, text)
+    storage_backend.record_occurrence(filename, exception_data.get("server_time"))
+    if getattr(storage_backend, "index", False):
+        index_report(exception_data, storage_backend, filename)
+    return report_location
+
+
+_MEMORY_ADDRESS_RE = re.compile(r" at 0x[0-9a-fA-F]+")
+
+
+def report_content_hash(exception_data):
+    """
+    Return a hash of the report content that ignores volatile fields.
+
+    The server time, process resources, frame ids, the environment fields (represented by their hash) and memory
+    addresses in object reprs are left out, so repeats of the same error in the same environment hash identically.
+    """
+    normalized = {
+        k: v
+        for k, v in exception_data.items()
+        if k not in ENVIRONMENT_KEYS and k not in VOLATILE_KEYS
+    }
+    normalized["frames"] = [
+        {k: v for k, v in frame.items() if k not in ("id", "tb")}
+        for frame in exception_data.get("frames") or []
+    ]
+    normalized_json = json.dumps(normalized, default=_json_serializer, sort_keys=True)
+    normalized_json = _MEMORY_ADDRESS_RE.sub("", normalized_json)
+    return hashlib.sha1(normalized_json.encode("utf8", "surrogateescape")).hexdigest()
+
+
+def share_environment(exception_data, storage_backend):
+    """
+    Move the environment fields of exception_data into a content-addressed object stored once per process.
+
+    The report gets an "environment" entry with the location of the stored object, and "environment_hash" of the
+    fields as they are after any data processor. If the object can't be stored the environment stays in the report.
+    """
+    if "environment_hash" not in exception_data or "sys_path" not in exception_data:
+        return
+
+    environment_hash = _environment_hash(exception_data)
+    exception_data["environment_hash"] = environment_hash
+
+    environment = {k: exception_data[k] for k in ENVIRONMENT_KEYS if k in exception_data}
+    environment["environment_hash"] = environment_hash
+    location = storage_backend.write_once(
+        f"environment/{environment_hash}.json", render_exception_json(environment)
+    )
+    if location is None:
+        return
+
+    for k in ENVIRONMENT_KEYS:
+        exception_data.pop(k, None)
+    exception_data["environment"] = location
+
+
+def share_assets(storage_backend, report_filename):
+    """
+    Store the versioned css and javascript assets once and return links to them relative to report_filename.
+
+    Returns None when the assets couldn't be stored, in which case they should be inlined in the report.
+    """
+    asset_urls = {}
+    for asset_filename, text in report_asset_files().items():
+        if storage_backend.write_once(asset_filename, text) is None:
+            return None
+        extension = asset_filename.rsplit(".", 1)[-1]
+        asset_urls[extension] = storage_backend.relative_link(asset_filename, report_filename)
+    return asset_urls
+
+
+def _report_frames(exception_data):
+    frames = list(exception_data.get("frames") or [])
+    lastframe = exception_data.get("lastframe")
+    if lastframe is not None and not any(lastframe is frame for frame in frames):
+        frames.append(lastframe)
+    return frames
+
+
+def share_snippets(exception_data, storage_backend):
+    """
+    Move the source context of each frame into content-addressed snippets stored once per storage backend.
+
+    Frames keep a "snippet" entry with the hash of their source context. Use `resolve_snippets` to restore them.
+    """
+    for frame in _report_frames(exception_data):
+        if "context_line" not in frame:
+            continue
+        snippet = {k: frame[k] for k in SNIPPET_KEYS}
+        snippet_json = json.dumps(snippet, sort_keys=True)
+        snippet_hash = hashlib.sha1(
+            snippet_json.encode("utf8", "surrogateescape")
+        ).hexdigest()
+        if storage_backend.write_once(f"snippets/{snippet_hash}.json", snippet_json):
+            for k in SNIPPET_KEYS:
+                del frame[k]
+            frame["snippet"] = snippet_hash
+
+
+def resolve_snippets(exception_data, storage_backend):
+    """
+    Restore the source context of frames that reference snippets stored in storage_backend.
+
+    Frames keep their "snippet" entry when storage_backend can't read the snippet.
+    """
+    snippets = {}
+    for frame in _report_frames(exception_data):
+        snippet_hash = frame.get("snippet")
+        if snippet_hash is None:
+            continue
+        if snippet_hash not in snippets:
+            snippet_json = storage_backend.read(f"snippets/{snippet_hash}.json")
+            snippets[snippet_hash] = (
+                None
+                if snippet_json is None
+                else json.loads(snippet_json.decode("utf8", "surrogateescape"))
+            )
+        if snippets[snippet_hash] is not None:
+            del frame["snippet"]
+            frame.update(snippets[snippet_hash])
+    return exception_data
+
+
+@functools.lru_cache()
+def _index_template():
+    with open(TEMPLATE_DIR / "index_template.html", "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _index_header(title, columns):
+    return (
+        _index_template()
+        .replace("__TITLE__", escape(title))
+        .replace("__COLUMNS__", json.dumps(list(columns)))
+    )
+
+
+def _index_row(values, link):
+    # "<" is escaped so a row can't end the script element the rows are appended to
+    return json.dumps([*values, link]).replace("<", "\\u003c") + "\n"
+
+
+def index_report(exception_data, storage_backend, filename):
+    """
+    Append a row for the report stored as filename to the index page of its day, `index/<yyyy-mm-dd>.html`.
+
+    Rows are appended to the pages as json lines that the page javascript filters and paginates, so pages are
+    never rebuilt. `index.html` links to the page of each day. Index write errors are logged, not raised. Reports
+    aren't indexed when storage_backend doesn't support appending.
+    """
+    if not storage_backend.supports_append:
+        return
+    server_time = exception_data.get("server_time")
+    if isinstance(server_time, str):
+        with suppress(ValueError):
+            server_time = datetime.fromisoformat(server_time)
+    if not isinstance(server_time, datetime):
+        server_time = datetime.now(timezone.utc)
+    day = server_time.date().isoformat()
+    page = f"index/{day}.html"
+
+    location = None
+    lastframe = exception_data.get("lastframe")
+    if lastframe:
+        location = (
+            f"{lastframe.get('filename')}:{lastframe.get('lineno')}"
+            f" in {lastframe.get('function')}"
+        )
+    row = _index_row(
+        (
+            server_time.strftime("%Y-%m-%d %H:%M:%S"),
+            exception_data.get("exception_type"),
+            str(exception_data.get("exception_value") or "")[:INDEX_MESSAGE_LENGTH],
+            location,
+        ),
+        storage_backend.relative_link(filename, page),
+    )
+
+    try:
+        created = storage_backend.append(
+            page, row, header=_index_header(f"Exception reports {day}", INDEX_COLUMNS)
+        )
+        if created:
+            storage_backend.append(
+                "index.html",
+                _index_row((day,), storage_backend.relative_link(page, "index.html")),
+                header=_index_header("Exception reports", ("day",)),
+            )
+    except OSError:
+        logger.warning(
+            "Couldn't add exception report %s to the index", filename, exc_info=True
+        )
+
+
 def append_to_exception_message(e, tb, added_message):
+    """
+    Add added_message to the message of exception e and return the exception to raise.
+
+    On python 3.11+ the message is added as a note. Before that, builtin exceptions are replaced by a new
+    exception with the longer message, and other exceptions get the class of a cached subclass of their type
+    that adds the message to str().
+    """
+    if hasattr(e, "add_note"):
+        e.add_note(added_message)
+        return e
+
     ExceptionType = type(e)
 
     if ExceptionType.__module__ == "builtins":
         # this way of altering the message isn't as good but it works for builtin exception types
-        e = ExceptionType(f"{str(e)} {added_message}").with_traceback(tb)
-    else:
+        return ExceptionType(f"{str(e)} {added_message}").with_traceback(tb)
 
-        def my_str(self):
-            m = ExceptionType.__str__(self)  # noqa
-            return f"{m} {added_message}"
+    return _append_to_str(e, added_message)
 
-        NewExceptionType = type(
-            ExceptionType.__name__, (ExceptionType,), {"__str__": my_str}
-        )
 
-        e.__class__ = NewExceptionType
+def _append_to_str(e, added_message):
+    e.__dict__.setdefault("_exception_report_messages", []).append(added_message)
+    if not getattr(type(e), "_exception_report_annotated", False):
+        e.__class__ = _annotated_exception_type(type(e))
     return e
+
+
+@functools.lru_cache(maxsize=1024)
+def _annotated_exception_type(exception_type):
+    """Return a subclass of exception_type whose str() ends with the messages added to the instance."""
+
+    def __str__(self):  # noqa: N807
+        message = exception_type.__str__(self)
+        return " ".join((message, *self.__dict__.get("_exception_report_messages", ())))
+
+    return type(
+        exception_type.__name__,
+        (exception_type,),
+        {
+            "__str__": __str__,
+            "__module__": exception_type.__module__,
+            "__qualname__": exception_type.__qualname__,
+            "_exception_report_annotated": True,
+        },
+    )
@@ -2,31 +2,199 @@ import hmac
 import logging
 import os
 import os.path
+import posixpath
+import struct
+import threading
+import time
+import zlib
 from base64 import b64encode
+from collections import OrderedDict, namedtuple
+from contextlib import suppress
 from datetime import datetime
-from http.client import HTTPSConnection
-from wsgiref.handlers import format_date_time
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+CONTENT_TYPES = {
+    "html": "text/html",
+    "css": "text/css",
+    "js": "application/javascript",
+    "erb": "application/octet-stream",
+}
+
 
 class S3UploadError(Exception):
     pass
 
 
+class S3DownloadError(Exception):
+    pass
+
+
 class ErrorStorage:
+    prefix = ""
+    # store the process environment once as a content-addressed object that reports reference by hash
+    shared_environment = False
+    # store the html report css and javascript once as versioned assets that reports link to
+    shared_assets = False
+    # store the source context of json report frames once as content-addressed snippets
+    shared_snippets = False
+    # name reports by a hash of their content so repeats of the same report are only stored once
+    content_addressed = False
+    # append a row for each report to daily html index pages, needs a storage that supports append
+    index = False
+    # whether the storage implements append(filename, data, header), which returns whether it created the file
+    supports_append = False
+    # how many filenames stored_location remembers the location of
+    max_cached_locations = 4096
+
     def write(self, filename, data):
         pass
 
+    def read(self, filename):
+        """Return the bytes stored under filename, or None if there are none or the storage can't read them back."""
+        return None
+
+    def relative_link(self, filename, from_filename):
+        """Return a link to the stored filename that works from the page stored as from_filename."""
+        from_dir = posixpath.dirname(self.prefix + from_filename) or "."
+        return posixpath.relpath(self.prefix + filename, from_dir)
+
+    def exists(self, filename):
+        """Return whether filename is already stored."""
+        return False
+
+    def location(self, filename):
+        """Return the location a write of filename is stored at."""
+        return None
+
+    def stored_location(self, filename):
+        """
+        Return the location of filename if it's already stored, otherwise None.
+
+        Lookups are cached per storage backend, for the max_cached_locations most recently used filenames.
+        """
+        stored_locations = self._stored_locations()
+        try:
+            stored_locations.move_to_end(filename)
+            return stored_locations[filename]
+        except KeyError:
+            pass
+        location = self.location(filename) if self.exists(filename) else None
+        self._cache_location(filename, location)
+        return location
+
+    def _stored_locations(self):
+        stored_locations = self.__dict__.get("_stored_location_cache")
+        if stored_locations is None:
+            stored_locations = self.__dict__.setdefault(
+                "_stored_location_cache", OrderedDict()
+            )
+        return stored_locations
+
+    def _cache_location(self, filename, location):
+        stored_locations = self._stored_locations()
+        stored_locations[filename] = location
+        while len(stored_locations) > self.max_cached_locations:
+            with suppress(KeyError):
+                stored_locations.popitem(last=False)
+
+    def _forget_location(self, filename):
+        """Drop the cached location of filename, e.g. when the storage deletes it."""
+        self._stored_locations().pop(filename, None)
+
+    def write_once(self, filename, data):
+        """
+        Write content-addressed data that only needs to be stored once.
+
+        Returns the location of the stored data without writing it again when the filename is already stored.
+        """
+        location = self.stored_location(filename)
+        if location is None:
+            location = self.write(filename, data)  # noqa: E1111
+            self._cache_location(filename, location)
+        return location
+
+    def record_occurrence(self, filename, timestamp):
+        """Record another occurrence of the content-addressed report stored as filename."""
+        from exception_reports.utils import gen_error_filename
+
+        self.write(f"occurrences/{filename}/{gen_error_filename('txt')}", str(timestamp))
+
 
 class LocalErrorStorage(ErrorStorage):
-    def __init__(self, output_path="/tmp/python-error-reports/", prefix=""):
+    supports_append = True
+
+    def __init__(
+        self,
+        output_path="/tmp/python-error-reports/",
+        prefix="",
+        shared_environment=False,
+        shared_assets=False,
+        shared_snippets=False,
+        content_addressed=False,
+        index=False,
+    ):
         self.output_path = output_path
         self.prefix = prefix
+        self.shared_environment = shared_environment
+        self.shared_assets = shared_assets
+        self.shared_snippets = shared_snippets
+        self.content_addressed = content_addressed
+        self.index = index
+
+    def _filepath(self, filename):
+        return os.path.abspath(
+            os.path.join(str(self.output_path), self.prefix + filename)
+        )
+
+    def read(self, filename):
+        try:
+            with open(self._filepath(filename), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, filename):
+        return os.path.exists(self._filepath(filename))
+
+    def location(self, filename):
+        return self._filepath(filename)
+
+    def record_occurrence(self, filename, timestamp):
+        filepath = self._filepath(f"occurrences/{filename}.log")
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "a", encoding="utf-8") as f:
+            f.write(f"{timestamp}\n")
+
+    def append(self, filename, data, header=""):
+        """Append data to filename and return whether this call created it. A new file starts with header."""
+        filepath = self._filepath(filename)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        data = data.encode("utf8", "surrogateescape")
+        if not os.path.exists(filepath):
+            # the new file is linked into place with its header, so concurrent writers never append to a file
+            # that doesn't have its header yet, and only one of them creates it
+            temp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(header.encode("utf8", "surrogateescape") + data)
+            try:
+                os.link(temp_path, filepath)
+                return True
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_path)
+        with open(filepath, "ab") as f:
+            f.write(data)
+        return False
 
     def write(self, filename, data):
-        output_path = str(self.output_path)
-        filepath = os.path.abspath(os.path.join(output_path, self.prefix + filename))
+        filepath = self._filepath(filename)
 
         # make directory if it doesn't exist
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
@@ -41,6 +209,10 @@ class LocalErrorStorage(ErrorStorage):
 
 
 class S3ErrorStorage(ErrorStorage):
+    # seconds occurrences of content-addressed reports are collected for before they're written in the background,
+    # as one object per report
+    occurrence_flush_seconds = 10
+
     def __init__(
         self,
         bucket,
@@ -48,10 +220,20 @@ class S3ErrorStorage(ErrorStorage):
         secret_key: str = None,
         region: str = None,
         prefix: str = "",
+        shared_environment: bool = False,
+        shared_assets: bool = False,
+        shared_snippets: bool = False,
+        content_addressed: bool = False,
+        timeout: float = 30,
     ):
         self.bucket = bucket
         self.prefix = prefix
         self.region = region
+        self.timeout = timeout
+        self.shared_environment = shared_environment
+        self.shared_assets = shared_assets
+        self.shared_snippets = shared_snippets
+        self.content_addressed = content_addressed
 
         s3_resource_kwargs = {}
         if access_key is not None:
@@ -62,6 +244,10 @@ class S3ErrorStorage(ErrorStorage):
             s3_resource_kwargs["region_name"] = region
 
         self._s3_resource_kwargs = s3_resource_kwargs
+        self._occurrences = {}
+        self._occurrence_lock = threading.Lock()
+        self._occurrence_thread = None
+        self._flush_at_exit = False
 
     def write(self, filename, data):  # noqa
         try:
@@ -69,11 +255,7 @@ class S3ErrorStorage(ErrorStorage):
                 data = data.encode("utf8")
 
             key = f"/{self.prefix}{filename}"
-
-            if key.endswith("html"):
-                content_type = "text/html"
-            else:
-                content_type = "text/plain"
+            content_type = CONTENT_TYPES.get(key.rsplit(".", 1)[-1], "text/plain")
 
             response, uploaded_url = upload_to_s3(
                 aws_key=self._s3_resource_kwargs["aws_access_key_id"],
@@ -82,6 +264,7 @@ class S3ErrorStorage(ErrorStorage):
                 filename=key,
                 contents=data,
                 content_type=content_type,
+                timeout=self.timeout,
             )
             if response.code != 200:
                 raise S3UploadError("Upload of exception report to S3 failed")
@@ -91,18 +274,1105 @@ class S3ErrorStorage(ErrorStorage):
         except Exception:  # noqa
             logger.warning("Error saving exception to s3", exc_info=True)
 
+    def exists(self, filename):
+        try:
+            response, _ = _s3_request(
+                "HEAD",
+                aws_key=self._s3_resource_kwargs["aws_access_key_id"],
+                aws_secret=self._s3_resource_kwargs["aws_secret_access_key"],
+                bucket=self.bucket,
+                filename=f"/{self.prefix}{filename}",
+                timeout=self.timeout,
+            )
+            return response.status == 200
+        except Exception:  # noqa
+            logger.warning("Error checking for exception report in s3", exc_info=True)
+            return False
+
+    def location(self, filename):
+        return f"https://{self.bucket}.s3.amazonaws.com/{self.prefix}{filename}"
+
+    def record_occurrence(self, filename, timestamp):
+        """Buffer the occurrence, it's written with the others of the same report by a background thread."""
+        import atexit
+
+        with self._occurrence_lock:
+            self._occurrences.setdefault(filename, []).append(str(timestamp))
+            if self._occurrence_thread is None:
+                if not self._flush_at_exit:
+                    # occurrences still buffered when the process exits
+                    atexit.register(self.flush_occurrences)
+                    self._flush_at_exit = True
+                self._occurrence_thread = threading.Thread(
+                    target=self._flush_occurrences_later,
+                    name="exception-reports-occurrences",
+                    daemon=True,
+                )
+                self._occurrence_thread.start()
+
+    def flush_occurrences(self):
+        """Write the buffered occurrences now, as an object per report with a timestamp per line."""
+        from exception_reports.utils import gen_error_filename
+
+        with self._occurrence_lock:
+            occurrences, self._occurrences = self._occurrences, {}
+        for filename, timestamps in occurrences.items():
+            self.write(
+                f"occurrences/{filename}/{gen_error_filename('txt')}", "\n".join(timestamps)
+            )
+
+    def _flush_occurrences_later(self):
+        time.sleep(self.occurrence_flush_seconds)
+        with self._occurrence_lock:
+            self._occurrence_thread = None
+        self.flush_occurrences()
+
+    def read(self, filename):
+        response, _ = download_from_s3(
+            aws_key=self._s3_resource_kwargs["aws_access_key_id"],
+            aws_secret=self._s3_resource_kwargs["aws_secret_access_key"],
+            bucket=self.bucket,
+            filename=f"/{self.prefix}{filename}",
+            timeout=self.timeout,
+        )
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise S3DownloadError(f"Download of {filename} from S3 failed")
+        return response.read()
+
+
+class OutboxErrorStorage(ErrorStorage):
+    """
+    Spools reports to a local outbox directory and uploads them to another backend from a background thread.
+
+    write() only writes the report to local disk and returns the location the report will have in the backend
+    once uploaded, so the backend must implement `location` (like S3ErrorStorage). Failed uploads are retried
+    with exponential backoff, reports that haven't failed yet go first. A report that keeps failing while other
+    uploads succeed is moved to the `failed` subdirectory after max_attempts tries.
+
+    Several processes can share an outbox: a report is claimed by renaming it before it's uploaded. Reports left
+    in the outbox by an earlier process are uploaded when the outbox is created, along with the reports it had
+    claimed. When the outbox grows past max_outbox_bytes or max_outbox_files the oldest reports are dropped.
+
+    Usage:
+
+        storage_backend = OutboxErrorStorage(S3ErrorStorage(bucket='MY_BUCKET', ...))
+    """
+
+    # reports that fail this many times while other uploads succeed are moved aside
+    max_attempts = 5
+    # partial spool files older than this many seconds were left by a crash
+    stale_spool_seconds = 3600
+
+    def __init__(
+        self,
+        backend,
+        outbox_path="/tmp/python-error-reports/outbox/",
+        max_outbox_bytes=100 * 1024 * 1024,
+        max_outbox_files=10000,
+        initial_retry_delay=1,
+        max_retry_delay=300,
+    ):
+        self.backend = backend
+        self.outbox_path = str(outbox_path)
+        self.max_outbox_bytes = max_outbox_bytes
+        self.max_outbox_files = max_outbox_files
+        self.initial_retry_delay = initial_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.prefix = getattr(backend, "prefix", "")
+
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._failures = {}
+        self._strikes = {}
+
+        os.makedirs(self.outbox_path, exist_ok=True)
+        self._recover()
+        self._bytes, self._count = self._outbox_size()[:2]
+        if self._pending():
+            self._start()
+
+    def location(self, filename):
+        return self.backend.location(filename)
+
+    def write(self, filename, data):
+        from urllib.parse import quote
+
+        if isinstance(data, str):
+            data = data.encode("utf8", "surrogateescape")
+
+        spool_name = f"{time.time_ns()}_{quote(filename, safe='')}"
+        spool_path = os.path.join(self.outbox_path, spool_name)
+        with open(spool_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(spool_path + ".tmp", spool_path)
+
+        with self._lock:
+            self._bytes += len(data)
+            self._count += 1
+            full = (
+                self._bytes > self.max_outbox_bytes
+                or self._count > self.max_outbox_files
+            )
+        if full:
+            self._trim()
+        self._start()
+        with self._lock:
+            self._idle.clear()
+            self._wakeup.set()
+        return self.backend.location(filename)
+
+    def flush(self, timeout=None):
+        """Wait until the outbox is empty, or a retry is pending. Returns whether the outbox is empty."""
+        self._idle.wait(timeout)
+        # reports being uploaded are claimed, but not uploaded yet
+        return not any(
+            name != "failed" and not name.endswith(".tmp")
+            for name in os.listdir(self.outbox_path)
+        )
+
+    def _pending(self):
+        return sorted(
+            name
+            for name in os.listdir(self.outbox_path)
+            if not name.endswith((".tmp", ".claimed")) and name != "failed"
+        )
+
+    def _recover(self):
+        """Remove partial spool files left by a crash and release the reports claimed by processes that exited."""
+        now = time.time()
+        for name in os.listdir(self.outbox_path):
+            path = os.path.join(self.outbox_path, name)
+            if name.endswith(".tmp"):
+                with suppress(OSError):
+                    if now - os.path.getmtime(path) > self.stale_spool_seconds:
+                        os.remove(path)
+            elif name.endswith(".claimed"):
+                spool_name, _, pid = name[: -len(".claimed")].rpartition(".")
+                if pid.isdigit() and not _process_exists(int(pid)):
+                    with suppress(OSError):
+                        os.rename(path, os.path.join(self.outbox_path, spool_name))
+
+    def _outbox_size(self):
+        """Return the total size and number of spooled reports, and the sizes of the unclaimed ones."""
+        total = count = 0
+        sizes = {}
+        for name in os.listdir(self.outbox_path):
+            if name.endswith(".tmp") or name == "failed":
+                continue
+            with suppress(OSError):
+                size = os.path.getsize(os.path.join(self.outbox_path, name))
+                total += size
+                count += 1
+                if not name.endswith(".claimed"):
+                    sizes[name] = size
+        return total, count, sizes
+
+    def _trim(self):
+        with self._lock:
+            total, count, sizes = self._outbox_size()
+            for name in sorted(sizes):
+                if total <= self.max_outbox_bytes and count <= self.max_outbox_files:
+                    break
+                logger.warning(f"Exception report outbox is full, dropping {name}")
+                with suppress(OSError):
+                    os.remove(os.path.join(self.outbox_path, name))
+                    total -= sizes[name]
+                    count -= 1
+            self._bytes, self._count = total, count
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="exception-reports-outbox", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        retry_delay = self.initial_retry_delay
+        last_ok = False
+        while True:
+            self._wakeup.clear()
+            pending = self._pending()
+            self._failures = {n: c for n, c in self._failures.items() if n in pending}
+            self._strikes = {n: c for n, c in self._strikes.items() if n in pending}
+            pending.sort(key=lambda name: self._failures.get(name, 0))
+            for name in pending:
+                uploaded = self._upload(name)
+                if uploaded is None:
+                    # dropped because the outbox was full, or claimed by another process
+                    continue
+                if uploaded:
+                    retry_delay = self.initial_retry_delay
+                    last_ok = True
+                    continue
+
+                self._failures[name] = self._failures.get(name, 0) + 1
+                if last_ok:
+                    self._strikes[name] = self._strikes.get(name, 0) + 1
+                last_ok = False
+                if self._strikes.get(name, 0) >= self.max_attempts:
+                    self._move_aside(name)
+                    continue
+                logger.warning(
+                    f"Upload of exception report {name} failed, retrying in {retry_delay}s"
+                )
+                self._idle.set()
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.max_retry_delay)
+                break
+            else:
+                with self._lock:
+                    if not self._wakeup.is_set():
+                        self._idle.set()
+                self._wakeup.wait()
+
+    def _upload(self, name):
+        """Claim and upload a spooled report. Returns None if the report is gone."""
+        from urllib.parse import unquote
+
+        spool_path = os.path.join(self.outbox_path, name)
+        claimed_path = f"{spool_path}.{os.getpid()}.claimed"
+        try:
+            os.rename(spool_path, claimed_path)
+            with open(claimed_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        filename = unquote(name.split("_", 1)[1])
+        if self.backend.write(filename, data) is None:
+            with suppress(OSError):
+                os.rename(claimed_path, spool_path)
+            return False
+
+        with suppress(OSError):
+            os.remove(claimed_path)
+        with self._lock:
+            self._bytes -= len(data)
+            self._count -= 1
+        return True
+
+    def _move_aside(self, name):
+        failed_dir = os.path.join(self.outbox_path, "failed")
+        logger.error(
+            f"Upload of exception report {name} failed {self.max_attempts} times, moving it to {failed_dir}"
+        )
+        os.makedirs(failed_dir, exist_ok=True)
+        with suppress(OSError):
+            size = os.path.getsize(os.path.join(self.outbox_path, name))
+            os.rename(
+                os.path.join(self.outbox_path, name), os.path.join(failed_dir, name)
+            )
+            with self._lock:
+                self._bytes -= size
+                self._count -= 1
+        self._failures.pop(name, None)
+        self._strikes.pop(name, None)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError):
+        pass
+    return True
+
+
+class SegmentCorruptError(Exception):
+    pass
+
+
+class SegmentLockedError(Exception):
+    pass
+
+
+# record header: magic, data length, crc32 of name and data, name length
+_SEGMENT_RECORD = struct.Struct("<4sIIH")
+_SEGMENT_MAGIC = b"ERR1"
+# index entry: record offset, name length
+_SEGMENT_INDEX_ENTRY = struct.Struct("<QH")
+
+
+class SegmentErrorStorage(ErrorStorage):
+    """
+    Appends reports to rolling segment files instead of writing a file per report.
+
+    Each record is a length-prefixed, checksummed (name, report) pair. Every segment has an index of the offset of
+    each record that is loaded on start, so finding a report doesn't scan the segments. Reads go through
+    memory-mapped segments. Locations are `<segment path>:<offset>`, use `read_segment_record` or
+    `extract_segment_report` to get a report back from a location.
+
+    A record torn by a crash is truncated from the end of the last segment when the storage is opened.
+
+    Only one process can write to a directory at a time: the storage takes an exclusive lock on the directory's
+    `.lock` file (where fcntl is available) until close(), and raises SegmentLockedError if another process holds
+    it. Give each process its own output_path. Reading segments with `read_segment_record`, `iter_segment_records`
+    or the aggregate command doesn't need the lock.
+
+    Only the names in the newest max_indexed_segments segments are kept in memory. exists() doesn't find older
+    reports, so a content-addressed report is stored again once its segment drops out of the index; read() and
+    location() look them up in the older segments' index files.
+    """
+
+    def __init__(
+        self,
+        output_path="/tmp/python-error-reports/segments/",
+        segment_bytes=64 * 1024 * 1024,
+        fsync=False,
+        prefix="",
+        shared_environment=False,
+        shared_snippets=False,
+        content_addressed=False,
+        max_indexed_segments=16,
+    ):
+        self.output_path = str(output_path)
+        self.segment_bytes = segment_bytes
+        self.max_indexed_segments = max_indexed_segments
+        self.fsync = fsync
+        self.prefix = prefix
+        self.shared_environment = shared_environment
+        self.shared_snippets = shared_snippets
+        self.content_addressed = content_addressed
+
+        self._lock = threading.Lock()
+        self._index = {}
+        self._indexed_segments = OrderedDict()
+        self._maps = {}
+        self._segment = None
+        self._segment_file = None
+        self._index_file = None
+        self._lock_file = None
+
+        os.makedirs(self.output_path, exist_ok=True)
+        self._lock_directory()
+        segments = self.segments()
+        for segment in segments[-self.max_indexed_segments : -1]:
+            self._load_index(segment)
+        if segments:
+            self._recover(segments[-1])
+
+    def _lock_directory(self):
+        if fcntl is None:
+            return
+        self._lock_file = open(  # noqa: R1732
+            os.path.join(self.output_path, ".lock"), "ab"
+        )
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise SegmentLockedError(
+                f"{self.output_path} is in use by another process, give each process its own output_path"
+            ) from None
+
+    def segments(self):
+        """Return the paths of the segment files, oldest first."""
+        return [
+            os.path.join(self.output_path, name)
+            for name in sorted(os.listdir(self.output_path))
+            if name.endswith(".seg")
+        ]
+
+    def _load_index(self, segment):
+        index_path = segment[:-4] + ".idx"
+        if not os.path.exists(index_path):
+            self._recover(segment)
+            return
+        for offset, name in _read_segment_index(index_path):
+            self._add_to_index(name, segment, offset)
+
+    def _add_to_index(self, name, segment, offset):
+        self._index[name] = (segment, offset)
+        names = self._indexed_segments.get(segment)
+        if names is None:
+            names = self._indexed_segments[segment] = []
+            while len(self._indexed_segments) > self.max_indexed_segments:
+                self._forget_segment(next(iter(self._indexed_segments)))
+        names.append(name)
+
+    def _forget_segment(self, segment):
+        for name in self._indexed_segments.pop(segment):
+            if self._index.get(name, (None,))[0] == segment:
+                del self._index[name]
+        mapped = self._maps.pop(segment, None)
+        if mapped is not None:
+            mapped.close()
+
+    def _find(self, name):
+        """Return the (segment, offset) of the newest record stored as name, or raise KeyError."""
+        if name in self._index:
+            return self._index[name]
+        for segment in reversed(self.segments()):
+            if segment in self._indexed_segments:
+                continue
+            index_path = segment[:-4] + ".idx"
+            if not os.path.exists(index_path):
+                continue
+            found = None
+            for offset, indexed_name in _read_segment_index(index_path):
+                if indexed_name == name:
+                    found = (segment, offset)
+            if found is not None:
+                return found
+        raise KeyError(name)
+
+    def _recover(self, segment):
+        """Rebuild the index of segment from its records and truncate a torn record at its end."""
+        valid_length = 0
+        index = []
+        for offset, name, data in iter_segment_records(segment, strict=False):
+            index.append((offset, name))
+            valid_length = (
+                offset + _SEGMENT_RECORD.size + len(name.encode("utf8")) + len(data)
+            )
+
+        if valid_length != os.path.getsize(segment):
+            logger.warning(
+                f"Truncating torn record at offset {valid_length} of {segment}"
+            )
+            with open(segment, "r+b") as f:
+                f.truncate(valid_length)
+
+        with open(segment[:-4] + ".idx", "wb") as f:
+            for offset, name in index:
+                self._add_to_index(name, segment, offset)
+                f.write(_index_entry(offset, name))
+
+    def _open_segment(self, record_length):
+        if self._segment is None:
+            segments = self.segments()
+            if segments:
+                self._switch_segment(segments[-1])
+        if self._segment is None:
+            self._switch_segment(os.path.join(self.output_path, f"{1:08d}.seg"))
+        else:
+            size = self._segment_file.tell()
+            if size > 0 and size + record_length > self.segment_bytes:
+                number = int(os.path.basename(self._segment)[:-4]) + 1
+                self._switch_segment(
+                    os.path.join(self.output_path, f"{number:08d}.seg")
+                )
+
+    def _switch_segment(self, segment):
+        self._close_segment()
+        self._segment = segment
+        self._segment_file = open(segment, "ab")  # noqa: R1732
+        self._index_file = open(segment[:-4] + ".idx", "ab")  # noqa: R1732
+
+    def _close_segment(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._index_file.close()
+        self._segment = self._segment_file = self._index_file = None
+
+    def close(self):
+        """Close the open segment and memory maps and release the directory lock."""
+        with self._lock:
+            self._close_segment()
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def write(self, filename, data):
+        if isinstance(data, str):
+            data = data.encode("utf8", "surrogateescape")
+        name = (self.prefix + filename).encode("utf8")
+        crc = zlib.crc32(data, zlib.crc32(name))
+        record = _SEGMENT_RECORD.pack(_SEGMENT_MAGIC, len(data), crc, len(name))
+
+        with self._lock:
+            self._open_segment(len(record) + len(name) + len(data))
+            offset = self._segment_file.tell()
+            self._segment_file.write(record + name + data)
+            self._segment_file.flush()
+            if self.fsync:
+                os.fsync(self._segment_file.fileno())
+            self._index_file.write(_index_entry(offset, self.prefix + filename))
+            self._index_file.flush()
+            self._add_to_index(self.prefix + filename, self._segment, offset)
+            return f"{self._segment}:{offset}"
+
+    def exists(self, filename):
+        return self.prefix + filename in self._index
+
+    def location(self, filename):
+        with self._lock:
+            segment, offset = self._find(self.prefix + filename)
+        return f"{segment}:{offset}"
+
+    def read(self, filename):
+        with self._lock:
+            try:
+                segment, offset = self._find(self.prefix + filename)
+            except KeyError:
+                return None
+            return self._read_record(segment, offset)[1]
+
+    def _read_record(self, segment, offset):
+        """Return the (name, data) of a record. Called with self._lock held, writes close and replace the maps."""
+        if segment not in self._indexed_segments:
+            # only the indexed segments stay mapped
+            mapped = _map_segment(segment)
+            try:
+                return _unpack_record(mapped, offset, segment)
+            finally:
+                mapped.close()
+        mapped = self._maps.get(segment)
+        if mapped is not None:
+            with suppress(SegmentCorruptError):
+                return _unpack_record(mapped, offset, segment)
+        # map the segment again, the record may have been appended after it was mapped
+        if mapped is not None:
+            mapped.close()
+        mapped = self._maps[segment] = _map_segment(segment)
+        return _unpack_record(mapped, offset, segment)
+
+    def extract(self, filename, output_path):
+        """Write a stored report to its own file at output_path and return the path."""
+        data = self.read(filename)
+        if data is None:
+            raise KeyError(filename)
+        with open(output_path, "wb") as f:
+            f.write(data)
+        return output_path
+
+
+def _index_entry(offset, name):
+    name = name.encode("utf8")
+    return _SEGMENT_INDEX_ENTRY.pack(offset, len(name)) + name
+
+
+def _read_segment_index(index_path):
+    """Yield the (offset, name) entries of a segment index file."""
+    with open(index_path, "rb") as f:
+        index = f.read()
+    position = 0
+    while position + _SEGMENT_INDEX_ENTRY.size <= len(index):
+        offset, name_length = _SEGMENT_INDEX_ENTRY.unpack_from(index, position)
+        position += _SEGMENT_INDEX_ENTRY.size
+        name = index[position : position + name_length].decode("utf8")
+        position += name_length
+        yield offset, name
+
+
+def _map_segment(segment):
+    import mmap
+
+    with open(segment, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _unpack_record(buffer, offset, segment=""):
+    """Return the (name, data) of the record at offset, raising SegmentCorruptError if it's torn or corrupt."""
+    if offset + _SEGMENT_RECORD.size > len(buffer):
+        raise SegmentCorruptError(f"Truncated record header at {segment}:{offset}")
+    magic, data_length, crc, name_length = _SEGMENT_RECORD.unpack_from(buffer, offset)
+    start = offset + _SEGMENT_RECORD.size
+    end = start + name_length + data_length
+    if magic != _SEGMENT_MAGIC or end > len(buffer):
+        raise SegmentCorruptError(f"Torn record at {segment}:{offset}")
+    name = buffer[start : start + name_length]
+    data = buffer[start + name_length : end]
+    if zlib.crc32(data, zlib.crc32(name)) != crc:
+        raise SegmentCorruptError(f"Checksum mismatch for record at {segment}:{offset}")
+    return name.decode("utf8"), data
+
+
+def iter_segment_records(segment, strict=True):
+    """
+    Yield (offset, name, data) for each record of a segment file.
+
+    With strict=False iteration stops quietly at the first torn or corrupt record instead of raising.
+    """
+    if os.path.getsize(segment) == 0:
+        return
+    mapped = _map_segment(segment)
+    try:
+        offset = 0
+        while offset < len(mapped):
+            try:
+                name, data = _unpack_record(mapped, offset, segment)
+            except SegmentCorruptError:
+                if strict:
+                    raise
+                return
+            yield offset, name, data
+            offset += _SEGMENT_RECORD.size + len(name.encode("utf8")) + len(data)
+    finally:
+        mapped.close()
+
+
+def read_segment_record(location):
+    """Return the report stored at a `<segment path>:<offset>` location."""
+    segment, offset = location.rsplit(":", 1)
+    mapped = _map_segment(segment)
+    try:
+        return _unpack_record(mapped, int(offset), segment)[1]
+    finally:
+        mapped.close()
+
+
+def extract_segment_report(location, output_path):
+    """Write the report stored at a `<segment path>:<offset>` location to its own html/json file."""
+    with open(output_path, "wb") as f:
+        f.write(read_segment_record(location))
+    return output_path
+
+
+class MemoryErrorStorage(ErrorStorage):
+    """
+    Keeps the most recent reports zlib-compressed in memory, for hosts without a useful disk.
+
+    The oldest reports are dropped once there are more than max_reports or they take more than max_bytes. The
+    shared assets and environments that reports link to are kept. `serve()` starts an http server on localhost
+    that lists and serves the reports. Once it's started, report locations are urls on that server, otherwise they
+    are `memory:<filename>`.
+
+    Usage:
+
+        storage_backend = MemoryErrorStorage(max_reports=100)
+        storage_backend.serve(port=8765)
+    """
+
+    def __init__(
+        self,
+        max_reports=100,
+        max_bytes=16 * 1024 * 1024,
+        prefix="",
+        shared_environment=False,
+        shared_assets=False,
+        shared_snippets=False,
+    ):
+        self.max_reports = max_reports
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.shared_environment = shared_environment
+        self.shared_assets = shared_assets
+        self.shared_snippets = shared_snippets
+        self.url = None
+
+        self._reports = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def write(self, filename, data):
+        if isinstance(data, str):
+            data = data.encode("utf8", "surrogateescape")
+        key = self.prefix + filename
+        compressed = zlib.compress(data, 6)
+
+        with self._lock:
+            if key in self._reports:
+                self._size -= len(self._reports.pop(key)[1])
+            self._reports[key] = (time.time(), compressed, len(data))
+            self._size += len(compressed)
+            pinned = (self.prefix + "assets/", self.prefix + "environment/")
+            while len(self._reports) > self.max_reports or self._size > self.max_bytes:
+                dropped = next(
+                    (k for k in self._reports if not k.startswith(pinned)), None
+                )
+                if dropped is None:
+                    break
+                self._size -= len(self._reports.pop(dropped)[1])
+                # so write_once stores a dropped snippet again
+                self._forget_location(dropped[len(self.prefix) :])
+        return self.location(filename)
+
+    def read(self, filename):
+        with self._lock:
+            entry = self._reports.get(self.prefix + filename)
+        if entry is None:
+            return None
+        return zlib.decompress(entry[1])
+
+    def exists(self, filename):
+        return self.prefix + filename in self._reports
+
+    def location(self, filename):
+        from urllib.parse import quote
+
+        if self.url is None:
+            return f"memory:{self.prefix}{filename}"
+        return f"{self.url}{quote(self.prefix + filename)}"
+
+    def reports(self):
+        """Return (filename, stored time, size) for each stored report, newest first."""
+        with self._lock:
+            return [
+                (filename, stored_at, size)
+                for filename, (stored_at, _, size) in reversed(self._reports.items())
+            ]
+
+    def serve(self, port=0):
+        """Serve the reports on http://127.0.0.1:<port>/ from a background thread and return the url."""
+        from http.server import ThreadingHTTPServer
+
+        if self._server is None:
+            self._server = ThreadingHTTPServer(
+                ("127.0.0.1", port), _memory_storage_handler(self)
+            )
+            threading.Thread(
+                target=self._server.serve_forever,
+                name="exception-reports-server",
+                daemon=True,
+            ).start()
+            self.url = f"http://127.0.0.1:{self._server.server_address[1]}/"
+        return self.url
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self.url = None
+
+
+def _memory_storage_handler(storage):
+    from html import escape
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import quote, unquote
+
+    class MemoryStorageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # noqa: N802
+            # a page on another site can resolve its own host name to 127.0.0.1 (dns rebinding)
+            host, port = self.server.server_address[:2]
+            if self.headers.get("Host") != f"{host}:{port}":
+                self.send_error(403, "Unexpected Host header")
+                return
+            filename = unquote(self.path.split("?", 1)[0].lstrip("/"))
+            if not filename:
+                rows = "".join(
+                    f'<li><a href="/{quote(name)}">{escape(name)}</a> '
+                    f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(stored_at))} UTC, "
+                    f"{size} bytes</li>"
+                    for name, stored_at, size in storage.reports()
+                    if not name.startswith(("assets/", "environment/", "snippets/"))
+                )
+                self._respond(f"<ul>{rows}</ul>".encode("utf8"), "text/html")
+                return
+            data = storage.read(filename[len(storage.prefix) :])
+            if data is None:
+                self.send_error(404)
+                return
+            extension = filename.rsplit(".", 1)[-1]
+            content_type = (
+                "application/json"
+                if extension == "json"
+                else CONTENT_TYPES.get(extension, "text/plain")
+            )
+            self._respond(data, content_type)
+
+        def _respond(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # noqa: W0622
+            pass
+
+    return MemoryStorageHandler
+
+
+StorageWriteResult = namedtuple(
+    "StorageWriteResult", ["backend", "status", "location", "error", "elapsed"]
+)
+
+# storage options that change how reports are rendered, see ErrorStorage
+_SHARED_OPTIONS = (
+    "shared_environment",
+    "shared_assets",
+    "shared_snippets",
+    "content_addressed",
+    "index",
+)
+
+
+class MultiErrorStorage(ErrorStorage):
+    """
+    Writes reports to several storage backends concurrently.
+
+    write() returns the location from the primary backend (an index into backends) when one is given, otherwise
+    the first successful location. The other writes finish in the background.
+
+    Each backend has its own writer thread and a queue of at most max_queued writes. Writes to a backend that has
+    fallen that far behind are dropped with a warning and the status "dropped".
+
+    timeout: seconds to wait for each backend, either one number or one per backend. A write that is still queued
+    when its timeout passes is skipped, and one that takes longer is reported with the status "timeout". A write
+    that already started can't be interrupted, so backends should have their own timeout (like S3ErrorStorage).
+
+    The shared storage options (shared_environment, shared_assets, ...) are on when they're on for every backend,
+    since each backend stores the same report. write_once, append and record_occurrence go to every backend, read
+    returns the data from the first backend that has it.
+
+    The result of the latest write to each backend is kept in `last_results` as a StorageWriteResult with the
+    status "ok", "failed", "timeout", "dropped" or "pending". Failures are logged as warnings.
+    """
+
+    def __init__(self, backends, primary=None, timeout=30, max_queued=100):
+        import queue
+
+        self.backends = list(backends)
+        self.primary = primary
+        if isinstance(timeout, (int, float)):
+            timeout = [timeout] * len(self.backends)
+        self.timeouts = list(timeout)
+        for option in _SHARED_OPTIONS:
+            setattr(
+                self,
+                option,
+                bool(self.backends)
+                and all(getattr(b, option, False) for b in self.backends),
+            )
+
+        self._queues = [queue.Queue(maxsize=max_queued) for _ in self.backends]
+        self._threads = [None] * len(self.backends)
+        self._lock = threading.Lock()
+        self._last_results = [None] * len(self.backends)
+
+    @property
+    def last_results(self):
+        with self._lock:
+            return list(self._last_results)
+
+    def write(self, filename, data):
+        return self._first_location(self._submit("write", filename, data))
+
+    def write_once(self, filename, data):
+        location = self.stored_location(filename)
+        if location is None:
+            location = self._first_location(self._submit("write_once", filename, data))
+            self._cache_location(filename, location)
+        return location
+
+    def append(self, filename, data, header=""):
+        """Append to every backend and return whether any of them created the file."""
+        results = self._wait_all(self._submit("append", filename, data, header))
+        return any(result.location for result in results)
+
+    @property
+    def supports_append(self):
+        return all(backend.supports_append for backend in self.backends)
+
+    def record_occurrence(self, filename, timestamp):
+        self._submit("record_occurrence", filename, timestamp)
+
+    def read(self, filename):
+        for backend in self._backends_by_preference():
+            try:
+                data = backend.read(filename)
+            except Exception:  # noqa
+                continue
+            if data is not None:
+                return data
+        return None
+
+    def exists(self, filename):
+        return all(backend.exists(filename) for backend in self.backends)
+
+    def location(self, filename):
+        for backend in self._backends_by_preference():
+            location = backend.location(filename)
+            if location is not None:
+                return location
+        return None
+
+    def write_all(self, filename, data):
+        """Write to every backend and return their StorageWriteResults once all have finished or timed out."""
+        return self._wait_all(self._submit("write", filename, data))
+
+    def _wait_all(self, futures):
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+
+        results = []
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result(timeout=self.timeouts[i]))
+            except FutureTimeoutError:
+                results.append(
+                    StorageWriteResult(
+                        self.backends[i], "timeout", None, None, self.timeouts[i]
+                    )
+                )
+        return results
+
+    def _backends_by_preference(self):
+        if self.primary is None:
+            return self.backends
+        return [self.backends[self.primary]] + [
+            b for i, b in enumerate(self.backends) if i != self.primary
+        ]
+
+    def _first_location(self, futures):
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        from concurrent.futures import wait
+
+        if self.primary is not None:
+            try:
+                return futures[self.primary].result(
+                    timeout=self.timeouts[self.primary]
+                ).location
+            except FutureTimeoutError:
+                return None
+
+        deadline = time.monotonic() + max(self.timeouts)
+        pending = set(futures)
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=max(deadline - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                break
+            for future in done:
+                if future.result().location is not None:
+                    return future.result().location
+        return None
+
+    def _submit(self, method, *args):
+        import queue
+        from concurrent.futures import Future
+
+        futures = []
+        for i, backend in enumerate(self.backends):
+            future = Future()
+            deadline = time.monotonic() + self.timeouts[i]
+            self._start(i)
+            try:
+                self._queues[i].put_nowait((future, method, args, deadline))
+            except queue.Full:
+                logger.warning(
+                    f"Exception report queue of {type(backend).__name__} is full, dropping {args[0]}"
+                )
+                result = StorageWriteResult(backend, "dropped", None, None, None)
+                future.set_result(result)
+            else:
+                result = StorageWriteResult(backend, "pending", None, None, None)
+            if method == "write":
+                self._set_result(i, result)
+            futures.append(future)
+        return futures
+
+    def _start(self, i):
+        with self._lock:
+            if self._threads[i] is None:
+                self._threads[i] = threading.Thread(
+                    target=self._run,
+                    args=(i,),
+                    name=f"exception-reports-storage-{i}",
+                    daemon=True,
+                )
+                self._threads[i].start()
+
+    def _set_result(self, i, result):
+        with self._lock:
+            self._last_results[i] = result
+
+    def _run(self, i):
+        backend = self.backends[i]
+        while True:
+            future, method, args, deadline = self._queues[i].get()
+            if time.monotonic() > deadline:
+                logger.warning(
+                    f"Exception report to {type(backend).__name__} timed out before it was written"
+                )
+                result = StorageWriteResult(backend, "timeout", None, None, None)
+            else:
+                result = self._call_backend(i, method, args)
+            if method == "write":
+                self._set_result(i, result)
+            future.set_result(result)
+
+    def _call_backend(self, i, method, args):
+        backend = self.backends[i]
+        start = time.monotonic()
+        location = None
+        error = None
+        try:
+            location = getattr(backend, method)(*args)
+        except Exception as e:  # noqa
+            error = e
+        elapsed = time.monotonic() - start
+
+        if elapsed > self.timeouts[i]:
+            status = "timeout"
+        elif location is None and (method != "record_occurrence" or error):
+            status = "failed"
+        else:
+            status = "ok"
+        if status != "ok":
+            logger.warning(
+                f"Error saving exception report to {type(backend).__name__}: {status}",
+                exc_info=error,
+            )
+        return StorageWriteResult(backend, status, location, error, elapsed)
+
+
+def upload_to_s3(
+    aws_key, aws_secret, bucket, filename, contents, content_type, timeout=None
+):
+    return _s3_request(
+        "PUT",
+        aws_key=aws_key,
+        aws_secret=aws_secret,
+        bucket=bucket,
+        filename=filename,
+        contents=contents,
+        content_type=content_type,
+        timeout=timeout,
+    )
+
+
+def download_from_s3(aws_key, aws_secret, bucket, filename, timeout=None):
+    return _s3_request(
+        "GET",
+        aws_key=aws_key,
+        aws_secret=aws_secret,
+        bucket=bucket,
+        filename=filename,
+        timeout=timeout,
+    )
+
 
-def upload_to_s3(aws_key, aws_secret, bucket, filename, contents, content_type):
+def _s3_request(
+    method,
+    aws_key,
+    aws_secret,
+    bucket,
+    filename,
+    contents=b"",
+    content_type="",
+    timeout=None,
+):
     from _sha1 import sha1
+    from http.client import HTTPSConnection
+    from wsgiref.handlers import format_date_time
 
+    amz_headers = {"x-amz-acl": "private"} if method == "PUT" else {}
     timestamp = format_date_time(datetime.now().timestamp())
     string_to_sign = "\n".join(
         [
-            "PUT",
+            method,
             "",
             content_type,
             timestamp,
-            "x-amz-acl:private",
+            *[f"{k}:{v}" for k, v in amz_headers.items()],
             f"/{bucket}{filename}",
         ]
     )
@@ -112,11 +1382,12 @@ def upload_to_s3(aws_key, aws_secret, bucket, filename, contents, content_type):
     signed = b64encode(hmac_data).decode("utf-8")
     headers = {
         "Authorization": "AWS " + aws_key + ":" + signed,
-        "Content-Type": content_type,
         "Date": timestamp,
-        "Content-Length": len(contents),
-        "x-amz-acl": "private",
+        **amz_headers,
     }
-    conn = HTTPSConnection(bucket + ".s3.amazonaws.com")
-    conn.request("PUT", filename, contents, headers)
+    if method == "PUT":
+        headers["Content-Type"] = content_type
+        headers["Content-Length"] = len(contents)
+    conn = HTTPSConnection(bucket + ".s3.amazonaws.com", timeout=timeout)
+    conn.request(method, filename, contents or None, headers)
     return conn.getresponse(), f"https://{bucket}.s3.amazonaws.com{filename}"
@@ -1,4 +1,5 @@
 import sys
+import types
 
 
 def get_logger_traceback():  # noqa
@@ -16,6 +17,53 @@ def get_logger_traceback():  # noqa
         return TracebackFrameProxy(sys.exc_info()[2])
 
 
+def get_stack_traceback(frame):
+    """
+    Returns a traceback object for the stack ending at frame.
+
+    Lets the stacks of code that didn't raise an exception, like other threads, be reported like a traceback.
+    """
+    tb = None
+    while frame is not None:
+        tb = types.TracebackType(tb, frame, max(frame.f_lasti, 0), frame.f_lineno)
+        frame = frame.f_back
+    return tb
+
+
+def get_frames_snapshot_traceback(frames):
+    """
+    Returns a traceback of snapshots of frames, which are ordered from oldest to newest.
+
+    Lets the frames of suspended coroutines, which aren't linked by f_back, be reported from another thread while
+    they keep running.
+    """
+    tb = None
+    for frame in reversed(frames):
+        tb = TracebackSnapshot(frame, tb)
+    return tb
+
+
+class FrameSnapshot:
+    """The position of a frame and a shallow copy of its local variables."""
+
+    def __init__(self, frame):
+        self.f_code = frame.f_code
+        self.f_globals = frame.f_globals
+        self.f_locals = dict(frame.f_locals)
+        self.f_lineno = frame.f_lineno or frame.f_code.co_firstlineno
+        self.f_lasti = frame.f_lasti
+
+
+class TracebackSnapshot:
+    """A traceback entry for a frame snapshot."""
+
+    def __init__(self, frame, tb_next=None):
+        self.tb_frame = FrameSnapshot(frame)
+        self.tb_lineno = self.tb_frame.f_lineno
+        self.tb_lasti = max(self.tb_frame.f_lasti, 0)
+        self.tb_next = tb_next
+
+
 class TracebackFrameProxy:
     """Proxies a traceback frame to hide parts of the trace related to logging.."""
 
@@ -0,0 +1,471 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import reprlib
+import signal
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+from exception_reports.storages import LocalErrorStorage
+from exception_reports.traceback import (
+    get_frames_snapshot_traceback,
+    get_stack_traceback,
+)
+
+logger = logging.getLogger(__name__)
+
+_short_repr = reprlib.Repr()
+_short_repr.maxother = 120
+
+
+def get_thread_stacks(skip_thread_ids=(), first_thread_id=None):
+    """
+    Return (label, traceback) pairs for the current stack of every thread.
+
+    The stack of first_thread_id, if given, is listed first.
+    """
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = []
+    for thread_id, frame in sys._current_frames().items():  # noqa: W0212
+        if thread_id in skip_thread_ids:
+            continue
+        label = f"Thread {thread_names.get(thread_id, '<unknown>')} ({thread_id})"
+        if thread_id == first_thread_id:
+            stacks.insert(0, (f"{label} - stalled", get_stack_traceback(frame)))
+        else:
+            stacks.append((label, get_stack_traceback(frame)))
+    return stacks
+
+
+class StallWatchdog:
+    """
+    Writes a report of the stack of every thread when a heartbeat is late.
+
+    Usage:
+
+        watchdog = StallWatchdog(threshold_ms=500)
+        watchdog.start()
+
+        while True:
+            watchdog.heartbeat()
+            handle_next_job()
+
+    For an asyncio event loop, `watchdog.watch_loop(loop)` sends heartbeats from a loop callback so a report is
+    written whenever the loop is blocked for longer than the threshold.
+
+    One report is written per stall, and at most one every min_report_interval seconds. Heartbeats only store a
+    timestamp, so the overhead while nothing is stalled is a background thread waking up every check interval.
+    """
+
+    def __init__(
+        self,
+        threshold_ms=1000,
+        storage_backend=None,
+        output_format="html",
+        check_interval_ms=None,
+        min_report_interval=60,
+        data_processor=None,
+    ):
+        if storage_backend is None:
+            storage_backend = LocalErrorStorage()
+        self.threshold = threshold_ms / 1000
+        self.check_interval = (check_interval_ms or threshold_ms / 4) / 1000
+        self.storage_backend = storage_backend
+        self.output_format = output_format
+        self.min_report_interval = min_report_interval
+        self.data_processor = data_processor
+
+        self._last_heartbeat = time.monotonic()
+        self._heartbeat_thread_id = None
+        self._stall_reported = False
+        self._last_report_time = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def heartbeat(self):
+        self._last_heartbeat = time.monotonic()
+        self._heartbeat_thread_id = threading.get_ident()
+
+    def start(self):
+        self._stopped.clear()
+        self._last_heartbeat = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name="exception-reports-watchdog", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def watch_loop(self, loop):
+        """Send heartbeats from callbacks scheduled on an asyncio event loop."""
+
+        def beat():
+            self.heartbeat()
+            if not self._stopped.is_set():
+                loop.call_later(self.check_interval, beat)
+
+        loop.call_soon_threadsafe(beat)
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            late_by = time.monotonic() - self._last_heartbeat
+            if late_by < self.threshold:
+                self._stall_reported = False
+                continue
+            if self._stall_reported:
+                continue
+
+            now = time.monotonic()
+            self._stall_reported = True
+            if (
+                self._last_report_time is not None
+                and now - self._last_report_time < self.min_report_interval
+            ):
+                continue
+            self._last_report_time = now
+
+            try:
+                self.report_stall(late_by)
+            except Exception:  # noqa
+                logger.warning("Error generating stall report", exc_info=True)
+
+    def report_stall(self, late_by):
+        from exception_reports.reporter import create_stack_report
+
+        stacks = get_thread_stacks(
+            skip_thread_ids={threading.get_ident()},
+            first_thread_id=self._heartbeat_thread_id,
+        )
+        report_location = create_stack_report(
+            stacks,
+            "Stall",
+            f"Heartbeat late by {late_by * 1000:.0f} ms",
+            self.output_format,
+            self.storage_backend,
+            data_processor=self.data_processor,
+        )
+        logger.warning(
+            "Stall detected", extra={"data": {"error_report": report_location}}
+        )
+        return report_location
+
+
+def get_task_frames(task):
+    """
+    Return the frames of a pending task, from its coroutine to the innermost coroutine it awaits.
+
+    Task.get_stack only follows f_back, which doesn't link the frames of suspended coroutines, so the chain of
+    awaited coroutines is followed instead.
+    """
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = (
+            getattr(awaitable, "cr_frame", None)
+            or getattr(awaitable, "gi_frame", None)
+            or getattr(awaitable, "ag_frame", None)
+        )
+        if frame is not None:
+            frames.append(frame)
+        awaitable = (
+            getattr(awaitable, "cr_await", None)
+            or getattr(awaitable, "gi_yieldfrom", None)
+            or getattr(awaitable, "ag_await", None)
+        )
+    return frames or task.get_stack()
+
+
+def _task_position(frames, task):
+    """Return where a task is suspended: its innermost frame and instruction, and the future it waits for."""
+    frame = frames[-1] if frames else None
+    return (
+        frame,
+        frame.f_lasti if frame is not None else None,
+        getattr(task, "_fut_waiter", None),
+    )
+
+
+def _same_position(position, other):
+    return (
+        position[0] is other[0]
+        and position[1] == other[1]
+        and position[2] is other[2]
+    )
+
+
+class TaskDumper:
+    """
+    Writes a report of every pending task of an asyncio event loop, with its coroutine stack, the locals of the
+    suspended frames and how long it has been waiting.
+
+    Usage:
+
+        task_dumper = TaskDumper(loop).start()
+        task_dumper.install_signal_handler()  # `kill -USR1 <pid>` writes a report
+
+    or `task_dumper.dump()` from any thread, which returns a concurrent.futures.Future of the report location.
+
+    A task is waiting while it stays suspended at the same await. While started, where each task is suspended is
+    sampled every sample_interval seconds so waiting times are accurate to a sample interval, otherwise they are
+    only measured from one dump to the next. Waiting times that started before the first sample are shown as
+    ">=". Reports list the max_tasks tasks that have been waiting the longest.
+
+    Only the task stacks and shallow copies of their locals are collected on the loop. Formatting the locals,
+    reading the source context and writing the report happen in a separate thread. A loop blocked by a
+    synchronous call can't collect its tasks, use StallWatchdog to report those.
+    """
+
+    def __init__(
+        self,
+        loop,
+        storage_backend=None,
+        output_format="html",
+        sample_interval=1,
+        max_tasks=500,
+        data_processor=None,
+    ):
+        if storage_backend is None:
+            storage_backend = LocalErrorStorage()
+        self.loop = loop
+        self.storage_backend = storage_backend
+        self.output_format = output_format
+        self.sample_interval = sample_interval
+        self.max_tasks = max_tasks
+        self.data_processor = data_processor
+
+        # task -> (position, waiting since), only used on the loop. Weak so finished tasks aren't kept alive.
+        self._waiting = weakref.WeakKeyDictionary()
+        self._first_sample = None
+        self._stopped = True
+
+    def start(self):
+        self._stopped = False
+        self.loop.call_soon_threadsafe(self._sample)
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._waiting = weakref.WeakKeyDictionary()
+
+    def install_signal_handler(self, signum=None):
+        """
+        Write a report when the process receives signum, SIGUSR1 by default or SIGBREAK (ctrl+break) on windows.
+        Call from the main thread.
+        """
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None) or signal.SIGBREAK
+        try:
+            self.loop.add_signal_handler(signum, self.dump)
+        except NotImplementedError:  # windows event loops
+            signal.signal(
+                signum, lambda *args: self.loop.call_soon_threadsafe(self.dump)
+            )
+
+    def _sample(self):
+        if self._stopped or self.loop.is_closed():
+            return
+        tasks = [
+            (task, get_task_frames(task)) for task in asyncio.all_tasks(self.loop)
+        ]
+        self._update_waiting(tasks, time.monotonic())
+        self.loop.call_later(self.sample_interval, self._sample)
+
+    def _update_waiting(self, tasks, now):
+        if self._first_sample is None:
+            self._first_sample = now
+        waiting = weakref.WeakKeyDictionary()
+        for task, frames in tasks:
+            position = _task_position(frames, task)
+            previous = self._waiting.get(task)
+            if previous is not None and _same_position(previous[0], position):
+                waiting[task] = previous
+            else:
+                waiting[task] = (position, now)
+        self._waiting = waiting
+
+    def dump(self):
+        """
+        Collect the pending tasks on the loop and write their report in a separate thread.
+
+        Returns a concurrent.futures.Future of the report location, `await asyncio.wrap_future(...)` it from a
+        coroutine.
+        """
+        future = Future()
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._dump(future)
+        else:
+            self.loop.call_soon_threadsafe(self._dump, future)
+        return future
+
+    def _dump(self, future):
+        try:
+            stacks, message = self._collect()
+        except Exception as e:  # noqa
+            future.set_exception(e)
+            return
+        threading.Thread(
+            target=self._write,
+            args=(stacks, message, future),
+            name="exception-reports-task-dump",
+            daemon=True,
+        ).start()
+
+    def _collect(self):
+        now = time.monotonic()
+        current_task = asyncio.current_task(self.loop)
+        tasks = [
+            (task, get_task_frames(task))
+            for task in asyncio.all_tasks(self.loop)
+            if task is not current_task
+        ]
+        self._update_waiting(tasks, now)
+        tasks.sort(key=lambda item: self._waiting[item[0]][1])
+
+        stacks = []
+        for task, frames in tasks[: self.max_tasks]:
+            since = self._waiting[task][1]
+            waiting = f"{'>=' if since == self._first_sample else ''}{now - since:.1f}s"
+            coro = task.get_coro()
+            coro_name = getattr(coro, "__qualname__", None) or _short_repr.repr(coro)
+            label = f"Task {task.get_name()} {coro_name} waiting {waiting}"
+            waiter = getattr(task, "_fut_waiter", None)
+            if waiter is not None:
+                label += f" on {_short_repr.repr(waiter)}"
+            stacks.append((label, get_frames_snapshot_traceback(frames)))
+
+        message = f"{len(tasks)} pending tasks"
+        if len(tasks) > self.max_tasks:
+            message += f", showing the {self.max_tasks} waiting the longest"
+        return stacks, message
+
+    def _write(self, stacks, message, future):
+        from exception_reports.reporter import create_stack_report
+
+        try:
+            report_location = create_stack_report(
+                stacks,
+                "Task dump",
+                message,
+                self.output_format,
+                self.storage_backend,
+                data_processor=self.data_processor,
+            )
+        except Exception as e:  # noqa
+            logger.warning("Error generating task dump report", exc_info=True)
+            future.set_exception(e)
+            return
+        logger.warning(
+            "Task dump written", extra={"data": {"error_report": report_location}}
+        )
+        future.set_result(report_location)
+
+
+class SlowCallMonitor:
+    """
+    Calls a callback for watched calls that are still running after their threshold.
+
+    A shared helper thread keeps the deadlines and starts a thread for each callback, so a slow callback (like
+    writing a report) doesn't delay the deadlines of other calls. Watching a call costs a heap push. Finished calls
+    are only marked inactive and dropped from the heap lazily.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def watch(self, threshold, callback):
+        """Call callback(watch) in another thread if the current call hasn't been unwatched after threshold seconds."""
+        watch = SlowCallWatch(threading.get_ident(), threshold, callback)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="exception-reports-slow-calls", daemon=True
+                )
+                self._thread.start()
+            heapq.heappush(
+                self._deadlines, (watch.deadline, next(self._counter), watch)
+            )
+            if self._deadlines[0][2] is watch:
+                self._condition.notify()
+        return watch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._deadlines:
+                    self._condition.wait()
+                deadline, _, watch = self._deadlines[0]
+                if watch.active and deadline > time.monotonic():
+                    self._condition.wait(deadline - time.monotonic())
+                    continue
+                heapq.heappop(self._deadlines)
+            if watch.active:
+                threading.Thread(
+                    target=self._call,
+                    args=(watch,),
+                    name="exception-reports-slow-call-report",
+                    daemon=True,
+                ).start()
+
+    def _call(self, watch):
+        try:
+            watch.callback(watch)
+        except Exception:  # noqa
+            logger.warning("Error generating slow call report", exc_info=True)
+
+
+class SlowCallWatch:
+    def __init__(self, thread_id, threshold, callback):
+        self.thread_id = thread_id
+        self.start = time.monotonic()
+        self.deadline = self.start + threshold
+        self.callback = callback
+        self.active = True
+        # how long the call took, once it has finished
+        self.duration = None
+        self.report_location = None
+        # held while the stack is sampled so the watched call can't finish meanwhile
+        self.lock = threading.Lock()
+        # set once a report has been written, or failed to be
+        self.reported = threading.Event()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def current_stack(self):
+        """Return a snapshot of the current traceback of the watched thread or None if it has finished."""
+        frame = sys._current_frames().get(self.thread_id)  # noqa: W0212
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        return get_frames_snapshot_traceback(frames)
+
+
+_slow_call_monitor = []
+_slow_call_monitor_lock = threading.Lock()
+
+
+def get_slow_call_monitor():
+    """Return the process wide SlowCallMonitor."""
+    with _slow_call_monitor_lock:
+        if not _slow_call_monitor:
+            _slow_call_monitor.append(SlowCallMonitor())
+    return _slow_call_monitor[0]
@@ -11,7 +11,17 @@ with open(path.join(this_directory, "README.md"), encoding="utf-8") as f:
 setup(
     name="exception-reports",
     packages=["exception_reports"],
-    package_data={"exception_reports": ["report_template.html"]},
+    package_data={
+        "exception_reports": [
+            "report_template.html",
+            "report_template.css",
+            "report_template.js",
+            "report_template.min.html",
+            "report_template.min.css",
+            "report_template.min.js",
+            "index_template.html",
+        ]
+    },
     version=__version__,
     description="Interactive stacktraces with variable state at each level.",
     long_description=long_description,
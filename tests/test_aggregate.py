@@ -0,0 +1,85 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from exception_reports.aggregate import aggregate_reports, main
+from exception_reports.reporter import create_exception_report
+from exception_reports.storages import LocalErrorStorage, SegmentErrorStorage
+
+
+def _write_reports(storage_backend, count):
+    for i in range(count):
+        try:
+            if i % 3:
+                raise ValueError(i)
+            raise KeyError(i)
+        except (ValueError, KeyError) as e:
+            create_exception_report(
+                type(e), e, e.__traceback__, "json", storage_backend
+            )
+
+
+def test_aggregate_reports(tmpdir):
+    storage_backend = LocalErrorStorage(
+        output_path=str(tmpdir), shared_environment=True
+    )
+    _write_reports(storage_backend, 9)
+    tmpdir.join("not-a-report.json").write("[1, 2]")
+
+    result = aggregate_reports(str(tmpdir), processes=2, chunk_size=2)
+
+    assert result["total"] == 9
+    value_errors, key_errors = result["groups"]
+    assert value_errors["exception_type"] == "ValueError"
+    assert value_errors["count"] == 6
+    assert value_errors["location"].endswith("in _write_reports")
+    assert sum(value_errors["histogram"].values()) == 6
+    assert key_errors["count"] == 3
+
+    later = datetime.now(timezone.utc) + timedelta(hours=1)
+    assert aggregate_reports(str(tmpdir), since=later, processes=1)["total"] == 0
+
+
+def test_aggregate_segment_reports(tmpdir, capsys):
+    _write_reports(SegmentErrorStorage(output_path=str(tmpdir)), 3)
+
+    main([str(tmpdir), "--hours", "1", "--processes", "1", "--json"])
+
+    result = json.loads(capsys.readouterr().out)
+    assert [g["count"] for g in result["groups"]] == [2, 1]
+
+
+def _write_repeated_report(storage_backend, count):
+    # the same locals on every iteration, so every report has the same content
+    for _ in [None] * count:
+        try:
+            raise ValueError("repeated")
+        except ValueError as e:
+            create_exception_report(
+                type(e), e, e.__traceback__, "json", storage_backend
+            )
+
+
+def test_aggregate_content_addressed_reports(tmpdir):
+    local = tmpdir.mkdir("local")
+    _write_repeated_report(
+        LocalErrorStorage(output_path=str(local), content_addressed=True), 4
+    )
+    segments = tmpdir.mkdir("segments")
+    storage_backend = SegmentErrorStorage(
+        output_path=str(segments), segment_bytes=1, content_addressed=True
+    )
+    _write_repeated_report(storage_backend, 3)
+    storage_backend.close()
+
+    assert len([p for p in local.listdir() if p.ext == ".json"]) == 1
+    assert aggregate_reports(str(local), processes=1)["total"] == 4
+    assert aggregate_reports(str(segments), processes=2)["total"] == 3
+
+    # the report is older than since, its occurrences aren't
+    report_paths = [p for p in local.listdir() if p.ext == ".json"]
+    for path in report_paths + [segments.join("00000001.seg")]:
+        os.utime(str(path), (0, 0))
+    since = datetime.now(timezone.utc) - timedelta(minutes=1)
+    assert aggregate_reports(str(local), since=since, processes=1)["total"] == 4
+    assert aggregate_reports(str(segments), since=since, processes=1)["total"] == 3
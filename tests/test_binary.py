@@ -0,0 +1,161 @@
+import json
+import marshal
+import sys
+import timeit
+from functools import partial
+
+import pytest
+
+from exception_reports import reporter
+from exception_reports.binary import (
+    MAGIC,
+    binary_report_to_html,
+    binary_report_to_json,
+    decode_binary_report,
+    encode_binary_report,
+    main,
+)
+from exception_reports.reporter import (
+    _json_serializer,
+    create_exception_report,
+    get_exception_data,
+    render_exception_html,
+    render_exception_json,
+)
+from exception_reports.storages import LocalErrorStorage
+
+
+def _exception_data():
+    def a(depth):
+        weird = "союз 🌞 \udcae <b>"  # noqa
+        numbers = [2**70, -1, 1.5, float("inf"), None, True]  # noqa
+        if depth:
+            a(depth - 1)
+        raise KeyError("missing")
+
+    try:
+        a(5)
+    except KeyError:
+        return get_exception_data()
+
+
+def test_binary_report_converts_to_json_and_html():
+    exception_data = _exception_data()
+    json_report = render_exception_json(exception_data)
+
+    binary_report = encode_binary_report(exception_data)
+
+    assert len(binary_report) < len(json_report.encode("utf8")) / 2
+    assert decode_binary_report(binary_report) == json.loads(json_report)
+    assert json.loads(binary_report_to_json(binary_report)) == json.loads(json_report)
+    assert binary_report_to_html(binary_report) == render_exception_html(
+        json.loads(json_report)
+    )
+
+
+def test_binary_report_values():
+    data = {"a": [1, 2**40, -3, 0.1, "x", ("y", None)], 1: False, None: {}}
+    assert decode_binary_report(encode_binary_report(data)) == json.loads(
+        json.dumps(data)
+    )
+
+    with pytest.raises(ValueError):
+        decode_binary_report(b"0" * 40)
+
+
+def test_binary_report_values_marshal_cant_encode():
+    data = {"when": {1, 2}, "raw": b"\x00", "other": object()}
+    assert decode_binary_report(encode_binary_report(data)) == json.loads(
+        json.dumps(data, default=_json_serializer)
+    )
+
+    with pytest.raises(ValueError):
+        decode_binary_report(MAGIC + b"\x04 not zlib data")
+    with pytest.raises(ValueError, match="marshal version"):
+        decode_binary_report(MAGIC + bytes([marshal.version + 1]) + b"data")
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="requires ExceptionGroup")
+def test_binary_report_chained_and_group_exceptions(monkeypatch):
+    def a(depth):
+        if depth:
+            a(depth - 1)
+        raise KeyError("missing")
+
+    try:
+        try:
+            a(3)
+        except KeyError as e:
+            raise ValueError("chained") from e
+    except ValueError:
+        chained_data = get_exception_data()
+    try:
+        try:
+            a(3)
+        except KeyError as e:
+            raise ExceptionGroup("group", [e, ValueError(1)])  # noqa: F821
+    except Exception:  # noqa
+        group_data = get_exception_data()
+    assert group_data["exception_groups"]
+
+    json_reports = [render_exception_json(d) for d in (chained_data, group_data)]
+
+    # the report values are converted for marshal, not through the json report
+    def fail(_):
+        raise AssertionError("json fallback")
+
+    monkeypatch.setattr(reporter, "render_exception_json", fail)
+    binary_reports = [encode_binary_report(d) for d in (chained_data, group_data)]
+    for binary_report, json_report in zip(binary_reports, json_reports):
+        assert decode_binary_report(binary_report) == json.loads(json_report)
+
+
+def test_binary_report_encoding_is_faster_than_json():
+    """Benchmark: encoding a binary report takes less time than rendering the json report."""
+
+    def a(depth):
+        config = {f"key{i}": list(range(i)) for i in range(30)}  # noqa
+        text = "hello world " * 50  # noqa
+        if depth:
+            a(depth - 1)
+        raise KeyError("missing")
+
+    try:
+        a(30)
+    except KeyError:
+        exception_data = get_exception_data()
+    try:
+        try:
+            a(15)
+        except KeyError as e:
+            raise ValueError("chained") from e
+    except ValueError:
+        chained_data = get_exception_data()
+
+    number = 30
+    for data in (exception_data, chained_data):
+        binary_time = min(
+            timeit.repeat(partial(encode_binary_report, data), number=number, repeat=9)
+        )
+        json_time = min(
+            timeit.repeat(partial(render_exception_json, data), number=number, repeat=9)
+        )
+
+        assert binary_time < json_time
+
+
+def test_binary_output_format(tmpdir, capsys):
+    try:
+        raise ValueError("on purpose")
+    except ValueError as e:
+        location = create_exception_report(
+            ValueError,
+            e,
+            e.__traceback__,
+            "binary",
+            LocalErrorStorage(output_path=str(tmpdir)),
+        )
+
+    assert location.endswith(".erb")
+    main([location])
+    assert json.loads(capsys.readouterr().out)["exception_type"] == "ValueError"
@@ -1,18 +1,35 @@
+import inspect
 import json
 import re
+import sys
+import threading
+import time
+import timeit
 
 import httpretty
 import pytest
 from httpretty import httprettified
 
-from exception_reports.decorators import exception_report
-from exception_reports.storages import S3ErrorStorage
+from exception_reports.decorators import (
+    exception_report,
+    fast_exception_report,
+    install_excepthook,
+    install_threading_excepthook,
+    report_exceptions,
+    slow_call_report,
+)
+from exception_reports.storages import LocalErrorStorage, S3ErrorStorage
 
 
 class SpecialException(Exception):
     pass
 
 
+def _message(e):
+    """The exception message including notes, which hold the report location on python 3.11+."""
+    return " ".join([str(e), *getattr(e, "__notes__", [])])
+
+
 def test_decorator():
     @exception_report()
     def foobar(text):
@@ -20,7 +37,7 @@ def test_decorator():
 
     with pytest.raises(SpecialException) as e:
         foobar("hi")
-    assert "report:/tmp" in str(e.value)
+    assert "report:/tmp" in _message(e.value)
 
 
 def test_decorator_json():
@@ -32,7 +49,7 @@ def test_decorator_json():
         foobar("hi")
         assert False
     except SpecialException as e:
-        assert "report:/tmp" in str(e)
+        assert "report:/tmp" in _message(e)
         with open(e.report, "r", encoding="utf-8") as f:
             data = json.load(f)
 
@@ -51,7 +68,7 @@ def test_decorator_with_base_exception():
         foobar("hi")
 
     assert "bad things" in str(e)
-    assert "report:/tmp" in str(e)
+    assert "report:/tmp" in _message(e.value)
 
 
 def test_decorator_with_type_exception():
@@ -65,7 +82,7 @@ def test_decorator_with_type_exception():
         foobar("hi")
 
     assert "bad things" in str(e)
-    assert "report:/tmp" in str(e)
+    assert "report:/tmp" in _message(e.value)
 
 
 class SpecialArgsException(Exception):
@@ -81,7 +98,7 @@ def test_decorator_with_args_exception():
     with pytest.raises(SpecialArgsException) as e:
         foobar("hi")
 
-    assert "report:/tmp" in str(e.value)
+    assert "report:/tmp" in _message(e.value)
 
 
 @httprettified
@@ -102,7 +119,7 @@ def test_s3_decorator():
     with pytest.raises(SpecialException) as e:
         foobar("hi")
 
-    assert "report:https://" in str(e.value)
+    assert "report:https://" in _message(e.value)
 
 
 @httprettified
@@ -134,7 +151,7 @@ def test_custom_s3_decorator():
             assert_expection_spec(e2)
             raise
 
-    assert "report:https://" in str(e.value)
+    assert "report:https://" in _message(e.value)
 
 
 def test_exception_spec():
@@ -153,3 +170,165 @@ def assert_expection_spec(e):
     assert isinstance(e, SpecialException)
     assert issubclass(e.__class__, Exception)
     assert issubclass(e.__class__, SpecialException)
+
+
+def test_slow_call_report(tmpdir):
+    @slow_call_report(
+        threshold_ms=50,
+        storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+        output_format="json",
+    )
+    def slow_function(delay):
+        waiting_for = "the database"  # noqa
+        time.sleep(delay)
+        return delay
+
+    assert slow_function(0.001) == 0.001
+    assert not tmpdir.listdir()
+
+    assert slow_function(0.2) == 0.2
+    (report_path,) = _wait_for_files(tmpdir)
+    with open(report_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    assert data["exception_type"] == "SlowCall"
+    assert "slow_function still running after" in data["exception_value"]
+    assert data["lastframe"]["function"] == "slow_function"
+    assert dict(data["lastframe"]["vars"])["waiting_for"] == "&#x27;the database&#x27;"
+
+
+def test_slow_call_report_context_manager(tmpdir):
+    report = slow_call_report(
+        threshold_ms=20,
+        storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+        name="sleepy block",
+    )
+    with report as watch:
+        time.sleep(0.1)
+
+    assert watch.reported.wait(5)
+    assert watch.report_location == tmpdir.listdir()[0]
+
+
+def test_slow_call_report_doesnt_wait_for_report(tmpdir, caplog):
+    class SlowLocalStorage(LocalErrorStorage):
+        def write(self, filename, data):
+            time.sleep(0.2)
+            return super().write(filename, data)
+
+    report = slow_call_report(
+        threshold_ms=20,
+        storage_backend=SlowLocalStorage(output_path=str(tmpdir)),
+        output_format="json",
+        name="short block",
+    )
+    start = time.monotonic()
+    with report as watch:
+        time.sleep(0.05)
+
+    assert time.monotonic() - start < 0.2
+    assert watch.report_location is None
+    # the thread writing the report logs it
+    assert watch.reported.wait(5)
+    assert watch.report_location == tmpdir.listdir()[0]
+    assert f"Slow call short block took {watch.duration * 1000:.0f} ms" in caplog.text
+    assert f"[report:{watch.report_location}]" in caplog.text
+
+
+def test_slow_call_reports_dont_delay_other_calls(tmpdir):
+    class SlowLocalStorage(LocalErrorStorage):
+        def write(self, filename, data):
+            time.sleep(0.3)
+            return super().write(filename, data)
+
+    slow_report = slow_call_report(
+        threshold_ms=10, storage_backend=SlowLocalStorage(output_path=str(tmpdir))
+    )
+    report = slow_call_report(
+        threshold_ms=40, storage_backend=LocalErrorStorage(output_path=str(tmpdir))
+    )
+
+    with slow_report as slow_watch:
+        time.sleep(0.02)
+        with report as watch:
+            time.sleep(0.1)
+            # reported while the first report is still being written
+            assert watch.reported.wait(0.15)
+
+    assert slow_watch.reported.wait(5)
+    assert len(tmpdir.listdir()) == 2
+
+
+def _wait_for_files(tmpdir, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not tmpdir.listdir() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return tmpdir.listdir()
+
+
+def test_fast_decorator(tmpdir):
+    @fast_exception_report(LocalErrorStorage(output_path=str(tmpdir)), "json")
+    def foobar(text, count=1):
+        raise SpecialException("bad things!!")
+
+    with pytest.raises(SpecialException) as e:
+        foobar("hi")
+
+    assert f"report:{tmpdir}" in _message(e.value)
+    assert e.value.report.endswith(".json")
+    assert foobar.__name__ == "foobar"
+    assert list(inspect.signature(foobar).parameters) == ["text", "count"]
+
+
+def test_report_exceptions_context_manager(tmpdir):
+    with pytest.raises(SpecialException) as e:
+        with report_exceptions(LocalErrorStorage(output_path=str(tmpdir))):
+            raise SpecialException("bad things!!")
+
+    assert "report:" in _message(e.value)
+    assert len(tmpdir.listdir()) == 1
+
+    with report_exceptions(LocalErrorStorage(output_path=str(tmpdir))):
+        pass
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_excepthooks(tmpdir, monkeypatch):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    seen = []
+    monkeypatch.setattr(sys, "excepthook", lambda *args: seen.append(args[1]))
+    monkeypatch.setattr(threading, "excepthook", lambda args: seen.append(args.exc_value))
+
+    install_excepthook(storage_backend)
+    try:
+        raise SpecialException("uncaught")
+    except SpecialException:
+        sys.excepthook(*sys.exc_info())
+
+    install_threading_excepthook(storage_backend)
+    thread = threading.Thread(target=lambda: 1 / 0)
+    thread.start()
+    thread.join()
+
+    assert [type(e).__name__ for e in seen] == ["SpecialException", "ZeroDivisionError"]
+    assert all(e.report.startswith(str(tmpdir)) for e in seen)
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_fast_decorator_overhead():
+    """Benchmark: the success path overhead of the fast decorator compared to a bare call and `exception_report`."""
+
+    def add(a, b):
+        return a + b
+
+    fast_add = fast_exception_report()(add)
+    decorated_add = exception_report()(add)
+
+    number = 50_000
+    bare_time = min(timeit.repeat(lambda: add(1, 2), number=number, repeat=3))
+    fast_time = min(timeit.repeat(lambda: fast_add(1, 2), number=number, repeat=3))
+    decorated_time = min(
+        timeit.repeat(lambda: decorated_add(1, 2), number=number, repeat=3)
+    )
+
+    assert fast_time - bare_time < (decorated_time - bare_time) / 4
@@ -0,0 +1,51 @@
+import os
+import sys
+import timeit
+
+import pytest
+
+from exception_reports.diagnostics import approximate_size, get_resource_data
+
+
+def test_resource_data():
+    data = get_resource_data()
+
+    assert data["uptime"] > 0
+    assert data["thread_count"] >= 1
+    assert len(data["gc_counts"]) == 3
+    if sys.platform.startswith("linux"):
+        assert data["open_fds"] > 0
+        assert data["rusage"]["user_time"] > 0
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires /proc")
+@pytest.mark.parametrize("stat_counts_fds", [True, False])
+def test_open_fd_count(monkeypatch, tmpdir, stat_counts_fds):
+    if not stat_counts_fds:
+        # kernels before 6.2 report a size of 0
+        stat = os.stat
+        monkeypatch.setattr(
+            os,
+            "stat",
+            lambda path, **kwargs: os.stat_result((0,) * 10)
+            if path == "/proc/self/fd"
+            else stat(path, **kwargs),
+        )
+
+    count = get_resource_data()["open_fds"]
+    with open(tmpdir.join("file"), "w", encoding="utf-8"):
+        assert get_resource_data()["open_fds"] == count + 1
+
+
+def test_resource_data_overhead():
+    """Benchmark: the resource snapshot only takes a few syscalls."""
+    number = 200
+    snapshot_time = min(timeit.repeat(get_resource_data, number=number, repeat=5))
+
+    assert snapshot_time / number < 0.0002
+
+
+def test_approximate_size():
+    assert approximate_size([]) == sys.getsizeof([])
+    assert approximate_size(["a" * 100] * 10) > 10 * 100
+    assert approximate_size({i: str(i) for i in range(5000)}) > 5000 * 50
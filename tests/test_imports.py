@@ -0,0 +1,31 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = [
+    "decorator",
+    "exception_reports.reporter",
+    "http.client",
+    "jinja2",
+    "platform",
+    "pprint",
+]
+
+
+def _loaded_modules(statement):
+    code = f"import sys; {statement}; print('\\n'.join(sys.modules))"
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    return set(output.split())
+
+
+def test_configuring_logging_is_lightweight():
+    modules = _loaded_modules(
+        "from logging.config import dictConfig; "
+        "from exception_reports.logs import DEFAULT_LOGGING_CONFIG; "
+        "dictConfig(DEFAULT_LOGGING_CONFIG)"
+    )
+    assert not modules.intersection(HEAVY_MODULES)
+
+
+def test_importing_decorators_is_lightweight():
+    modules = _loaded_modules("import exception_reports.decorators")
+    assert not modules.intersection(HEAVY_MODULES)
@@ -0,0 +1,103 @@
+import json
+import threading
+
+from exception_reports.load_shedding import ReportLoadShedder
+from exception_reports.reporter import create_exception_report, create_traceback_report
+from exception_reports.storages import LocalErrorStorage
+
+
+def _report(storage_backend, load_shedder):
+    secret = "local value"  # noqa
+    try:
+        raise ValueError("on purpose")
+    except ValueError as e:
+        return create_exception_report(
+            ValueError,
+            e,
+            e.__traceback__,
+            "html",
+            storage_backend,
+            load_shedder=load_shedder,
+        )
+
+
+def test_detail_degrades_and_recovers(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    load_shedder = ReportLoadShedder(
+        max_cpu_share=1e-9, check_interval=0, min_level_duration=0
+    )
+
+    locations = [_report(storage_backend, load_shedder) for _ in range(4)]
+
+    full, without_locals, traceback_only, counted = locations
+    assert full.endswith(".html")
+    with open(without_locals, encoding="utf-8") as f:
+        report = json.load(f)
+    assert "vars" not in report["frames"][-1]
+    assert "context_line" in report["frames"][-1]
+    with open(traceback_only, encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["lastframe"]["function"] == "_report"
+    assert "context_line" not in report["lastframe"]
+    assert counted is None
+    assert load_shedder.counts == {"ValueError": 1}
+
+    load_shedder.max_cpu_share = 1000
+    assert _report(storage_backend, load_shedder) is not None
+    assert load_shedder.detail_level == "traceback"
+    _report(storage_backend, load_shedder)
+    _report(storage_backend, load_shedder)
+    assert load_shedder.detail_level == "full"
+
+
+def test_concurrency_limit(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    load_shedder = ReportLoadShedder(max_concurrent=1)
+
+    with load_shedder.report(KeyError):
+        assert _report(storage_backend, load_shedder) is None
+
+    assert load_shedder.counts == {"ValueError": 1}
+    assert _report(storage_backend, load_shedder).endswith(".html")
+
+
+def test_traceback_report_processing(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+
+    def redact(data):
+        data["exception_value"] = "<redacted>"
+        return data
+
+    def hidden():
+        __traceback_hide__ = True  # noqa
+        raise ValueError("secret")
+
+    try:
+        hidden()
+    except ValueError as e:
+        location = create_traceback_report(
+            ValueError, e, e.__traceback__, storage_backend, data_processor=redact
+        )
+
+    with open(location, encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["exception_value"] == "<redacted>"
+    assert report["lastframe"]["function"] == "test_traceback_report_processing"
+
+
+def test_counts_are_thread_safe():
+    load_shedder = ReportLoadShedder(max_concurrent=1)
+
+    def count():
+        for _ in range(10_000):
+            with load_shedder.report(KeyError):
+                pass
+
+    with load_shedder.report(ValueError):
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert load_shedder.counts == {"KeyError": 40_000}
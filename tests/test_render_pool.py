@@ -0,0 +1,45 @@
+import sys
+
+from exception_reports.render_pool import RenderPool, to_primitives
+from exception_reports.reporter import get_exception_data, render_exception_html
+
+
+def _exception_data():
+    try:
+        try:
+            raise KeyError("missing")
+        except KeyError as e:
+            raise ValueError("<b>bad</b>") from e
+    except ValueError:
+        return get_exception_data(*sys.exc_info())
+
+
+def test_render_pool_matches_in_process_rendering(caplog):
+    exception_data = _exception_data()
+    render_pool = RenderPool(processes=1)
+    try:
+        html = render_pool.render_html(exception_data)
+    finally:
+        render_pool.shutdown()
+
+    assert not caplog.records
+    assert html == render_exception_html(exception_data)
+    assert "KeyError(&#39;missing&#39;)" in html
+    assert "&lt;b&gt;bad&lt;/b&gt;" in html
+
+
+def test_render_pool_falls_back_when_full():
+    render_pool = RenderPool(max_pending=0)
+
+    html = render_pool.render_html(_exception_data())
+
+    assert render_pool._executor is None  # noqa: W0212
+    assert "ValueError" in html
+
+
+def test_to_primitives():
+    data = to_primitives({"tb": sys, "frames": [(1, "a")]})
+
+    assert type(data["tb"]) is not type(sys)  # noqa: E721
+    assert repr(data["tb"]) == repr(sys)
+    assert data["frames"] == [(1, "a")]
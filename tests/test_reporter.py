@@ -1,11 +1,27 @@
+import gc
 import json
 import os
+import sys
+import tracemalloc
 
+import pytest
+
+from exception_reports import reporter
 from exception_reports.reporter import (
+    TEMPLATE_DIR,
+    _append_to_str,
+    _report_assets,
+    _report_template,
+    append_to_exception_message,
+    create_exception_report,
+    format_frame_vars,
+    get_environment_data,
     get_exception_data,
     get_lines_from_file,
+    minify_template,
     render_exception_html,
     render_exception_json,
+    resolve_snippets,
 )
 from exception_reports.storages import LocalErrorStorage
 
@@ -199,3 +215,488 @@ def test_bad_sourcefile():
         empty_file, 999, 4
     )
     assert "There was an error displaying the source" in context_line
+
+
+def test_minified_template_is_current():
+    """The minified files must be regenerated (`make templates`) when the template sources change."""
+    with open(TEMPLATE_DIR / "report_template.html", "r", encoding="utf-8") as f:
+        assert _report_template() == minify_template(f.read())
+
+    for extension, text in _report_assets().items():
+        with open(TEMPLATE_DIR / f"report_template.{extension}", "r", encoding="utf-8") as f:
+            assert text == minify_template(f.read())
+
+
+def test_environment_snapshot_refreshes_when_path_changes(monkeypatch):
+    snapshot = get_environment_data()
+    assert get_environment_data() == snapshot
+
+    monkeypatch.setattr(sys, "path", sys.path + ["/some/new/path"])
+    new_snapshot = get_environment_data()
+
+    assert new_snapshot["sys_path"][-1] == "/some/new/path"
+    assert new_snapshot["environment_hash"] != snapshot["environment_hash"]
+
+
+def test_environment_snapshot_copies_are_independent():
+    snapshot = get_environment_data()
+    snapshot["platform"]["node"] = "redacted"
+    snapshot["sys_path"].append("/redacted")
+
+    fresh_snapshot = get_environment_data()
+    assert fresh_snapshot["platform"]["node"] != "redacted"
+    assert "/redacted" not in fresh_snapshot["sys_path"]
+
+
+def test_html_report_renders_processed_environment(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+
+    def redact(data):
+        data["sys_executable"] = "<redacted>"
+        return data
+
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        create_exception_report(*sys.exc_info(), "html", storage_backend)
+        location = create_exception_report(
+            *sys.exc_info(), "html", storage_backend, data_processor=redact
+        )
+
+    with open(location, "r", encoding="utf-8") as f:
+        html = f.read()
+    assert "&lt;redacted&gt;" in html
+    assert sys.executable not in html
+
+
+def test_shared_environment(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir), shared_environment=True)
+
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        json_location = create_exception_report(*sys.exc_info(), "json", storage_backend)
+        html_location = create_exception_report(*sys.exc_info(), "html", storage_backend)
+
+    with open(json_location, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    assert "sys_path" not in data
+    assert data["environment"].endswith(f"{data['environment_hash']}.json")
+    assert len(tmpdir.join("environment").listdir()) == 1
+
+    with open(data["environment"], "r", encoding="utf-8") as f:
+        environment = json.load(f)
+    assert environment["sys_path"] == sys.path
+
+    with open(html_location, "r", encoding="utf-8") as f:
+        assert data["environment"] in f.read()
+
+
+def test_shared_assets(tmpdir):
+    storage_backend = LocalErrorStorage(
+        output_path=str(tmpdir), prefix="reports/", shared_assets=True
+    )
+
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        location = create_exception_report(*sys.exc_info(), "html", storage_backend)
+
+    with open(location, "r", encoding="utf-8") as f:
+        html = f.read()
+
+    assert "<style" not in html
+    asset_files = tmpdir.join("reports", "assets").listdir()
+    assert sorted(f.ext for f in asset_files) == [".css", ".js"]
+    for asset_file in asset_files:
+        assert f'"assets/{asset_file.basename}"' in html
+
+
+def test_shared_assets_fallback_to_inline(tmpdir):
+    class FailingStorage(LocalErrorStorage):
+        def write(self, filename, data):
+            if filename.startswith("assets/"):
+                return None
+            return super().write(filename, data)
+
+    storage_backend = FailingStorage(output_path=str(tmpdir), shared_assets=True)
+
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        location = create_exception_report(*sys.exc_info(), "html", storage_backend)
+
+    with open(location, "r", encoding="utf-8") as f:
+        assert "<style" in f.read()
+
+
+def test_shared_snippets(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir), shared_snippets=True)
+
+    def fail():
+        raise Exception("on purpose")
+
+    locations = []
+    for _ in range(2):
+        try:
+            fail()
+        except Exception:
+            locations.append(
+                create_exception_report(*sys.exc_info(), "json", storage_backend)
+            )
+
+    reports = []
+    for location in locations:
+        with open(location, "r", encoding="utf-8") as f:
+            reports.append(json.load(f))
+
+    frames = reports[0]["frames"]
+    assert "context_line" not in frames[-1]
+    assert [f["snippet"] for f in frames] == [f["snippet"] for f in reports[1]["frames"]]
+    assert len(tmpdir.join("snippets").listdir()) == len(frames)
+    snippet_hashes = [f["snippet"] for f in frames]
+
+    data = resolve_snippets(reports[0], storage_backend)
+    assert data["frames"][-1]["context_line"].strip() == 'raise Exception("on purpose")'
+    assert data["lastframe"]["context_line"] == data["frames"][-1]["context_line"]
+    assert "raise Exception" in render_exception_html(data)
+
+    tmpdir.join("snippets").remove()
+    data = resolve_snippets(reports[1], storage_backend)
+    assert [f["snippet"] for f in data["frames"]] == snippet_hashes
+    assert "context_line" not in data["frames"][-1]
+    assert "on purpose" in render_exception_html(data)
+
+
+def test_content_addressed_reports(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir), content_addressed=True)
+
+    class Thing:
+        pass
+
+    def fail():
+        thing = Thing()  # noqa
+        raise Exception("on purpose")
+
+    def report():
+        try:
+            fail()
+        except Exception:
+            return create_exception_report(*sys.exc_info(), "json", storage_backend)
+        return None
+
+    locations = [report() for _ in range(3)]
+
+    assert len(set(locations)) == 1
+    assert len(tmpdir.listdir(lambda p: p.ext == ".json")) == 1
+
+    occurrences = tmpdir.join("occurrences", os.path.basename(locations[0]) + ".log")
+    assert len(occurrences.readlines()) == 3
+
+
+def test_html_report_frames_are_rendered_lazily():
+    def recurse(depth):
+        if depth == 0:
+            raise ValueError("<deep>")
+        recurse(depth - 1)
+
+    try:
+        recurse(200)
+    except ValueError:
+        html = render_exception_html(get_exception_data(*sys.exc_info()))
+
+    before, rest = html.split('<script type="application/json" id="traceback-payload">')
+    payload, after = rest.split("</script>", 1)
+    # frames are rendered from the payload, the markup only has the last frames for browsers without javascript
+    assert 'class="frame' not in before
+    static = after.split('<ul class="traceback" id="traceback-payload-static">')[1].split("</ul>")[0]
+    assert static.count('class="frame') == 20
+    assert "182 earlier frames" in static
+    assert "<code>recurse</code>" in static
+    assert 'raise ValueError(&#34;&lt;deep&gt;&#34;)' in static
+    assert "<" not in payload
+    frames = json.loads(payload)
+    assert len(frames) == 202
+    assert frames[-1]["context_line"].strip() == 'raise ValueError(&#34;&lt;deep&gt;&#34;)'
+    assert frames[-1]["vars"][0] == ["depth", "0"]
+    # the recurse closure is referenced, by id, to the test frame that has it first
+    assert frames[-1]["vars"][1][2] == frames[0]["id"]
+
+
+def test_report_index(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir), index=True)
+
+    def fail(i):
+        raise ValueError(f"bad </script> value {i}")
+
+    locations = []
+    for i in range(3):
+        try:
+            fail(i)
+        except ValueError:
+            locations.append(
+                create_exception_report(*sys.exc_info(), "html", storage_backend)
+            )
+
+    (page,) = tmpdir.join("index").listdir()
+    text = page.read_text("utf-8")
+    header, rows_text = text.split('<script type="text/plain" id="rows">\n')
+    assert '["time", "exception", "message", "last frame"]' in header
+    assert "</script>" not in rows_text
+    rows = [json.loads(line) for line in rows_text.splitlines()]
+    assert [row[1] for row in rows] == ["ValueError"] * 3
+    assert rows[0][2] == "bad </script> value 0"
+    assert rows[0][3].endswith(" in fail")
+    assert [page.dirpath().join(row[4]) for row in rows] == locations
+
+    days = tmpdir.join("index.html").read_text("utf-8").split('id="rows">\n')[1]
+    assert [json.loads(line) for line in days.splitlines()] == [
+        [page.purebasename, f"index/{page.basename}"]
+    ]
+
+
+class WriteOnlyStorage(LocalErrorStorage):
+    supports_append = False
+
+    def append(self, filename, data, header=""):
+        raise AssertionError("appended to a storage that doesn't support it")
+
+
+def test_report_index_needs_append(tmpdir):
+    storage_backend = WriteOnlyStorage(output_path=str(tmpdir), index=True)
+
+    try:
+        raise ValueError("bad")
+    except ValueError:
+        location = create_exception_report(*sys.exc_info(), "html", storage_backend)
+
+    assert tmpdir.listdir() == [location]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="requires ExceptionGroup")
+def test_exception_group_report():
+    def fail(i):
+        raise ValueError(f"bad value {i}")
+
+    def fail_differently():
+        raise KeyError("missing")
+
+    def gather():
+        errors = []
+        for i in range(500):
+            try:
+                fail(i)
+            except ValueError as e:
+                errors.append(e)
+        try:
+            fail_differently()
+        except KeyError as e:
+            errors.append(ExceptionGroup("nested", [e]))  # noqa: F821
+        raise ExceptionGroup("many tasks failed", errors)  # noqa: F821
+
+    try:
+        gather()
+    except Exception:
+        exception_data = get_exception_data(max_group_exceptions=300)
+
+    (group,) = exception_data["exception_groups"]
+    assert group["examined"] == 300
+    assert group["unexamined"] == 201
+    assert group["nested_groups"] == 1
+    (sub_exception,) = group["sub_exceptions"]
+    assert sub_exception["count"] == 300
+    assert sub_exception["exception_type"] == "ValueError"
+    assert sub_exception["frames"][-1]["function"] == "fail"
+
+    html = render_exception_html(exception_data)
+    assert "300 &times; ValueError: bad value 0" in html
+    assert "201 more sub-exceptions not examined" in html
+    render_exception_json(exception_data)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="requires ExceptionGroup")
+def test_exception_group_frame_limit():
+    def fail(exception_type):
+        raise exception_type("problem")
+
+    errors = []
+    for exception_type in (ValueError, KeyError, TypeError):
+        try:
+            fail(exception_type)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        raise ExceptionGroup("many tasks failed", errors)  # noqa: F821
+    except Exception:
+        exception_data = get_exception_data(max_group_frames=5)
+
+    sub_exceptions = exception_data["exception_groups"][0]["sub_exceptions"]
+    assert [len(e["frames"]) for e in sub_exceptions] == [2, 2, 0]
+    assert sub_exceptions[-1]["frames_omitted"] == 2
+
+
+def test_memory_section():
+    tracemalloc.start()
+    try:
+        big_list = [str(i) for i in range(100_000)]  # noqa
+        small = 1  # noqa
+        try:
+            raise Exception("on purpose")
+        except Exception:
+            exception_data = get_exception_data(include_memory=True)
+    finally:
+        tracemalloc.stop()
+
+    memory = exception_data["memory"]
+    assert memory["largest_locals"][0]["name"] == "big_list"
+    assert memory["largest_locals"][0]["size"] > 100_000 * 40
+    assert memory["tracemalloc"]["top"]
+    assert len(memory["gc_counts"]) == 3
+
+    html = render_exception_html(exception_data)
+    assert "Largest local variables" in html
+    assert "Top allocation sites" in html
+    render_exception_json(exception_data)
+
+
+def test_memory_error_report(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    huge = "x" * 100_000  # noqa
+
+    try:
+        raise MemoryError()
+    except MemoryError:
+        location = create_exception_report(*sys.exc_info(), "html", storage_backend)
+
+    assert location.endswith(".json")
+    with open(location, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    assert data["exception_type"] == "MemoryError"
+    local_vars = dict(data["lastframe"]["vars"])
+    assert len(local_vars["huge"]) < 100
+    assert data["memory"]["largest_locals"][0]["name"] == "huge"
+
+
+def test_memory_error_report_processing(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+
+    def redact(data):
+        for frame in data["frames"]:
+            frame["vars"] = [(k, "<redacted>") for k, _ in frame["vars"]]
+        return data
+
+    def hidden():
+        __traceback_hide__ = True  # noqa
+        raise MemoryError()
+
+    tracemalloc.start()
+    try:
+        secret = "hunter2"  # noqa
+        hidden()
+    except MemoryError:
+        location = create_exception_report(
+            *sys.exc_info(), "html", storage_backend, data_processor=redact
+        )
+    finally:
+        tracemalloc.stop()
+
+    with open(location, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    assert "hunter2" not in json.dumps(data)
+    assert [f["function"] for f in data["frames"]] == [
+        "test_memory_error_report_processing"
+    ]
+    assert data["memory"]["tracemalloc"]["top"] == []
+
+
+def test_repeated_locals_are_referenced():
+    config = {f"key{i}": i for i in range(100)}
+
+    def handler(settings, retries=3):
+        raise ValueError("on purpose")
+
+    def middleware(config, retries):
+        handler(config, retries)
+
+    try:
+        middleware(config, 3)
+    except ValueError:
+        exception_data = get_exception_data()
+
+    test_frame, middleware_frame, handler_frame = exception_data["frames"]
+    assert "key99" in dict(test_frame["vars"])["config"]
+    assert dict(middleware_frame["vars"])["config"] == "same as frame 1 `config`"
+    assert dict(handler_frame["vars"])["settings"] == "same as frame 1 `config`"
+    assert handler_frame["var_references"] == {
+        "settings": {"frame": 1, "name": "config"}
+    }
+    # short values are repeated instead of referenced
+    assert dict(handler_frame["vars"])["retries"] == "3"
+
+    html = render_exception_html(exception_data)
+    payload = html.split('id="traceback-payload">')[1].split("</script>")[0]
+    handler_payload = json.loads(payload)[2]
+    assert handler_payload["vars"][0] == [
+        "settings",
+        "same as frame 1 `config`",
+        test_frame["id"],
+    ]
+    assert json.loads(render_exception_json(exception_data))["frames"][2]["vars"]
+
+
+def test_reused_ids_are_not_referenced(monkeypatch):
+    # a local freed after its frame is formatted can have its id reused by a local of a later frame
+    monkeypatch.setattr(reporter, "id", lambda v: 1, raising=False)
+    frames = [{"vars": [("first", [1] * 100)]}, {"vars": [("second", [2] * 100)]}]
+
+    format_frame_vars(frames)
+
+    assert dict(frames[1]["vars"])["second"].startswith("[2,")
+    assert "var_references" not in frames[1]
+
+
+class AnnotatedError(Exception):
+    pass
+
+
+def test_annotated_exception_subclass_is_reused():
+    errors = [_append_to_str(AnnotatedError("bad"), f"[report:{i}]") for i in range(3)]
+
+    assert len({type(e) for e in errors}) == 1
+    assert isinstance(errors[0], AnnotatedError)
+    assert type(errors[0]).__qualname__ == "AnnotatedError"
+    assert str(errors[1]) == "bad [report:1]"
+
+    again = _append_to_str(errors[0], "[again]")
+    assert type(again) is type(errors[1])
+    assert str(again) == "bad [report:0] [again]"
+
+
+def test_append_to_exception_message_memory():
+    """Benchmark: annotating exceptions doesn't keep memory per exception once they're gone."""
+
+    def annotate(append, number):
+        for _ in range(number):
+            try:
+                raise AnnotatedError("bad")
+            except AnnotatedError as e:
+                append(e, e.__traceback__, "[report:/tmp/report.html]")
+
+    paths = {
+        "append_to_exception_message": append_to_exception_message,
+        "cached subclass": lambda e, tb, message: _append_to_str(e, message),
+    }
+    number = 50_000
+    for name, append in paths.items():
+        annotate(append, 100)
+        gc.collect()
+        tracemalloc.start()
+        annotate(append, number)
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        assert retained / number < 1, name
@@ -1,7 +1,27 @@
+import os
+import re
+import threading
+import time
+from http.client import HTTPConnection
+from urllib.request import urlopen
+
 import httpretty
+import pytest
 from httpretty import httprettified
 
-from exception_reports.storages import upload_to_s3
+from exception_reports.storages import (
+    ErrorStorage,
+    LocalErrorStorage,
+    MemoryErrorStorage,
+    MultiErrorStorage,
+    OutboxErrorStorage,
+    S3ErrorStorage,
+    SegmentErrorStorage,
+    SegmentLockedError,
+    extract_segment_report,
+    read_segment_record,
+    upload_to_s3,
+)
 
 
 @httprettified
@@ -19,3 +39,497 @@ def test_s3_upload():
     )
 
     assert response.status == 200
+
+
+@httprettified
+def test_s3_asset_content_type():
+    url = "https://my-bucket.s3.amazonaws.com/bugs/assets/abc.css"
+    httpretty.register_uri(httpretty.HEAD, url, status=404)
+    httpretty.register_uri(httpretty.PUT, url)
+    storage_backend = S3ErrorStorage(
+        access_key="access_key", secret_key="secret_key", bucket="my-bucket", prefix="bugs/"
+    )
+
+    location = storage_backend.write_once("assets/abc.css", "body {}")
+    assert location == "https://my-bucket.s3.amazonaws.com/bugs/assets/abc.css"
+    assert httpretty.last_request().headers["Content-Type"] == "text/css"
+    request_count = len(httpretty.latest_requests())
+
+    storage_backend.write_once("assets/abc.css", "body {}")
+    assert len(httpretty.latest_requests()) == request_count
+
+
+def test_relative_link():
+    storage_backend = LocalErrorStorage(prefix="bugs-")
+    assert storage_backend.relative_link("assets/a.css", "report.html") == "bugs-assets/a.css"
+
+    storage_backend = LocalErrorStorage(prefix="bugs/2023/")
+    assert storage_backend.relative_link("assets/a.css", "report.html") == "assets/a.css"
+
+
+@httprettified
+def test_s3_read():
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://my-bucket.s3.amazonaws.com/bugs/snippets/abc.json",
+        body="{}",
+    )
+    storage_backend = S3ErrorStorage(
+        access_key="access_key", secret_key="secret_key", bucket="my-bucket", prefix="bugs/"
+    )
+
+    assert storage_backend.read("snippets/abc.json") == b"{}"
+
+
+@httprettified
+def test_s3_read_missing():
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://my-bucket.s3.amazonaws.com/bugs/snippets/abc.json",
+        status=404,
+    )
+    storage_backend = S3ErrorStorage(
+        access_key="access_key", secret_key="secret_key", bucket="my-bucket", prefix="bugs/"
+    )
+
+    assert storage_backend.read("snippets/abc.json") is None
+
+
+@httprettified
+def test_s3_stored_location_is_cached():
+    url = "https://my-bucket.s3.amazonaws.com/bugs/abc.json"
+    httpretty.register_uri(httpretty.HEAD, url)
+    storage_backend = S3ErrorStorage(
+        access_key="access_key", secret_key="secret_key", bucket="my-bucket", prefix="bugs/"
+    )
+
+    assert storage_backend.stored_location("abc.json") == url
+    assert storage_backend.write_once("abc.json", "{}") == url
+    assert {r.method for r in httpretty.latest_requests()} == {"HEAD"}
+    request_count = len(httpretty.latest_requests())
+
+    assert storage_backend.stored_location("abc.json") == url
+    assert len(httpretty.latest_requests()) == request_count
+
+
+@httprettified
+def test_s3_occurrences_are_buffered():
+    httpretty.register_uri(
+        httpretty.PUT,
+        re.compile(r"https://my-bucket\.s3\.amazonaws\.com/bugs/occurrences/abc\.json/.*\.txt"),
+    )
+    storage_backend = S3ErrorStorage(
+        access_key="access_key", secret_key="secret_key", bucket="my-bucket", prefix="bugs/"
+    )
+    storage_backend.occurrence_flush_seconds = 0.05
+
+    storage_backend.record_occurrence("abc.json", "2024-01-01 00:00:01")
+    storage_backend.record_occurrence("abc.json", "2024-01-01 00:00:02")
+    assert not httpretty.latest_requests()
+
+    deadline = time.monotonic() + 5
+    while not any(r.body for r in httpretty.latest_requests()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    bodies = {r.body for r in httpretty.latest_requests()} - {b""}
+    assert bodies == {b"2024-01-01 00:00:01\n2024-01-01 00:00:02"}
+
+    storage_backend.record_occurrence("abc.json", "2024-01-01 00:00:03")
+    storage_backend.flush_occurrences()
+    assert httpretty.last_request().body == b"2024-01-01 00:00:03"
+
+
+def test_stored_location_cache_is_bounded(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    storage_backend.max_cached_locations = 2
+
+    for name in ("a.json", "b.json", "c.json"):
+        storage_backend.write_once(name, "{}")
+    storage_backend.stored_location("b.json")
+    storage_backend.write_once("d.json", "{}")
+
+    assert list(storage_backend._stored_locations()) == ["b.json", "d.json"]  # noqa: W0212
+    assert storage_backend.stored_location("a.json") == str(tmpdir.join("a.json"))
+
+
+def test_unreadable_storage_reads_none():
+    assert ErrorStorage().read("report.json") is None
+
+
+class SlowStorage(ErrorStorage):
+    def __init__(self, delay, location="slow"):
+        self.delay = delay
+        self.location_ = location
+
+    def write(self, filename, data):
+        time.sleep(self.delay)
+        return self.location_
+
+
+class FailingStorage(ErrorStorage):
+    def write(self, filename, data):
+        raise OSError("disk full")
+
+
+def test_local_storage_append(tmpdir):
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    created = []
+
+    def append(i):
+        created.append(storage_backend.append("page.txt", f"{i}\n", header="header\n"))
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    lines = tmpdir.join("page.txt").read().splitlines()
+    assert lines[0] == "header"
+    assert sorted(lines[1:], key=int) == [str(i) for i in range(20)]
+    assert created.count(True) == 1
+    assert tmpdir.listdir() == [tmpdir.join("page.txt")]
+    assert storage_backend.supports_append
+    assert not ErrorStorage().supports_append
+
+
+def test_multi_storage_append(tmpdir):
+    first = LocalErrorStorage(output_path=str(tmpdir.join("first")))
+    second = LocalErrorStorage(output_path=str(tmpdir.join("second")))
+    first.append("page.txt", "0\n", header="header\n")
+    storage_backend = MultiErrorStorage([first, second])
+
+    assert storage_backend.supports_append
+    assert storage_backend.append("page.txt", "1\n", header="header\n")
+    assert not storage_backend.append("page.txt", "2\n", header="header\n")
+    assert second.read("page.txt") == b"header\n1\n2\n"
+    assert not MultiErrorStorage([first, ErrorStorage()]).supports_append
+
+
+def test_multi_storage_returns_first_success(tmpdir):
+    storage_backend = MultiErrorStorage(
+        [FailingStorage(), SlowStorage(0.2), LocalErrorStorage(output_path=str(tmpdir))]
+    )
+
+    start = time.monotonic()
+    location = storage_backend.write("report.json", "{}")
+
+    assert location == str(tmpdir.join("report.json"))
+    assert time.monotonic() - start < 0.2
+    assert storage_backend.last_results[1].status == "pending"
+
+    time.sleep(0.3)
+    assert [r.status for r in storage_backend.last_results] == ["failed", "ok", "ok"]
+    assert isinstance(storage_backend.last_results[0].error, OSError)
+
+
+def test_multi_storage_primary_and_timeouts(tmpdir):
+    storage_backend = MultiErrorStorage(
+        [LocalErrorStorage(output_path=str(tmpdir)), SlowStorage(0.2)],
+        primary=1,
+        timeout=[1, 0.05],
+    )
+
+    assert storage_backend.write("report.json", "{}") is None
+
+    results = storage_backend.write_all("report.json", "{}")
+    assert [r.status for r in results] == ["ok", "timeout"]
+
+
+def test_multi_storage_queues_are_bounded():
+    storage_backend = MultiErrorStorage([SlowStorage(0.2)], timeout=0.05, max_queued=1)
+
+    # the first write is running, the second is queued, the third doesn't fit
+    assert storage_backend.write("first.json", "{}") is None
+    time.sleep(0.01)
+    results = [storage_backend.write_all(f"{i}.json", "{}")[0] for i in range(2)]
+
+    assert results[1].status == "dropped"
+    time.sleep(0.3)
+    # the queued write was skipped once its timeout passed
+    assert storage_backend.last_results[0].status == "timeout"
+    assert storage_backend.last_results[0].elapsed is None
+
+
+def test_multi_storage_forwards_shared_objects(tmpdir):
+    first = LocalErrorStorage(
+        output_path=str(tmpdir.join("first")), shared_assets=True
+    )
+    second = LocalErrorStorage(
+        output_path=str(tmpdir.join("second")), shared_assets=True
+    )
+    storage_backend = MultiErrorStorage([first, second], primary=1)
+
+    assert storage_backend.shared_assets
+    assert not storage_backend.shared_snippets
+    location = storage_backend.write_once("assets/report.css", "body {}")
+    time.sleep(0.05)
+
+    assert location == second.location("assets/report.css")
+    assert first.read("assets/report.css") == b"body {}"
+    assert storage_backend.read("assets/report.css") == b"body {}"
+    assert storage_backend.read("missing.css") is None
+
+
+class FlakyStorage(LocalErrorStorage):
+    def __init__(self, output_path, failures):
+        super().__init__(output_path=output_path)
+        self.failures = failures
+
+    def write(self, filename, data):
+        if self.failures:
+            self.failures -= 1
+            return None
+        return super().write(filename, data)
+
+
+def test_outbox_storage_retries(tmpdir):
+    uploaded = tmpdir.mkdir("uploaded")
+    storage_backend = OutboxErrorStorage(
+        FlakyStorage(str(uploaded), failures=2),
+        outbox_path=str(tmpdir.join("outbox")),
+        initial_retry_delay=0.01,
+    )
+
+    location = storage_backend.write("report 1.json", "{}")
+
+    assert location == str(uploaded.join("report 1.json"))
+    for _ in range(100):
+        if storage_backend.flush(1):
+            break
+        time.sleep(0.01)
+    assert uploaded.join("report 1.json").read() == "{}"
+    assert tmpdir.join("outbox").listdir() == []
+
+
+def test_outbox_storage_resumes_pending_uploads(tmpdir):
+    uploaded = tmpdir.mkdir("uploaded")
+    outbox = tmpdir.mkdir("outbox")
+    outbox.join("1_report.json").write("{}")
+
+    storage_backend = OutboxErrorStorage(
+        LocalErrorStorage(output_path=str(uploaded)), outbox_path=str(outbox)
+    )
+
+    assert storage_backend.flush(1)
+    assert uploaded.join("report.json").read() == "{}"
+
+
+def test_outbox_storage_is_bounded(tmpdir):
+    outbox = tmpdir.join("outbox")
+    storage_backend = OutboxErrorStorage(
+        FlakyStorage(str(tmpdir), failures=1000),
+        outbox_path=str(outbox),
+        max_outbox_bytes=25,
+        initial_retry_delay=10,
+    )
+
+    for i in range(5):
+        storage_backend.write(f"{i}.json", "x" * 10)
+
+    assert len(outbox.listdir()) == 2
+
+
+class PoisonStorage(LocalErrorStorage):
+    def write(self, filename, data):
+        if filename == "poison.json":
+            return None
+        return super().write(filename, data)
+
+
+def test_outbox_storage_moves_failing_reports_aside(tmpdir):
+    uploaded = tmpdir.mkdir("uploaded")
+    outbox = tmpdir.join("outbox")
+    storage_backend = OutboxErrorStorage(
+        PoisonStorage(str(uploaded)), outbox_path=str(outbox), initial_retry_delay=0.01
+    )
+    storage_backend.max_attempts = 2
+
+    storage_backend.write("poison.json", "{}")
+    for i in range(3):
+        time.sleep(0.05)
+        storage_backend.write(f"{i}.json", "{}")
+    for _ in range(100):
+        if storage_backend.flush(1):
+            break
+        time.sleep(0.01)
+
+    assert sorted(uploaded.listdir()) == [uploaded.join(f"{i}.json") for i in range(3)]
+    assert [p.basename.split("_", 1)[1] for p in outbox.join("failed").listdir()] == [
+        "poison.json"
+    ]
+
+
+def test_outbox_storage_recovers_leftovers(tmpdir):
+    uploaded = tmpdir.mkdir("uploaded")
+    outbox = tmpdir.mkdir("outbox")
+    outbox.join("1_partial.json.tmp").write("{")
+    os.utime(str(outbox.join("1_partial.json.tmp")), (0, 0))
+    outbox.join("2_fresh.json.tmp").write("{")
+    # claimed by a process that exited
+    outbox.join("3_claimed.json.999999999.claimed").write("{}")
+
+    storage_backend = OutboxErrorStorage(
+        LocalErrorStorage(output_path=str(uploaded)), outbox_path=str(outbox)
+    )
+
+    assert storage_backend.flush(1)
+    assert uploaded.join("claimed.json").read() == "{}"
+    assert [p.basename for p in outbox.listdir()] == ["2_fresh.json.tmp"]
+
+
+def test_segment_storage(tmpdir):
+    storage_backend = SegmentErrorStorage(output_path=str(tmpdir), segment_bytes=130)
+
+    locations = [storage_backend.write(f"{i}.json", "x" * 40) for i in range(5)]
+    storage_backend.write("report.html", "<html></html>")
+
+    assert len(storage_backend.segments()) == 3
+    assert storage_backend.read("report.html") == b"<html></html>"
+    assert storage_backend.read("missing.html") is None
+    assert read_segment_record(locations[3]) == b"x" * 40
+    assert storage_backend.location("3.json") == locations[3]
+
+    extracted = extract_segment_report(
+        storage_backend.location("report.html"), str(tmpdir.join("report.html"))
+    )
+    with open(extracted, encoding="utf-8") as f:
+        assert f.read() == "<html></html>"
+
+    with pytest.raises(SegmentLockedError):
+        SegmentErrorStorage(output_path=str(tmpdir))
+    storage_backend.close()
+
+    reopened = SegmentErrorStorage(output_path=str(tmpdir), segment_bytes=130)
+    assert reopened.exists("0.json")
+    assert reopened.read("report.html") == b"<html></html>"
+
+
+def test_segment_storage_recovers_torn_record(tmpdir):
+    storage_backend = SegmentErrorStorage(output_path=str(tmpdir))
+    storage_backend.write("a.json", "{}")
+    location = storage_backend.write("b.json", '{"b": 1}')
+    storage_backend.close()
+
+    segment, offset = location.rsplit(":", 1)
+    with open(segment, "r+b") as f:
+        f.truncate(int(offset) + 10)
+
+    reopened = SegmentErrorStorage(output_path=str(tmpdir))
+    assert reopened.exists("a.json")
+    assert not reopened.exists("b.json")
+    assert reopened.write("c.json", "{}") == location
+    assert reopened.read("c.json") == b"{}"
+
+
+def test_segment_storage_index_is_bounded(tmpdir):
+    storage_backend = SegmentErrorStorage(
+        output_path=str(tmpdir), segment_bytes=130, max_indexed_segments=2
+    )
+
+    locations = [storage_backend.write(f"{i}.json", "x" * 40) for i in range(6)]
+
+    assert len(storage_backend.segments()) == 3
+    assert not storage_backend.exists("0.json")
+    assert storage_backend.exists("5.json")
+    assert storage_backend.read("0.json") == b"x" * 40
+    assert storage_backend.location("1.json") == locations[1]
+    storage_backend.close()
+
+    reopened = SegmentErrorStorage(
+        output_path=str(tmpdir), segment_bytes=130, max_indexed_segments=2
+    )
+    assert not reopened.exists("0.json")
+    assert reopened.read("1.json") == b"x" * 40
+
+
+def test_segment_storage_concurrent_reads(tmpdir):
+    storage_backend = SegmentErrorStorage(
+        output_path=str(tmpdir), segment_bytes=1000, max_indexed_segments=2
+    )
+    for i in range(20):
+        storage_backend.write(f"{i}.json", "x" * 40)
+    written = [20]
+    errors = []
+    done = threading.Event()
+
+    def read():
+        # the newest reports, in the mapped segments that writes roll over
+        i = 0
+        while not done.is_set():
+            i += 1
+            try:
+                name = f"{written[0] - 1 - i % 20}.json"
+                assert storage_backend.read(name) == b"x" * 40
+            except Exception as e:  # noqa
+                errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for i in range(20, 2000):
+        storage_backend.write(f"{i}.json", "x" * 40)
+        written[0] = i + 1
+    done.set()
+    for reader in readers:
+        reader.join()
+    storage_backend.close()
+
+    assert not errors
+
+
+def test_memory_storage_is_bounded():
+    storage_backend = MemoryErrorStorage(max_reports=3)
+
+    for i in range(5):
+        assert storage_backend.write(f"{i}.json", "{}" * 1000) == f"memory:{i}.json"
+
+    assert [name for name, _, _ in storage_backend.reports()] == [
+        "4.json",
+        "3.json",
+        "2.json",
+    ]
+    assert storage_backend.read("4.json") == b"{}" * 1000
+    assert not storage_backend.exists("1.json")
+    assert storage_backend.read("1.json") is None
+
+    storage_backend = MemoryErrorStorage(max_bytes=100)
+    storage_backend.write("a.json", os.urandom(80))
+    storage_backend.write("b.json", os.urandom(80))
+    assert [name for name, _, _ in storage_backend.reports()] == ["b.json"]
+
+
+def test_memory_storage_keeps_shared_objects():
+    storage_backend = MemoryErrorStorage(max_reports=3)
+    storage_backend.write_once("assets/report.css", "body {}")
+    storage_backend.write_once("snippets/a.json", "{}")
+
+    for i in range(3):
+        storage_backend.write(f"{i}.json", "{}")
+
+    assert storage_backend.exists("assets/report.css")
+    assert not storage_backend.exists("snippets/a.json")
+    # a dropped snippet is stored again
+    storage_backend.write_once("snippets/a.json", "{}")
+    assert storage_backend.exists("snippets/a.json")
+
+
+def test_memory_storage_server():
+    storage_backend = MemoryErrorStorage()
+    url = storage_backend.serve()
+    try:
+        assert url.startswith("http://127.0.0.1:")
+        location = storage_backend.write("report 1.html", "<html></html>")
+        assert location == f"{url}report%201.html"
+
+        with urlopen(url) as response:
+            assert "report%201.html" in response.read().decode("utf8")
+        with urlopen(location) as response:
+            assert response.headers["Content-Type"].startswith("text/html")
+            assert response.read() == b"<html></html>"
+
+        connection = HTTPConnection("127.0.0.1", int(url.rsplit(":", 1)[1][:-1]))
+        connection.request("GET", "/report%201.html", headers={"Host": "evil.test"})
+        assert connection.getresponse().status == 403
+        connection.close()
+    finally:
+        storage_backend.shutdown()
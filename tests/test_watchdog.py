@@ -0,0 +1,215 @@
+import asyncio
+import gc
+import json
+import os
+import re
+import signal
+import sys
+import time
+import weakref
+
+import pytest
+
+from exception_reports.storages import LocalErrorStorage
+from exception_reports.watchdog import StallWatchdog, TaskDumper
+
+
+def _reports(tmpdir):
+    reports = []
+    for path in tmpdir.listdir():
+        with open(path, "r", encoding="utf-8") as f:
+            reports.append(json.load(f))
+    return reports
+
+
+def test_stall_report(tmpdir):
+    watchdog = StallWatchdog(
+        threshold_ms=50,
+        storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+        output_format="json",
+    ).start()
+
+    def blocking_call():
+        time.sleep(0.3)
+
+    try:
+        for _ in range(5):
+            watchdog.heartbeat()
+            time.sleep(0.01)
+        watchdog.heartbeat()
+        blocking_call()
+        watchdog.heartbeat()
+        time.sleep(0.1)
+    finally:
+        watchdog.stop()
+
+    (report,) = _reports(tmpdir)
+    assert report["exception_type"] == "Stall"
+    assert report["frames"][0]["section"].endswith("stalled")
+    stalled_functions = [
+        f["function"] for f in report["frames"] if f["section"].endswith("stalled")
+    ]
+    assert "blocking_call" in stalled_functions
+
+
+def test_stall_reports_are_rate_limited(tmpdir):
+    watchdog = StallWatchdog(
+        threshold_ms=20,
+        storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+        output_format="json",
+        min_report_interval=60,
+    ).start()
+
+    try:
+        for _ in range(2):
+            watchdog.heartbeat()
+            time.sleep(0.15)
+    finally:
+        watchdog.stop()
+
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_event_loop_stall_report(tmpdir):
+    async def main():
+        watchdog = StallWatchdog(
+            threshold_ms=50,
+            storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+            output_format="json",
+        ).start()
+        watchdog.watch_loop(asyncio.get_running_loop())
+        try:
+            await asyncio.sleep(0.1)
+            time.sleep(0.3)
+            await asyncio.sleep(0.05)
+        finally:
+            watchdog.stop()
+
+    asyncio.run(main())
+
+    (report,) = _reports(tmpdir)
+    assert "main" in [f["function"] for f in report["frames"]]
+
+
+async def _waiting_tasks(event):
+    async def wait_for_event(job_id):
+        await event.wait()
+
+    async def handle(job_id):
+        pending_job = {"id": job_id}  # noqa
+        await wait_for_event(job_id)
+
+    tasks = [asyncio.create_task(handle(i), name=f"job-{i}") for i in range(3)]
+    await asyncio.sleep(0.05)
+    return tasks
+
+
+def test_task_dump(tmpdir):
+    async def main():
+        loop = asyncio.get_running_loop()
+        task_dumper = TaskDumper(
+            loop,
+            storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+            output_format="json",
+            sample_interval=0.01,
+            max_tasks=2,
+        ).start()
+        event = asyncio.Event()
+        tasks = await _waiting_tasks(event)
+        try:
+            return await asyncio.wrap_future(task_dumper.dump())
+        finally:
+            task_dumper.stop()
+            event.set()
+            await asyncio.gather(*tasks)
+
+    location = asyncio.run(main())
+
+    with open(location, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["exception_type"] == "Task dump"
+    assert report["exception_value"] == "3 pending tasks, showing the 2 waiting the longest"
+    sections = sorted({frame["section"] for frame in report["frames"]})
+    assert len(sections) == 2
+    assert re.match(
+        r"Task job-\d _waiting_tasks.<locals>.handle waiting \d+\.\ds on <Future pending",
+        sections[0],
+    )
+
+    handle_frame, wait_frame, event_wait_frame = report["frames"][:3]
+    assert [handle_frame["function"], wait_frame["function"]] == [
+        "handle",
+        "wait_for_event",
+    ]
+    assert event_wait_frame["section"] == handle_frame["section"]
+    assert event_wait_frame["filename"] == asyncio.locks.__file__
+    assert "pending_job" in dict(handle_frame["vars"])
+    assert wait_frame["context_line"].strip() == "await event.wait()"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires SIGUSR1")
+def test_task_dump_signal_handler(tmpdir):
+    async def main():
+        task_dumper = TaskDumper(
+            asyncio.get_running_loop(),
+            storage_backend=LocalErrorStorage(output_path=str(tmpdir)),
+            output_format="json",
+        )
+        task_dumper.install_signal_handler()
+        event = asyncio.Event()
+        tasks = await _waiting_tasks(event)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if tmpdir.listdir():
+                break
+        event.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+    (report,) = _reports(tmpdir)
+    # the main task is waiting too
+    assert report["exception_value"] == "4 pending tasks"
+    assert "handle" in [f["function"] for f in report["frames"]]
+
+
+def test_task_dump_does_not_keep_tasks_alive():
+    async def main():
+        task_dumper = TaskDumper(
+            asyncio.get_running_loop(), sample_interval=0.01
+        ).start()
+        event = asyncio.Event()
+        tasks = await _waiting_tasks(event)
+        await asyncio.sleep(0.03)
+        assert len(task_dumper._waiting) == 4  # noqa: W0212
+        task_refs = [weakref.ref(task) for task in tasks]
+        event.set()
+        await asyncio.sleep(0.01)
+        assert all(task.done() for task in tasks)
+        del tasks
+        gc.collect()
+        assert [ref() for ref in task_refs] == [None] * 3
+        task_dumper.stop()
+        assert len(task_dumper._waiting) == 0  # noqa: W0212
+
+    asyncio.run(main())
+
+
+def test_task_dump_signal_handler_fallback(monkeypatch):
+    handlers = {}
+
+    def add_signal_handler(signum, callback):
+        raise NotImplementedError
+
+    monkeypatch.delattr(signal, "SIGUSR1", raising=False)
+    monkeypatch.setattr(signal, "SIGBREAK", 21, raising=False)
+    monkeypatch.setattr(signal, "signal", handlers.__setitem__)
+    loop = asyncio.new_event_loop()
+    try:
+        monkeypatch.setattr(loop, "add_signal_handler", add_signal_handler)
+        TaskDumper(loop).install_signal_handler()
+    finally:
+        loop.close()
+
+    assert list(handlers) == [21]